@@ -15,14 +15,18 @@ from __future__ import print_function
 __license__ = 'GNU Affero GPL v3'
 __copyright__ = '2014, Robert Błaut listy@blaut.biz'
 __appname__ = u'ExtractCoverThumbs'
-numeric_version = (1, 0, 1)
-__version__ = u'.'.join(map(unicode, numeric_version))
+from lib.version import __version__
 __author__ = u'Robert Błaut <listy@blaut.biz>'
 
 import argparse
+import multiprocessing
 import os
 import sys
 from lib.extract_cover_thumbs import extract_cover_thumbs
+from lib.extract_cover_thumbs import THUMB_QUALITIES
+from lib.extract_cover_thumbs import APNX_ALGORITHMS
+from lib.metrics import profiled
+from lib.progress import DEBUG, INFO, printed_progress
 from distutils.util import strtobool
 
 parser = argparse.ArgumentParser()
@@ -40,7 +44,8 @@ parser.add_argument("--overwrite-amzn-thumbs",
                     help="overwrite amzn ebook (EBOK) and book sample (EBSP)"
                          " cover thumbnails",
                     action="store_true")
-parser.add_argument("-o", "--overwrite-apnx", help="overwrite APNX files",
+parser.add_argument("-o", "--overwrite-apnx",
+                    help="overwrite all APNX files, not only stale ones",
                     action="store_true")
 parser.add_argument("--skip-apnx", help="skip generating APNX files",
                     action="store_true")
@@ -59,25 +64,58 @@ parser.add_argument("-l", "--lubimy-czytac",
                     help="download real pages from lubimyczytac.pl "
                     "(time-consuming process!) (only with -d)",
                     action="store_true")
+parser.add_argument("--lubimy-czytac-rate", type=float, default=1.0,
+                    metavar='RATE',
+                    help="maximum number of requests per second sent to "
+                         "lubimyczytac.pl (default: 1)")
+parser.add_argument("--lubimy-czytac-workers", type=int, default=4,
+                    metavar='N',
+                    help="number of books looked up on lubimyczytac.pl "
+                         "at the same time (default: 4)")
 parser.add_argument("--mark-real-pages",
                     help="mark computed pages as real pages "
                     "(only with -l and -d)",
                     action="store_true")
+parser.add_argument("--no-cache",
+                    help="do not use cache of parsed books metadata "
+                         "and downloaded pages",
+                    action="store_true")
+parser.add_argument("--purge-cache",
+                    help="remove cache of parsed books metadata "
+                         "and downloaded pages before processing",
+                    action="store_true")
+parser.add_argument("-j", "--jobs", type=int, default=1, metavar='N',
+                    help="number of books processed in parallel "
+                         "(default: 1)")
+parser.add_argument("--thumb-quality", choices=THUMB_QUALITIES,
+                    default='normal',
+                    help="speed/quality of cover thumbnails scaling: "
+                         "best, normal or fast (default: normal)")
+parser.add_argument("--apnx-algorithm", choices=APNX_ALGORITHMS,
+                    default='fast',
+                    help="page mapping of books without pages in CSV file: "
+                         "fast (2300 characters per page) or accurate "
+                         "(pages broken on paragraphs) (default: fast)")
+parser.add_argument("--stats", metavar='FILE',
+                    help="save counters and timers of processing stages "
+                         "as JSON report in FILE")
+parser.add_argument("--stats-prometheus", metavar='FILE',
+                    help="save counters and timers of processing stages "
+                         "in Prometheus textfile FILE")
+parser.add_argument("--trace", type=int, nargs='?', const=10, metavar='N',
+                    help="trace time spent on every book and report N "
+                         "slowest books and histogram of books processing "
+                         "time (default: 10)")
+parser.add_argument("--profile", action="store_true",
+                    help="profile the run with cProfile and save "
+                         "statistics next to --stats report (default: "
+                         "extract_cover_thumbs.prof)")
 
 if sys.platform == 'darwin':
     parser.add_argument("-e", "--eject",
                         help="eject Kindle after completing process",
                         action="store_true")
 
-if sys.platform == "win32":
-    from lib.win_utf8_console import fix_broken_win_console
-    fix_broken_win_console()
-
-args = parser.parse_args()
-
-kindlepath = args.kindle_directory
-docs = os.path.join(kindlepath, 'documents')
-
 
 def user_yes_no_query(question):
     sys.stdout.write('%s [y/n]\n' % question)
@@ -88,12 +126,38 @@ def user_yes_no_query(question):
             sys.stdout.write('Please respond with \'y\' or \'n\'.\n')
 
 if __name__ == '__main__':
-    extract_cover_thumbs(args.silent, args.overwrite_pdoc_thumbs,
-                         args.overwrite_amzn_thumbs,
-                         args.overwrite_apnx, args.skip_apnx,
-                         kindlepath, args.azw, args.days,
-                         args.fix_thumb, args.lubimy_czytac,
-                         args.mark_real_pages, args.patch_azw3)
+    # worker processes re-import this module on Windows
+    multiprocessing.freeze_support()
+    if sys.platform == "win32":
+        from lib.win_utf8_console import fix_broken_win_console
+        fix_broken_win_console()
+
+    args = parser.parse_args()
+
+    kindlepath = args.kindle_directory
+    docs = os.path.join(kindlepath, 'documents')
+
+    run_args = (args.silent, args.overwrite_pdoc_thumbs,
+                args.overwrite_amzn_thumbs,
+                args.overwrite_apnx, args.skip_apnx,
+                kindlepath, args.azw, args.days,
+                args.fix_thumb, args.lubimy_czytac,
+                args.mark_real_pages, args.patch_azw3,
+                not args.no_cache, args.purge_cache, args.jobs,
+                args.thumb_quality, args.lubimy_czytac_rate,
+                args.apnx_algorithm, args.stats,
+                args.stats_prometheus, args.trace,
+                args.lubimy_czytac_workers)
+    with printed_progress(INFO if args.silent else DEBUG):
+        if args.profile:
+            if args.stats:
+                profile_path = os.path.splitext(args.stats)[0] + '.prof'
+            else:
+                profile_path = 'extract_cover_thumbs.prof'
+            profiled(profile_path, extract_cover_thumbs, *run_args)
+            print('* Profile saved to "%s"' % profile_path)
+        else:
+            extract_cover_thumbs(*run_args)
     if sys.platform == 'darwin':
         if args.eject:
             os.system('diskutil eject ' + kindlepath)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+"""
+Benchmark of HUFF/CDIC decoding of lib/mobi_text.py.
+
+Synthetic text records are decoded by the table driven HuffcdicReader
+and checked against the text they were compressed from. The same records
+are decoded by the classic bit loop of KindleUnpack, walking dict1 and
+dict2 for every code, and the speedup is printed.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import (cdic_records, huff_record,
+                                  huffcdic_codes, huffcdic_compress)
+from lib.mobi_text import QUAD, HuffcdicReader
+
+# codes of records, most of them short like in real books
+CODES_PER_RECORD = 2000
+SHORT_CODES = 64
+
+
+class ReferenceReader(HuffcdicReader):
+    """Decoder looking up every code in dict1 and dict2 only."""
+
+    def unpack(self, data):
+        out = []
+        bitsleft = len(data) * 8
+        data += b'\x00' * 8
+        pos = 0
+        x, = QUAD.unpack_from(data, 0)
+        n = 32
+        while True:
+            if n <= 0:
+                pos += 4
+                x, = QUAD.unpack_from(data, pos)
+                n += 32
+            codelen, index = self.long_code((x >> n) & 0xffffffff)
+            n -= codelen
+            bitsleft -= codelen
+            if bitsleft < 0:
+                break
+            phrase = self.phrases[index]
+            if phrase is None:
+                phrase = self.expand(index)
+            out.append(phrase)
+        return b''.join(out)
+
+
+def phrases_and_records(count, seed=0):
+    """
+    Return phrases, compressed text records and their text.
+
+    Every tenth phrase is stored compressed as two other phrases.
+    """
+    rnd = random.Random(seed)
+    codes = huffcdic_codes()[0]
+    phrases = [b'p%03d' % index for index in range(len(codes))]
+    texts = list(phrases)
+    for index in range(0, len(phrases), 10):
+        parts = [rnd.randrange(len(phrases)) for _ in range(2)]
+        parts = [part + 1 if part % 10 == 0 else part for part in parts]
+        phrases[index] = parts
+        texts[index] = b''.join(texts[part] for part in parts)
+    records = []
+    text = []
+    for _ in range(count):
+        indexes = [rnd.randrange(SHORT_CODES) if rnd.random() < 0.9
+                   else rnd.randrange(len(codes))
+                   for _ in range(CODES_PER_RECORD)]
+        records.append(huffcdic_compress(codes, indexes))
+        text.append(b''.join(texts[index] for index in indexes))
+    return phrases, records, text
+
+
+def bench(reader_class, huff, cdics, records, repeat):
+    """Return best time of decoding all records and the decoded text."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        reader = reader_class(huff, cdics)
+        text = [reader.unpack(data) for data in records]
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--records', type=int, default=100,
+                        help='number of text records (default: 100)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of repetitions, best is reported '
+                        '(default: 5)')
+    args = parser.parse_args()
+
+    codes = huffcdic_codes()[0]
+    phrases, records, expected = phrases_and_records(args.records)
+    huff = huff_record()
+    cdics = cdic_records(codes, phrases)
+    size = sum(len(text) for text in expected)
+    print('* Decoding %d record(s), %.1f MB of text' % (len(records),
+                                                        size / 1048576.0))
+
+    current, text = bench(HuffcdicReader, huff, cdics, records, args.repeat)
+    if text != expected:
+        sys.exit('FAILED! HuffcdicReader text differs from compressed text')
+    reference, text = bench(ReferenceReader, huff, cdics, records,
+                            args.repeat)
+    if text != expected:
+        sys.exit('FAILED! Reference text differs from compressed text')
+    print('  current:   %.3f s, %.1f MB/s' % (current,
+                                              size / 1048576.0 / current))
+    print('  reference: %.3f s, %.1f MB/s' % (reference,
+                                              size / 1048576.0 / reference))
+    print('  speedup:   %.2fx' % (reference / current))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+"""
+Benchmark of ION decoding of lib/kfxmeta.py.
+
+All entities of KFX containers given on command line (or of a synthetic
+book) are decoded. With --baseline the same containers are decoded by
+kfxmeta.py of another checkout, e.g. previous release, and the speedup
+is printed.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import imp
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import kfx_book
+
+
+def load_kfxmeta(path, name):
+    return imp.load_source(name, path)
+
+
+def bench(kfxmeta, containers, repeat):
+    """Return best time of decoding all containers."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for data in containers:
+            kfxmeta.KFXContainer(data).decode()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('files', nargs='*', help='KFX containers to decode '
+                        '(default: synthetic book)')
+    parser.add_argument('--baseline', metavar='KFXMETA_PY',
+                        help='kfxmeta.py to compare with')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of repetitions, best is reported '
+                        '(default: 5)')
+    args = parser.parse_args()
+
+    if args.files:
+        containers = []
+        for name in args.files:
+            with open(name, 'rb') as f:
+                containers.append(f.read())
+    else:
+        containers = [kfx_book(u'B000000000', u'Benchmark',
+                               b'\xff\xd8' * 1024, storylines=500)]
+    size = sum(len(data) for data in containers)
+    print('* Decoding %d container(s), %.1f MB' % (len(containers),
+                                                   size / 1048576.0))
+
+    current = bench(load_kfxmeta(os.path.join(ROOT, 'lib', 'kfxmeta.py'),
+                                 'kfxmeta_current'), containers, args.repeat)
+    print('  current:  %.3f s, %.1f MB/s' % (current,
+                                             size / 1048576.0 / current))
+    if args.baseline:
+        baseline = bench(load_kfxmeta(args.baseline, 'kfxmeta_baseline'),
+                         containers, args.repeat)
+        print('  baseline: %.3f s, %.1f MB/s' % (baseline,
+                                                 size / 1048576.0 / baseline))
+        print('  speedup:  %.2fx' % (baseline / current))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+"""
+Benchmark of processing a synthetic Kindle library.
+
+Libraries of MOBI7, KF8 (AZW3), combo and KFX books are generated for
+every size given and the library scan, extract_cover_thumbs (covers
+only) and generate_apnx_files stages are run on them. Every stage runs
+in its own process, so books per second, bytes read from the disk and
+peak RSS are reported per stage.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import BOOK_FORMATS, kindle_library
+from lib.book_cache import BookCache
+from lib.extract_cover_thumbs import extract_cover_thumbs
+from lib.extract_cover_thumbs import generate_apnx_files
+from lib.pages import PagesDatabase
+from lib.scanner import MOBI_EXTENSIONS, scan_library
+
+CSV_PAGES_NAME = 'extract_cover_thumbs_book_pages2.csv'
+# getrusage() block counts are in 512 byte units
+BLOCK_SIZE = 512
+POSIX_FADV_DONTNEED = 4
+
+
+def evict_file(path):
+    """
+    Drop file from the page cache, so it is read from the disk again.
+
+    Return False if it is not supported on this system.
+    """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fadvise = libc.posix_fadvise
+    except (ImportError, OSError, AttributeError):
+        return False
+    fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong,
+                        ctypes.c_int]
+    with open(path, 'rb') as f:
+        # dirty pages are not dropped
+        os.fsync(f.fileno())
+        return fadvise(f.fileno(), 0, 0, POSIX_FADV_DONTNEED) == 0
+
+
+def evict_library(root):
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            if not evict_file(os.path.join(dirpath, name)):
+                return False
+    return True
+
+
+def reset_library(root):
+    """Remove thumbnails, pages CSV and APNX files of previous runs."""
+    thumbs = os.path.join(root, 'system', 'thumbnails')
+    for name in os.listdir(thumbs):
+        os.remove(os.path.join(thumbs, name))
+    docs = os.path.join(root, 'documents')
+    if os.path.isfile(os.path.join(docs, CSV_PAGES_NAME)):
+        os.remove(os.path.join(docs, CSV_PAGES_NAME))
+    for dirpath, _, files in os.walk(docs):
+        for name in files:
+            if name.endswith('.apnx'):
+                os.remove(os.path.join(dirpath, name))
+
+
+def usage():
+    """Return blocks read and peak RSS in bytes of process and children."""
+    if resource is None:
+        return None, None
+    blocks = rss = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        ru = resource.getrusage(who)
+        blocks += ru.ru_inblock
+        rss = max(rss, ru.ru_maxrss)
+    if sys.platform != 'darwin':
+        # kilobytes everywhere but macOS
+        rss *= 1024
+    return blocks * BLOCK_SIZE, rss
+
+
+def run_stage(func, args, results):
+    sys.stdout = open(os.devnull, 'w')
+    start_read, _ = usage()
+    start = time.time()
+    count = func(*args)
+    elapsed = time.time() - start
+    read, rss = usage()
+    if read is not None:
+        read -= start_read
+    results.put((count, elapsed, read, rss))
+
+
+def scan_stage(root):
+    return len(scan_library(os.path.join(root, 'documents'), None))
+
+
+def covers_stage(root, jobs):
+    extract_cover_thumbs(True, False, False, False, True, root, False, None,
+                         False, False, False, False, use_cache=False,
+                         jobs=jobs)
+    return scan_stage(root)
+
+
+def apnx_stage(root, jobs, algorithm):
+    docs = os.path.join(root, 'documents')
+    books = scan_library(docs, None)
+    generate_apnx_files(books, True,
+                        PagesDatabase(os.path.join(docs, CSV_PAGES_NAME)),
+                        BookCache(root, False), jobs, algorithm)
+    return sum(1 for book in books if book.ext in MOBI_EXTENSIONS)
+
+
+def measure(func, args):
+    """Run stage in a new process and return its measurements."""
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_stage,
+                                      args=(func, args, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def megabytes(value):
+    if value is None:
+        return '%10s' % 'n/a'
+    return '%10.1f' % (value / 1048576.0)
+
+
+def library_size(root):
+    return sum(os.path.getsize(os.path.join(dirpath, name))
+               for dirpath, _, files in os.walk(root) for name in files)
+
+
+def split_books(books, mix):
+    """Return numbers of books of each format proportional to mix."""
+    counts = [books * weight // sum(mix) for weight in mix]
+    counts[0] += books - sum(counts)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-b', '--books', type=int, nargs='+',
+                        default=[100, 5000, 50000],
+                        help='sizes of libraries (default: 100 5000 50000)')
+    parser.add_argument('--mix', default='4,2,2,2',
+                        help='proportions of MOBI7, KF8, combo and KFX '
+                        'books (default: 4,2,2,2)')
+    parser.add_argument('--paragraphs', type=int, default=100,
+                        help='paragraphs of text of every book '
+                        '(default: 100)')
+    parser.add_argument('--cover-size', default='600x900',
+                        help='size of cover images (default: 600x900)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of books processed in parallel '
+                        '(default: 1)')
+    parser.add_argument('--apnx-algorithm', choices=('fast', 'accurate'),
+                        default='fast', help='page mapping of books '
+                        '(default: fast)')
+    parser.add_argument('--warm', action='store_true',
+                        help='do not drop library files from the page '
+                        'cache before every stage')
+    parser.add_argument('--dir',
+                        help='directory where libraries are kept and '
+                        'reused by next runs (default: temporary one)')
+    args = parser.parse_args()
+
+    mix = [int(weight) for weight in args.mix.split(',')]
+    if len(mix) != len(BOOK_FORMATS) or sum(mix) <= 0:
+        parser.error('--mix needs %d proportions' % len(BOOK_FORMATS))
+    cover_size = tuple(int(side) for side in args.cover_size.split('x'))
+    workdir = args.dir or tempfile.mkdtemp(
+        prefix='extract_cover_thumbs-bench-')
+    try:
+        for books in args.books:
+            counts = split_books(books, mix)
+            root = os.path.join(workdir, 'library-%s' % '-'.join(
+                str(count) for count in counts + [args.paragraphs]))
+            if not os.path.isdir(root):
+                print('* Generating library of %d books...' % books)
+                start = time.time()
+                kindle_library(root, *counts, paragraphs=args.paragraphs,
+                               cover_size=cover_size)
+                print('  done in %.1f s' % (time.time() - start))
+            reset_library(root)
+            print('* Library: %d books (%s), %.1f MB' % (
+                books, ', '.join('%d %s' % (count, book_format)
+                                 for book_format, count
+                                 in zip(BOOK_FORMATS, counts)),
+                library_size(root) / 1048576.0))
+            print('  %-8s %8s %9s %10s %10s %10s' % (
+                'stage', 'books', 'time s', 'books/s', 'read MB',
+                'peak RSS MB'))
+            for name, func, stage_args in (
+                    ('scan', scan_stage, (root,)),
+                    ('covers', covers_stage, (root, args.jobs)),
+                    ('apnx', apnx_stage, (root, args.jobs,
+                                          args.apnx_algorithm))):
+                if not args.warm and not evict_library(root):
+                    print('! Page cache can not be dropped, bytes read '
+                          'depend on files cached by the system')
+                    args.warm = True
+                count, elapsed, read, rss = measure(func, stage_args)
+                print('  %-8s %8d %9.2f %10.1f %s %s' % (
+                    name, count, elapsed, count / max(elapsed, 1e-6),
+                    megabytes(read), megabytes(rss)))
+    finally:
+        if not args.dir:
+            shutil.rmtree(workdir, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+"""Builders of synthetic book files used by benchmarks."""
+
+import os
+import random
+import struct
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+ION_MAGIC = b'\xe0\x01\x00\xea'
+ION_SYMBOL_TABLE = 3
+
+# symbols of lib/kfxmeta.py YJ_SYMBOLS
+SYMBOLS = 7
+MAX_ID = 8
+LANGUAGE = 10
+TITLE = 153
+EXTERNAL_RESOURCE = 164
+LOCATION = 165
+ASIN = 224
+CDE_CONTENT_TYPE = 251
+METADATA = 258
+VALUE = 307
+RAW_MEDIA = 417
+COVER_IMAGE = 424
+BOOK_METADATA = 490
+CATEGORISED_METADATA = 491
+KEY = 492
+# not known to kfxmeta, decoded as "S<number>"
+CATEGORY = 495
+STORYLINE = 259
+CONTENT = 146
+POSITION = 155
+STYLE = 157
+WIDTH = 56
+FIRST_LOCAL_SYMBOL = 851
+
+DRMION_MAGIC = b'\xeaDRMION\xee'
+
+TEXT_RECORD_SIZE = 4096
+MOBI_HEADER_LENGTH = 0xe8
+UTF8_CODEPAGE = 65001
+# multibyte characters overflowing into the next record are appended
+# to text records, like KindleGen does
+MULTIBYTE_FLAG = 1
+FLIS = b'FLIS\x00\x00\x00\x08\x00\x41\x00\x00\x00\x00\x00\x00' \
+    b'\xff\xff\xff\xff\x00\x01\x00\x03\x00\x00\x00\x03' \
+    b'\x00\x00\x00\x01\xff\xff\xff\xff'
+EOF_RECORD = b'\xe9\x8e\r\n'
+
+BOOK_FORMATS = ('mobi7', 'kf8', 'combo', 'kfx')
+
+# numbers of HUFF codes of each length, chosen so that codes of 9, 11, 12,
+# 16 and 17 bits fill whole first bytes (terminal dict1 entries) and other
+# first bytes are shared by codes of two lengths
+HUFF_CODE_COUNTS = {17: 768, 16: 640, 12: 24, 11: 20, 9: 4, 8: 6, 7: 8,
+                    6: 8, 5: 8, 2: 2}
+
+
+class Symbol(int):
+    """Integer encoded as ION symbol."""
+
+
+class Struct(tuple):
+    """Sequence of (symbol, value) pairs encoded as ION struct."""
+
+
+class Typed(tuple):
+    """(type, id, value) encoded as ION typed data."""
+
+
+def varuint(number):
+    data = [number & 0x7f | 0x80]
+    number >>= 7
+    while number:
+        data.append(number & 0x7f)
+        number >>= 7
+    return bytes(bytearray(reversed(data)))
+
+
+def uint(number):
+    data = bytearray()
+    while number:
+        data.insert(0, number & 0xff)
+        number >>= 8
+    return bytes(data)
+
+
+def typed_value(data_type, data):
+    if len(data) < 14:
+        return chr(data_type << 4 | len(data)) + data
+    return chr(data_type << 4 | 14) + varuint(len(data)) + data
+
+
+def encode(value):
+    if value is None:
+        return b'\x0f'
+    if isinstance(value, bool):
+        return chr(0x10 | value)
+    if isinstance(value, Symbol):
+        return typed_value(7, uint(value))
+    if isinstance(value, (int, long)):
+        if value < 0:
+            return typed_value(3, uint(-value))
+        return typed_value(2, uint(value))
+    if isinstance(value, float):
+        return typed_value(4, struct.pack('>d', value))
+    if isinstance(value, unicode):
+        return typed_value(8, value.encode('UTF-8'))
+    if isinstance(value, str):
+        return typed_value(8, value)
+    if isinstance(value, list):
+        return typed_value(11, b''.join(encode(v) for v in value))
+    if isinstance(value, Struct):
+        return typed_value(13, b''.join(
+            varuint(k) + encode(v) for k, v in value))
+    if isinstance(value, Typed):
+        return typed_value(14, varuint(value[0]) + varuint(value[1]) +
+                           encode(value[2]))
+    raise TypeError('cannot encode %r' % (value,))
+
+
+def ion(value):
+    return ION_MAGIC + encode(value)
+
+
+def container(entities, symbols=()):
+    """
+    Return KFX container with entities given as (id, type, payload).
+
+    Local symbols get numbers from FIRST_LOCAL_SYMBOL up.
+    """
+    body = BytesIO()
+    index = BytesIO()
+    for entity_id, entity_type, payload in entities:
+        index.write(struct.pack('<LLQQ', entity_id, entity_type,
+                                body.tell(), 10 + len(payload)))
+        body.write(b'ENTY' + struct.pack('<HL', 1, 10) + payload)
+    header_len = 18
+    offset = header_len + body.tell()
+    index = index.getvalue()
+    info = [(413, offset), (414, len(index))]
+    tail = index
+    if symbols:
+        doc_symbols = ion(Typed((ION_SYMBOL_TABLE, ION_SYMBOL_TABLE, Struct((
+            (SYMBOLS, list(symbols)),
+            (MAX_ID, FIRST_LOCAL_SYMBOL + len(symbols) - 1))))))
+        info += [(415, offset + len(tail)), (416, len(doc_symbols))]
+        tail += doc_symbols
+    info = ion(Struct(info))
+    return (b'CONT' + struct.pack('<HLLL', 2, header_len,
+                                  offset + len(tail), len(info)) +
+            body.getvalue() + tail + info)
+
+
+def storyline(rnd, paragraphs):
+    return ion(Struct((
+        (CONTENT, [Struct((
+            (POSITION, rnd.randint(0, 1 << 20)),
+            (STYLE, Symbol(rnd.choice((10, 153, 224)))),
+            (WIDTH, rnd.random() * 100),
+            (VALUE, u'Zażółć gęślą jaźń %d. ' % i * rnd.randint(1, 8)),
+        )) for i in range(paragraphs)]),
+    )))
+
+
+def kfx_book(asin, title, cover, doctype='EBOK', media=0, media_size=65536,
+             storylines=0, seed=0):
+    """
+    Return KFX container of a book with cover image and metadata.
+
+    Additional random media resources and storyline entities make the file
+    as large as real books.
+    """
+    rnd = random.Random(seed)
+    symbols = (['cover', 'resource/cover'] +
+               ['rsrc%d' % i for i in range(media)] +
+               ['resource/rsrc%d' % i for i in range(media)])
+    cover_symbol = FIRST_LOCAL_SYMBOL
+    metadata = [
+        ('title', title),
+        ('author', u'Jan Kowalski'),
+        ('author', u'Anna Nowak'),
+        ('ASIN', asin),
+        ('publisher', u'Wydawnictwo'),
+        ('description', u'Opis książki. ' * 200),
+    ]
+    entities = [
+        (900, METADATA, ion(Struct((
+            (ASIN, asin),
+            (CDE_CONTENT_TYPE, doctype),
+            (COVER_IMAGE, Symbol(cover_symbol)))))),
+        (901, BOOK_METADATA, ion(Struct((
+            (CATEGORISED_METADATA, [Struct((
+                (CATEGORY, u'kindle_title_metadata'),
+                (METADATA, [Struct(((KEY, k), (VALUE, v)))
+                            for k, v in metadata]))),
+            ]),)))),
+        (cover_symbol, EXTERNAL_RESOURCE, ion(Struct((
+            (LOCATION, u'resource/cover'),
+            (LANGUAGE, u'pl'))))),
+        (cover_symbol + 1, RAW_MEDIA, cover),
+    ]
+    for i in range(media):
+        # ids of resources and their locations follow the cover symbols
+        entities.append((cover_symbol + 2 + i, EXTERNAL_RESOURCE, ion(Struct((
+            (LOCATION, u'resource/rsrc%d' % i),
+            (WIDTH, rnd.randint(100, 1600)))))))
+        entities.append((cover_symbol + 2 + media + i, RAW_MEDIA,
+                         bytes(bytearray(rnd.getrandbits(8)
+                                         for _ in xrange(256))) *
+                         (media_size // 256)))
+    for i in range(storylines):
+        entities.append((10000 + i, STORYLINE, storyline(rnd, 40)))
+    return container(entities, symbols)
+
+
+def jpeg_cover(width=600, height=900, seed=0):
+    """Return JPEG cover image with random shapes and title bars."""
+    rnd = random.Random(seed)
+    image = Image.new('RGB', (width, height),
+                      tuple(rnd.randint(0, 255) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(24):
+        x, y = rnd.randint(0, width), rnd.randint(0, height)
+        draw.ellipse((x, y, x + rnd.randint(10, width // 2),
+                      y + rnd.randint(10, height // 2)),
+                     fill=tuple(rnd.randint(0, 255) for _ in range(3)))
+    for i in range(3):
+        top = height // 8 + i * height // 12
+        draw.rectangle((width // 10, top, width - width // 10,
+                        top + height // 24), fill=(240, 240, 240))
+    data = BytesIO()
+    image.save(data, 'JPEG', quality=85)
+    return data.getvalue()
+
+
+def exth(items):
+    """Return EXTH block of (id, value) pairs padded to 4 bytes."""
+    body = b''.join(struct.pack('>LL', i, len(v) + 8) + v for i, v in items)
+    data = b'EXTH' + struct.pack('>LL', 12 + len(body), len(items)) + body
+    return data + b'\x00' * (-len(data) % 4)
+
+
+def mobi_record0(text_length, text_records, first_resource, exth_items,
+                 title, version=6, fdst=0xffffffff):
+    """Return record 0 of uncompressed MOBI (version 6) or KF8 text."""
+    exth_data = exth(exth_items)
+    title_offset = 16 + MOBI_HEADER_LENGTH + len(exth_data)
+    header = bytearray(title_offset + len(title) + 2)
+    struct.pack_into('>HHLHHHH', header, 0, 1, 0, text_length,
+                     text_records, TEXT_RECORD_SIZE, 0, 0)
+    header[16:20] = b'MOBI'
+    struct.pack_into('>LLLLL', header, 20, MOBI_HEADER_LENGTH, 2,
+                     UTF8_CODEPAGE, random.Random(title).getrandbits(32),
+                     version)
+    for offset in range(0x28, 16 + MOBI_HEADER_LENGTH, 4):
+        struct.pack_into('>L', header, offset, 0xffffffff)
+    struct.pack_into('>L', header, 0x50, text_records + 1)
+    struct.pack_into('>LLL', header, 0x54, title_offset, len(title), 0x415)
+    struct.pack_into('>LLLL', header, 0x60, 0, 0, version, first_resource)
+    struct.pack_into('>LLLL', header, 0x70, 0, 0, 0, 0)
+    struct.pack_into('>L', header, 0x80, 0x40)
+    struct.pack_into('>LL', header, 0xc0, fdst, 1)
+    struct.pack_into('>HH', header, 0xf0, 0, MULTIBYTE_FLAG)
+    header[16 + MOBI_HEADER_LENGTH:title_offset] = exth_data
+    header[title_offset:title_offset + len(title)] = title
+    return bytes(header)
+
+
+def book_text(rnd, paragraphs):
+    return b''.join(
+        (u'<p>Rozdział %d. %s</p>' % (
+            i, u'Zażółć gęślą jaźń. ' * rnd.randint(1, 40))).encode('UTF-8')
+        for i in range(paragraphs))
+
+
+def text_records(text):
+    """Split text into records with multibyte overflow trailing entries."""
+    records = []
+    for start in range(0, len(text), TEXT_RECORD_SIZE):
+        end = start + TEXT_RECORD_SIZE
+        overflow = 0
+        while (overflow < 3 and end + overflow < len(text) and
+               0x80 <= ord(text[end + overflow]) < 0xc0):
+            overflow += 1
+        records.append(text[start:end + overflow] + chr(overflow))
+    return records
+
+
+def palm_database(name, records):
+    """Return PDB file of BOOKMOBI records."""
+    header = bytearray(78 + 8 * len(records) + 2)
+    name = name[:31]
+    header[0:len(name)] = name
+    header[60:68] = b'BOOKMOBI'
+    struct.pack_into('>H', header, 76, len(records))
+    offset = len(header)
+    for i, record in enumerate(records):
+        struct.pack_into('>LL', header, 78 + 8 * i, offset, 2 * i)
+        offset += len(record)
+    return bytes(header) + b''.join(records)
+
+
+def mobi_book(asin, title, cover, doctype='EBOK', book_format='mobi7',
+              paragraphs=100, seed=0):
+    """
+    Return MOBI7, KF8 (AZW3) or combo (MOBI7 and KF8) book.
+
+    Text records are uncompressed and the cover is the first resource
+    record shared by both parts of combo books.
+    """
+    rnd = random.Random(seed)
+    title = title.encode('UTF-8')
+    text = book_text(rnd, paragraphs)
+    records = text_records(text)
+    exth_items = [(100, b'Jan Kowalski'), (113, asin), (501, doctype),
+                  (524, b'pl'), (201, struct.pack('>L', 0)),
+                  (202, struct.pack('>L', 0))]
+    if book_format == 'kf8':
+        resources = [cover, b'FDST' + struct.pack('>LL', 12, 1) +
+                     struct.pack('>LL', 0, len(text)), FLIS, EOF_RECORD]
+        rec0 = mobi_record0(len(text), len(records), len(records) + 1,
+                            exth_items, title, 8, len(records) + 2)
+        return palm_database(title, [rec0] + records + resources)
+    resources = [cover, FLIS]
+    if book_format != 'combo':
+        rec0 = mobi_record0(len(text), len(records), len(records) + 1,
+                            exth_items, title)
+        return palm_database(title, [rec0] + records + resources +
+                             [EOF_RECORD])
+    # KF8 part follows BOUNDARY record and shares resources of MOBI7 part
+    kf8_start = len(records) + len(resources) + 2
+    kf8_text = book_text(rnd, paragraphs)
+    kf8_records = text_records(kf8_text)
+    rec0 = mobi_record0(len(text), len(records), len(records) + 1,
+                        exth_items + [(121, struct.pack('>L', kf8_start))],
+                        title)
+    kf8_rec0 = mobi_record0(len(kf8_text), len(kf8_records), 0xffffffff,
+                            exth_items, title, 8, len(kf8_records) + 1)
+    return palm_database(title, [rec0] + records + resources +
+                         [b'BOUNDARY', kf8_rec0] + kf8_records +
+                         [b'FDST' + struct.pack('>LL', 12, 1) +
+                          struct.pack('>LL', 0, len(kf8_text)), EOF_RECORD])
+
+
+def huffcdic_codes(counts=HUFF_CODE_COUNTS):
+    """
+    Return canonical HUFF codes as (codelen, code) pairs by phrase index.
+
+    Longer codes are numerically smaller, like MOBI decoders expect, and
+    phrases are numbered from the shortest codes. Tables of code ranges
+    and phrase offsets of every length are returned too.
+    """
+    low = {}
+    code = 0
+    for codelen in range(32, 0, -1):
+        low[codelen] = code
+        code = (code + counts.get(codelen, 0) + 1) >> 1
+    if code > 1:
+        raise ValueError('too many HUFF codes')
+    codes = []
+    maxcode = dict.fromkeys(range(1, 33), 0)
+    for codelen in range(1, 33):
+        count = counts.get(codelen, 0)
+        if not count:
+            continue
+        # phrase index is maxcode - code
+        first = len(codes)
+        maxcode[codelen] = first + low[codelen] + count - 1
+        codes.extend((codelen, maxcode[codelen] - index)
+                     for index in range(first, first + count))
+    return codes, low, maxcode
+
+
+def huff_record(counts=HUFF_CODE_COUNTS):
+    """Return HUFF record of canonical codes of huffcdic_codes()."""
+    low, maxcode = huffcdic_codes(counts)[1:]
+    # code lengths found under every first byte of codes
+    lengths = [set() for _ in range(256)]
+    for codelen, count in counts.items():
+        start = low[codelen] << (32 - codelen)
+        end = (low[codelen] + count) << (32 - codelen)
+        for prefix in range(start >> 24, ((end - 1) >> 24) + 1):
+            lengths[prefix].add(codelen)
+    dict1 = []
+    for prefix_lengths in lengths:
+        codelen = min(prefix_lengths)
+        if len(prefix_lengths) == 1:
+            dict1.append(codelen | 0x80 | maxcode[codelen] << 8)
+        else:
+            dict1.append(codelen)
+    dict2 = []
+    for codelen in range(1, 33):
+        dict2.extend((low[codelen], maxcode[codelen]))
+    return (b'HUFF\x00\x00\x00\x18' +
+            struct.pack('>LLQ', 24, 24 + 1024, 0) +
+            struct.pack('>256L', *dict1) + struct.pack('>64L', *dict2))
+
+
+def huffcdic_compress(codes, indexes):
+    """Return bits of codes of phrase indexes padded with zeros to bytes."""
+    value = 0
+    bits = 0
+    for index in indexes:
+        codelen, code = codes[index]
+        value = (value << codelen) | code
+        bits += codelen
+    value <<= -bits % 8
+    size = (bits + 7) // 8
+    return ('%0*x' % (2 * size, value)).decode('hex') if size else b''
+
+
+def cdic_records(codes, phrases, bits=10):
+    """
+    Return CDIC records of phrases.
+
+    Phrases given as lists of indexes of other phrases are stored
+    compressed.
+    """
+    records = []
+    for start in range(0, len(phrases), 1 << bits):
+        entries = []
+        for phrase in phrases[start:start + (1 << bits)]:
+            if isinstance(phrase, list):
+                data = huffcdic_compress(codes, phrase)
+                entries.append(struct.pack('>H', len(data)) + data)
+            else:
+                entries.append(struct.pack('>H', len(phrase) | 0x8000) +
+                               phrase)
+        offsets = []
+        offset = 2 * len(entries)
+        for entry in entries:
+            offsets.append(offset)
+            offset += len(entry)
+        records.append(b'CDIC\x00\x00\x00\x10' +
+                       struct.pack('>LL', len(phrases), bits) +
+                       struct.pack('>%dH' % len(offsets), *offsets) +
+                       b''.join(entries))
+    return records
+
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def kindle_library(root, mobi7=0, kf8=0, combo=0, kfx=0, paragraphs=100,
+                   cover_size=(600, 900), covers=16, seed=0):
+    """
+    Create Kindle tree with given numbers of books of each format.
+
+    Every book gets its .sdr directory like on the device. Every second
+    KFX book is encrypted, so its metadata is read from .sdr/assets.
+    Return list of created book paths.
+    """
+    docs = os.path.join(root, 'documents')
+    for path in (docs, os.path.join(root, 'system', 'thumbnails')):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    # encoding covers is slow, so a few of them are shared by all books
+    images = [jpeg_cover(cover_size[0], cover_size[1], seed + i)
+              for i in range(covers)]
+    counts = zip(BOOK_FORMATS, (mobi7, kf8, combo, kfx))
+    extensions = {'mobi7': '.mobi', 'kf8': '.azw3', 'combo': '.azw3',
+                  'kfx': '.kfx'}
+    paths = []
+    number = 0
+    for book_format, count in counts:
+        for _ in range(count):
+            asin = b'B%09d' % number
+            doctype = b'PDOC' if number % 3 == 0 else b'EBOK'
+            title = u'Książka %d' % number
+            cover = images[number % covers]
+            stem = 'Ksiazka_%d-%s' % (number, asin)
+            path = os.path.join(docs, stem + extensions[book_format])
+            sdr = os.path.join(docs, stem + '.sdr')
+            os.mkdir(sdr)
+            if book_format != 'kfx':
+                write_file(path, mobi_book(asin, title, cover, doctype,
+                                           book_format, paragraphs,
+                                           seed + number))
+            elif number % 2:
+                data = kfx_book(asin, title, cover, doctype, media=2,
+                                media_size=4096, seed=seed + number)
+                os.mkdir(os.path.join(sdr, 'assets'))
+                write_file(os.path.join(sdr, 'assets', 'metadata.kfx'), data)
+                write_file(path, DRMION_MAGIC + os.urandom(len(data)))
+            else:
+                write_file(path, kfx_book(asin, title, cover, doctype,
+                                          media=2, media_size=4096,
+                                          storylines=paragraphs // 40,
+                                          seed=seed + number))
+            paths.append(path)
+            number += 1
+    return paths
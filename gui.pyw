@@ -13,10 +13,10 @@
 __license__ = 'GNU Affero GPL v3'
 __copyright__ = '2014, Robert Błaut listy@blaut.biz'
 __appname__ = u'ExtractCoverThumbs'
-numeric_version = (1, 0, 0)
-__version__ = u'.'.join(map(unicode, numeric_version))
+from lib.version import __version__
 __author__ = u'Robert Błaut <listy@blaut.biz>'
 
+import multiprocessing
 import threading
 import Queue
 import tkFileDialog
@@ -24,6 +24,7 @@ import sys
 import Tkinter as tk
 from ScrolledText import ScrolledText
 from lib.extract_cover_thumbs import extract_cover_thumbs
+from lib.progress import PROGRESS, DEBUG, INFO, LogSink, StreamRedirector
 
 sentinel = object()
 
@@ -34,7 +35,8 @@ class ThreadedTask(threading.Thread):
     def __init__(self, outqueue, kindlepath, days, is_log,
                  is_overwrite_pdoc_thumbs, is_overwrite_amzn_thumbs,
                  is_overwrite_apnx, skip_apnx, is_azw, is_fix_thumb,
-                 status, run_button, lubimy_czytac, mark_real_pages, patch_azw3):
+                 status, run_button, lubimy_czytac, mark_real_pages, patch_azw3,
+                 jobs):
         threading.Thread.__init__(self)
         self.outqueue = outqueue
         self.kindlepath = kindlepath
@@ -49,10 +51,28 @@ class ThreadedTask(threading.Thread):
         self.is_azw = is_azw
         self.is_fix_thumb = is_fix_thumb
         self.patch_azw3 = patch_azw3
+        self.jobs = jobs
         self.status = status
         self.run_button = run_button
 
     def run(self):
+        try:
+            jobs = int(self.jobs.get())
+        except ValueError:
+            jobs = 1
+        # text of messages is put in chunks into the queue and inserted
+        # into the Message Window by the Tk thread
+        level = INFO if self.is_log.get() else DEBUG
+        sink = LogSink(self.outqueue.put, level)
+        PROGRESS.subscribe(sink, level)
+        try:
+            self.extract(jobs)
+        finally:
+            PROGRESS.unsubscribe(sink)
+            sink.close()
+            self.outqueue.put(sentinel)
+
+    def extract(self, jobs):
         if self.days.get() == '':
             extract_cover_thumbs(
                 self.is_log.get(), self.is_overwrite_pdoc_thumbs.get(),
@@ -63,7 +83,8 @@ class ThreadedTask(threading.Thread):
                 self.is_fix_thumb.get(),
                 self.lubimy_czytac.get(),
                 self.mark_real_pages.get(),
-                self.patch_azw3.get()
+                self.patch_azw3.get(),
+                jobs=jobs
             )
         else:
             extract_cover_thumbs(
@@ -75,20 +96,9 @@ class ThreadedTask(threading.Thread):
                 self.is_fix_thumb.get(),
                 self.lubimy_czytac.get(),
                 self.mark_real_pages.get(),
-                self.patch_azw3.get()
+                self.patch_azw3.get(),
+                jobs=jobs
             )
-        self.outqueue.put(sentinel)
-
-
-class StdoutRedirector(object):
-    """Redirect output."""
-
-    def __init__(self, stext):
-        self.stext = stext
-
-    def write(self, str):
-        self.stext.insert(tk.END, str)
-        self.stext.see(tk.END)
 
 
 class App:
@@ -109,6 +119,8 @@ class App:
         self.kindlepath = tk.StringVar()
         self.status = tk.StringVar()
         self.days = tk.StringVar()
+        self.jobs = tk.StringVar()
+        self.jobs.set('1')
 
         self.frame = tk.Frame(master, borderwidth=5)
         self.frame.pack(side=tk.TOP, anchor=tk.W)
@@ -144,6 +156,23 @@ class App:
         self.days_checkbox.deselect()
         self.days_checkbox.pack(side=tk.TOP, anchor=tk.NW)
 
+        self.frame_jobs = tk.Frame(
+            self.frame2,
+        )
+        self.frame_jobs.pack(side=tk.TOP, anchor=tk.W)
+
+        self.jobs_entry = tk.Entry(
+            self.frame_jobs, width=4,
+            textvariable=self.jobs
+        )
+        self.jobs_entry.pack(side=tk.RIGHT, anchor=tk.NW)
+
+        self.jobs_label = tk.Label(
+            self.frame_jobs,
+            text="Number of books processed in parallel: "
+        )
+        self.jobs_label.pack(side=tk.TOP, anchor=tk.NW)
+
         self.lubimy_czytac_checkbox = tk.Checkbutton(
             self.frame2, text="Download real pages from lubimyczytac.pl? "
                               "(a time-consuming process!)",
@@ -256,7 +285,8 @@ class App:
         self.stext.pack()
         self.stext.insert(tk.END, self.msg1)
 
-        sys.stdout = StdoutRedirector(self.stext)
+        # text printed directly goes to the Message Window with messages
+        sys.stdout = StreamRedirector()
 
     def naccheck(self):
         if self.nac.get() == 0:
@@ -286,17 +316,25 @@ class App:
         self.kindlepath.set(str(a.encode(sys.getfilesystemencoding())))
 
     def update(self, outqueue):
+        chunks = []
+        msg = None
         try:
-            msg = outqueue.get_nowait()
-            if msg is not sentinel:
-                root.after(250, self.update, outqueue)
-            else:
-                # By not calling root.after here, we allow update to
-                # truly end
-                self.status.set(' Process finished...')
-                self.run_button['state'] = tk.NORMAL
+            while msg is not sentinel:
+                msg = outqueue.get_nowait()
+                if msg is not sentinel:
+                    chunks.append(msg)
         except Queue.Empty:
+            pass
+        if chunks:
+            self.stext.insert(tk.END, u''.join(chunks))
+            self.stext.see(tk.END)
+        if msg is not sentinel:
             root.after(250, self.update, outqueue)
+        else:
+            # By not calling root.after here, we allow update to
+            # truly end
+            self.status.set(' Process finished...')
+            self.run_button['state'] = tk.NORMAL
 
     def createBtnCallback(self):
         """Create button event."""
@@ -311,11 +349,15 @@ class App:
                      self.is_azw, self.is_fix_thumb,
                      self.status, self.run_button,
                      self.lubimy_czytac,
-                     self.mark_real_pages, self.patch_azw3).start()
+                     self.mark_real_pages, self.patch_azw3,
+                     self.jobs).start()
         root.after(250, self.update, outqueue)
 
-root = tk.Tk()
-app = App(root)
-root.title('ExtractCoverThumbs ' + __version__)
-root.resizable(width=tk.FALSE, height=tk.TRUE)
-root.mainloop()
+if __name__ == '__main__':
+    # worker processes re-import this module on Windows
+    multiprocessing.freeze_support()
+    root = tk.Tk()
+    app = App(root)
+    root.title('ExtractCoverThumbs ' + __version__)
+    root.resizable(width=tk.FALSE, height=tk.TRUE)
+    root.mainloop()
@@ -8,96 +8,360 @@ __docformat__ = 'restructuredtext en'
 Generates and writes an APNX page mapping file.
 '''
 
+import re
 import struct
+import json
+import uuid
 import os
 import sys
+from array import array
 
-import kindle_unpack
-from lib.header import PdbHeaderReader
+from lib.book_handle import BookHandle
+from lib.metrics import METRICS
+from lib.mobi_text import text_decompressor, iter_text_records
+from lib.progress import PROGRESS
+
+APNX_MAGIC = 65537
+FAST_CHARS_PER_PAGE = 2300
+# page count is stored as unsigned short
+MAX_PAGES = 0xffff
+# array typecode of unsigned 32-bit integer
+PAGE_TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
+WRITE_BUFFER_SIZE = 64 * 1024
+
+# accurate page mapping
+LINE_CHARS = 70
+PAGE_LINES = 32
+MAX_PAGE_LINES = 40
+MAX_TAG_LENGTH = 1024
+PARAGRAPH_RE = re.compile(br'<(?:p|div|h[1-6]|li|blockquote|br)[\s/>]', re.I)
+TAG_RE = re.compile(br'<[^>]*>')
+UTF8_CONTINUATION = bytes(bytearray(range(0x80, 0xc0)))
+
+
+def long_path(path):
+    if sys.platform == 'win32':
+        return '\\\\?\\' + path.replace('/', '\\')
+    return path
+
+
+def read_apnx_header(apnx_path):
+    """
+    Read metadata and page count of an existing APNX file.
+
+    Only the headers and the first three page offsets are read. None is
+    returned if the file cannot be parsed.
+    """
+    try:
+        with open(long_path(apnx_path), 'rb') as apnxf:
+            magic, page_header_offset, content_length = struct.unpack(
+                '>III', apnxf.read(12))
+            if magic != APNX_MAGIC:
+                return None
+            content_header = json.loads(apnxf.read(content_length))
+            apnxf.seek(page_header_offset)
+            _, page_header_length, page_count, _ = struct.unpack(
+                '>HHHH', apnxf.read(8))
+            page_header = json.loads(apnxf.read(page_header_length))
+            first_pages = min(page_count, 3)
+            pages = struct.unpack('>%dI' % first_pages,
+                                  apnxf.read(4 * first_pages))
+    except (IOError, OSError, struct.error, ValueError):
+        return None
+    return {
+        'asin': content_header.get('asin'),
+        'cdetype': content_header.get('cdeType'),
+        'format': content_header.get('format', 'MOBI_7'),
+        'page_map': page_header.get('pageMap'),
+        'page_count': page_count,
+        'first_pages': pages
+    }
+
+
+def page_signature(pages):
+    """Return page count and first page offsets compared by check_apnx."""
+    return len(pages), tuple(pages[:3])
+
+
+class PageMapper(object):
+    """
+    Break pages of text fed record by record on paragraph boundaries.
+
+    Every paragraph starts a new line and a line holds LINE_CHARS
+    characters outside of tags. A page is broken before the first
+    paragraph starting after PAGE_LINES lines, or after MAX_PAGE_LINES
+    lines inside of a long paragraph. Only a tag or a character cut by
+    the end of a record is kept between records.
+    """
+
+    def __init__(self, utf8=False):
+        self.utf8 = utf8
+        self.pages = [0]
+        self.page_lines = 1
+        self.line_chars = 0
+        self.position = 0
+        self.pending = b''
+        # page break at the start of the next text
+        self.break_pending = False
+
+    def feed(self, data):
+        text = self.pending + data
+        start = self.position
+        end = len(text)
+        tag_start = text.rfind(b'<', max(0, end - MAX_TAG_LENGTH))
+        if tag_start != -1 and text.find(b'>', tag_start) == -1:
+            end = tag_start
+        elif self.utf8 and end and ord(text[end - 1]) & 0x80:
+            # keep character which may be cut by the end of the record
+            lead = end - 1
+            while lead > max(0, end - 4) and ord(text[lead]) & 0xc0 == 0x80:
+                lead -= 1
+            end = lead
+        self.pending = text[end:]
+        self.position = start + end
+        pos = 0
+        for paragraph in PARAGRAPH_RE.finditer(text, 0, end):
+            self.add_text(text[pos:paragraph.start()], start + pos)
+            pos = paragraph.start()
+            self.new_paragraph(start + pos)
+        self.add_text(text[pos:end], start + pos)
+
+    def close(self):
+        self.add_text(self.pending, self.position)
+        self.position += len(self.pending)
+        self.pending = b''
+        return self.pages
+
+    def text_length(self, text):
+        if self.utf8:
+            return len(text.translate(None, UTF8_CONTINUATION))
+        return len(text)
+
+    def new_paragraph(self, offset):
+        if self.break_pending:
+            self.pages.append(offset)
+            self.break_pending = False
+        elif self.page_lines >= PAGE_LINES:
+            self.pages.append(offset)
+            self.page_lines = 0
+        self.page_lines += 1
+        self.line_chars = 0
+
+    def add_text(self, piece, offset):
+        if not piece:
+            return
+        text_chars = self.text_length(TAG_RE.sub(b'', piece))
+        if not text_chars:
+            return
+        if self.break_pending:
+            self.pages.append(offset + self.raw_offset(piece, 0))
+            self.break_pending = False
+        chars_before = self.line_chars
+        lines, self.line_chars = divmod(chars_before + text_chars, LINE_CHARS)
+        line = 0
+        while lines - line > MAX_PAGE_LINES - self.page_lines:
+            # break the page at the start of the line over the limit
+            line += MAX_PAGE_LINES - self.page_lines + 1
+            index = line * LINE_CHARS - chars_before
+            if index < text_chars:
+                self.pages.append(offset + self.raw_offset(piece, index))
+            else:
+                self.break_pending = True
+            self.page_lines = 1
+        self.page_lines += lines - line
+
+    def raw_offset(self, piece, index):
+        """Return offset of index-th character outside of tags in piece."""
+        pos = 0
+        for tag in TAG_RE.finditer(piece):
+            chars = self.text_length(piece[pos:tag.start()])
+            if index < chars:
+                break
+            index -= chars
+            pos = tag.end()
+        if not self.utf8:
+            return pos + index
+        for pos in range(pos, len(piece)):
+            if ord(piece[pos]) & 0xc0 != 0x80:
+                if index == 0:
+                    return pos
+                index -= 1
+        return len(piece)
 
 
 class APNXBuilder(object):
     """Create an APNX file using a pseudo page mapping."""
 
-    def write_apnx(self, mobi_file_path, apnx_path, page_count=0):
+    def write_apnx(self, mobi_file_path, apnx_path, page_count=0, book=None,
+                   accurate=False, meta=None):
         """
         Write APNX file.
 
         If you want a fixed number of pages (such as from a custom column) then
         pass in a value to page_count, otherwise a count will be estimated
-        using either the fast or accurate algorithm.
+        using either the fast or accurate algorithm. An already opened
+        BookHandle can be passed in book to avoid opening the file again.
+        Metadata of the book parsed before (asin, doctype, version,
+        text_length and pdb_name) can be passed in meta, then the file is
+        opened only to map its text with the accurate algorithm, unless
+        meta holds pages mapped already as page_map. The file opened here
+        is closed before returning.
         """
-        import uuid
-        apnx_meta = {'guid': str(uuid.uuid4()).replace('-', '')[:8], 'asin':
-                     '', 'cdetype': 'EBOK', 'format': 'MOBI_7', 'acr': ''}
-
+        page_map = None
+        if accurate and not page_count and meta is not None:
+            page_map = meta.get('page_map')
+        text_needed = accurate and not page_count and page_map is None
+        opened = None
+        if book is None and (meta is None or text_needed):
+            try:
+                book = opened = BookHandle(mobi_file_path)
+            except (IOError, OSError):
+                PROGRESS.error('Error! Unable to open file %s', mobi_file_path,
+                               error='IOError')
+                return 1
         try:
-            with open(mobi_file_path, 'rb') as mf:
-                ident = PdbHeaderReader(mf).identity()
-                if ident != 'BOOKMOBI':
-                    # Check that this is really a MOBI file.
-                    print('ERROR! Not a valid MOBI file "%s"'
-                          % os.path.basename(mobi_file_path))
-                    return 1
-                apnx_meta['acr'] = str(PdbHeaderReader(mf).name())
-        except:
-            print('Error! Unable to open file %s' % mobi_file_path)
+            return self.write_book_apnx(mobi_file_path, apnx_path,
+                                        page_count, book, text_needed, meta,
+                                        page_map)
+        finally:
+            if opened is not None:
+                opened.close()
+
+    def write_book_apnx(self, mobi_file_path, apnx_path, page_count, book,
+                        text_needed, meta, page_map=None):
+        """Write APNX file of the book opened or described by meta."""
+        if book is not None and not book.is_mobi:
+            # Check that this is really a MOBI file.
+            PROGRESS.error('ERROR! Not a valid MOBI file "%s"',
+                           os.path.basename(mobi_file_path),
+                           error='invalid MOBI')
             return 1
+        if meta is None:
+            apnx_meta = self.get_apnx_meta(book)
+            apnx_meta['acr'] = str(book.pdb_name)
+            text_length = book.text_length
+        else:
+            apnx_meta = self.make_apnx_meta(meta['asin'], meta['doctype'],
+                                            meta['version'])
+            apnx_meta['acr'] = str(meta['pdb_name'])
+            text_length = meta['text_length']
+        apnx_meta['guid'] = str(uuid.uuid4()).replace('-', '')[:8]
+
+        # Get the pages depending on the chosen parser
+        pages = page_map or []
+        if text_needed:
+            pages = self.get_pages_accurate(book)
+        if not pages:
+            pages = self.get_pages(text_length, page_count)
+        if not pages:
+            PROGRESS.warning('Could not generate page mapping.')
+        if len(pages) > MAX_PAGES:
+            PROGRESS.error('Pages over limit in "%s" file. '
+                           'Unable to write apnx file...', mobi_file_path,
+                           error='too many pages')
+            return 1
+
+        # Write the APNX file from the page mapping.
+        with open(long_path(apnx_path), 'wb',
+                  WRITE_BUFFER_SIZE) as apnxf:
+            apnxf.write(self.generate_apnx_header(len(pages), apnx_meta))
+            self.pack_pages(pages).tofile(apnxf)
+            METRICS.written(apnxf.tell())
+
+    def write_apnx_batch(self, jobs, accurate=False):
+        """
+        Write APNX files of many books.
+
+        jobs are (path, apnx_path, page_count, meta) tuples, where meta is
+        metadata of the book parsed before (see write_apnx) or None. Return
+        the number of written files. Writing of every file is timed as
+        apnx_write stage of its book.
+        """
+        written = 0
+        for path, apnx_path, page_count, meta in jobs:
+            with METRICS.book(path), METRICS.timer('apnx_write'):
+                if self.write_apnx(path, apnx_path, page_count,
+                                   accurate=accurate, meta=meta) is None:
+                    written += 1
+        return written
+
+    def get_apnx_meta(self, book):
+        """Return ASIN, cdetype and format written to APNX of the book."""
         # We'll need the PDB name, the MOBI version, and some metadata to make
         # FW 3.4 happy with KF8 files...
-        with open(mobi_file_path, 'rb') as mf:
-            section = kindle_unpack.Sectionizer(mobi_file_path)
-            mhlst = [kindle_unpack.MobiHeader(section, 0)]
-            mh = mhlst[0]
-            metadata = mh.getmetadata()
-            if mh.version == 8:
-                apnx_meta['format'] = 'MOBI_8'
-            else:
-                apnx_meta['format'] = 'MOBI_7'
-            try:
-                if metadata['Document Type'][0] is None:
-                    apnx_meta['cdetype'] = 'EBOK'
-                else:
-                    apnx_meta['cdetype'] = 'EBOK'
-                    apnx_meta['cdetype'] = metadata['Document Type'][0]
-            except KeyError:
-                apnx_meta['cdetype'] = 'EBOK'
+        metadata = book.metadata
+
+        def first(key):
             try:
-                if metadata['ASIN'][0] is None:
-                    apnx_meta['asin'] = ''
-                else:
-                    apnx_meta['asin'] = metadata['ASIN'][0]
+                return metadata[key][0]
             except KeyError:
-                apnx_meta['asin'] = ''
+                return None
+        return self.make_apnx_meta(first('ASIN'), first('Document Type'),
+                                   book.mh.version)
 
-        # Get the pages depending on the chosen parser
+    def make_apnx_meta(self, asin, doctype, version):
+        return {
+            'asin': asin or '',
+            'cdetype': doctype or 'EBOK',
+            'format': 'MOBI_8' if version == 8 else 'MOBI_7'
+        }
+
+    def get_pages(self, text_length, page_count=0):
+        """
+        Get page offsets.
+
+        Text is split evenly into page_count pages if it is given, otherwise
+        the fast algorithm is used.
+        """
         pages = []
         if page_count:
-            pages = self.get_pages_exact(mobi_file_path, page_count)
-        else:
-            pages = self.get_pages_fast(mobi_file_path)
-
+            pages = self.get_pages_exact(text_length, page_count)
         if not pages:
-            pages = self.get_pages_fast(mobi_file_path)
+            pages = self.get_pages_fast(text_length)
+        return pages
+
+    def get_book_pages(self, book, page_count=0, accurate=False):
+        """Get page offsets of the book with the chosen algorithm."""
+        pages = []
+        if accurate and not page_count:
+            pages = self.get_pages_accurate(book)
         if not pages:
-            print('Could not generate page mapping.')
-        if len(pages) > 65536:
-            print('Pages over limit in "%s" file. '
-                  'Unable to write apnx file...' % mobi_file_path)
-            return
+            pages = self.get_pages(book.text_length, page_count)
+        return pages
 
-        # Generate the APNX file from the page mapping.
-        apnx = self.generate_apnx(pages, apnx_meta)
+    def check_apnx(self, apnx_path, apnx_meta, signature, known=()):
+        """
+        Check existing APNX file against expected metadata and page_signature.
 
-        # Write the APNX.
-        if sys.platform == 'win32':
-            apnx_path = '\\\\?\\' + apnx_path.replace('/', '\\')
-        with open(apnx_path, 'wb') as apnxf:
-            apnxf.write(apnx)
+        Return 'current' if the file matches them and 'stale' if it holds an
+        evenly spaced pseudo page mapping or a mapping with one of known
+        signatures, which does not match. Return None for other files,
+        e.g. real page numbers from Amazon, which must not be overwritten.
+        """
+        header = read_apnx_header(apnx_path)
+        if header is None:
+            return None
+        offsets = header['first_pages']
+        if (header['asin'] == apnx_meta['asin'] and
+                header['cdetype'] == apnx_meta['cdetype'] and
+                header['format'] == apnx_meta['format'] and
+                (header['page_count'], offsets) == signature):
+            return 'current'
+        if header['page_map'] != '(1,a,1)':
+            return None
+        if (header['page_count'], offsets) in known:
+            return 'stale'
+        if offsets[:1] == (0,) and (
+                len(offsets) < 3 or
+                offsets[2] - offsets[1] == offsets[1] - offsets[0]):
+            return 'stale'
+        return None
 
     def generate_apnx(self, pages, apnx_meta):
-        apnx = ''
+        return (self.generate_apnx_header(len(pages), apnx_meta) +
+                self.pack_pages(pages).tostring())
 
+    def generate_apnx_header(self, page_count, apnx_meta):
         # Updated header if we have a KF8 file...
         if apnx_meta['format'] == 'MOBI_8':
             content_header = '{"contentGuid":"%(guid)s","asin":"%(asin)s","cdeType":"%(cdetype)s","format":"%(format)s","fileRevisionId":"1","acr":"%(acr)s"}' % apnx_meta  # noqa
@@ -109,23 +373,22 @@ class APNXBuilder(object):
             content_header = '{"contentGuid":"%(guid)s","asin":"%(asin)s","cdeType":"%(cdetype)s","fileRevisionId":"1"}' % apnx_meta  # noqa
         page_header = '{"asin":"%(asin)s","pageMap":"(1,a,1)"}' % apnx_meta
 
-        apnx += struct.pack('>I', 65537)
-        apnx += struct.pack('>I', 12 + len(content_header))
-        apnx += struct.pack('>I', len(content_header))
-        apnx += content_header
-        apnx += struct.pack('>H', 1)
-        apnx += struct.pack('>H', len(page_header))
-        apnx += struct.pack('>H', len(pages))
-        apnx += struct.pack('>H', 32)
-        apnx += page_header
-
-        # Write page values to APNX.
-        for page in pages:
-            apnx += struct.pack('>I', page)
+        return b''.join((
+            struct.pack('>III', APNX_MAGIC, 12 + len(content_header),
+                        len(content_header)),
+            content_header,
+            struct.pack('>HHHH', 1, len(page_header), page_count, 32),
+            page_header
+        ))
 
-        return apnx
+    def pack_pages(self, pages):
+        """Pack page offsets into big-endian array in one go."""
+        packed = array(PAGE_TYPECODE, pages)
+        if sys.byteorder == 'little':
+            packed.byteswap()
+        return packed
 
-    def get_pages_exact(self, mobi_file_path, page_count):
+    def get_pages_exact(self, text_length, page_count):
         """
         Get pages exact.
 
@@ -133,18 +396,10 @@ class APNXBuilder(object):
         create our array of pages for the apnx file by dividing by
         the content size of the book.
         """
-        pages = []
-        count = 0
-
-        with open(mobi_file_path, 'rb') as mf:
-            phead = PdbHeaderReader(mf)
-            r0 = phead.section_data(0)
-            text_length = struct.unpack('>I', r0[4:8])[0]
-
         chars_per_page = int(text_length / page_count)
-        while count < text_length:
-            pages.append(count)
-            count += chars_per_page
+        if chars_per_page <= 0:
+            return []
+        pages = range(0, text_length, chars_per_page)
 
         if len(pages) > page_count:
             # Rounding created extra page entries
@@ -152,7 +407,33 @@ class APNXBuilder(object):
 
         return pages
 
-    def get_pages_fast(self, mobi_file_path):
+    def get_pages_accurate(self, book):
+        """
+        Break pages on paragraph boundaries of the text.
+
+        Text records are decompressed and mapped one by one, so the whole
+        text is never held in memory. Nothing is returned for encrypted
+        books, unsupported compression and broken text records.
+        """
+        mh = book.mh
+        try:
+            decompress = text_decompressor(mh)
+            if decompress is None:
+                return []
+            mapper = PageMapper(mh.codec == b'utf-8')
+            for data in iter_text_records(book.section, mh, decompress):
+                mapper.feed(data)
+        except (ValueError, struct.error):
+            PROGRESS.error('Error! Unable to decompress text of "%s"',
+                           book.path, error='broken text')
+            return []
+        pages = mapper.close()
+        if mapper.position != book.text_length:
+            # broken or differently compressed text
+            return []
+        return pages
+
+    def get_pages_fast(self, text_length):
         """
         2300 characters of uncompressed text per page.
 
@@ -169,17 +450,4 @@ class APNXBuilder(object):
         It's faster to work off of the length then to
         decompress and parse the actual text.
         """
-        text_length = 0
-        pages = []
-        count = 0
-
-        with open(mobi_file_path, 'rb') as mf:
-            phead = PdbHeaderReader(mf)
-            r0 = phead.section_data(0)
-            text_length = struct.unpack('>I', r0[4:8])[0]
-
-        while count < text_length:
-            pages.append(count)
-            count += 2300
-
-        return pages
+        return range(0, text_length, FAST_CHARS_PER_PAGE)
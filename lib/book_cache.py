@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+from __future__ import print_function
+import os
+import json
+import uuid
+import hashlib
+
+from lib.progress import PROGRESS
+from lib.version import __version__
+
+# bump when cached fields or the way they are parsed change
+CACHE_VERSION = 3
+DEVICE_ID_NAME = 'extract_cover_thumbs.id'
+
+
+def cache_dir():
+    return os.path.join(os.path.expanduser('~'), '.extract_cover_thumbs')
+
+
+def get_device_id(kindlepath):
+    """
+    Return identifier of Kindle device mounted in kindlepath.
+
+    Serial number is not available on mounted Kindle filesystem so random
+    identifier is generated once and stored in Kindle system directory.
+    If it can't be stored there (read-only mount), identifier derived from
+    the mount path is used, so the cache is still found by next runs.
+    """
+    id_path = os.path.join(kindlepath, 'system', DEVICE_ID_NAME)
+    try:
+        with open(id_path) as f:
+            device_id = f.read().strip()
+        if device_id:
+            return device_id
+    except IOError:
+        pass
+    device_id = uuid.uuid4().hex
+    try:
+        with open(id_path, 'w') as f:
+            f.write(device_id)
+    except IOError:
+        device_id = 'path-' + hashlib.sha1(
+            os.path.abspath(kindlepath)).hexdigest()
+        PROGRESS.warning('! Unable to write "%s", books metadata cache is '
+                         'kept for the device path', id_path)
+    return device_id
+
+
+def _to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('UTF-8')
+    if isinstance(value, list):
+        return [_to_str(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in value.items())
+    return value
+
+
+class BookCache(object):
+    """
+    Persistent cache of parsed book metadata keyed by path, size, mtime.
+
+    When disabled entries are kept only in memory for the current run.
+    Cache saved by another version of the tool is dropped.
+    """
+
+    def __init__(self, kindlepath, enabled=True):
+        self.docs = os.path.join(kindlepath, 'documents')
+        self.enabled = enabled
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if not enabled:
+            self.path = None
+            return
+        self.path = os.path.join(cache_dir(), 'books-%s.json' %
+                                 get_device_id(kindlepath))
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        if (data.get('version') == CACHE_VERSION and
+                data.get('tool_version') == __version__):
+            self.entries = _to_str(data.get('entries', {}))
+
+    def _key(self, book):
+        return os.path.relpath(book.path, self.docs)
+
+    def get(self, book):
+        entry = self.entries.get(self._key(book))
+        if (entry is None or entry['size'] != book.stat.st_size or
+                entry['mtime'] != book.stat.st_mtime):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['data']
+
+    def put(self, book, data):
+        self.entries[self._key(book)] = {
+            'size': book.stat.st_size,
+            'mtime': book.stat.st_mtime,
+            'data': data
+        }
+
+    def prune(self, books):
+        """Drop entries of books which are not present anymore."""
+        keys = set(self._key(book) for book in books)
+        for key in list(self.entries):
+            if key not in keys:
+                del self.entries[key]
+
+    def save(self):
+        """Save entries, failure is only reported as a warning."""
+        if not self.enabled:
+            return
+        if not os.path.isdir(cache_dir()):
+            os.makedirs(cache_dir())
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                json.dump({'version': CACHE_VERSION,
+                           'tool_version': __version__,
+                           'entries': self.entries}, f)
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError, ValueError) as e:
+            # UnicodeDecodeError of text which is not UTF-8 is ValueError
+            PROGRESS.warning('! Unable to save books metadata cache: %s',
+                             e)
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+    def purge(self):
+        self.entries = {}
+        if self.path and os.path.isfile(self.path):
+            os.remove(self.path)
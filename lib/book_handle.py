@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import re
+import struct
+
+import kindle_unpack
+from lib.pages import find_exth
+
+
+class BookHandle(object):
+    """
+    MOBI/AZW3 file opened once and shared by all per-book stages.
+
+    The file is memory mapped, PDB records table, record 0 and EXTH
+    metadata are parsed lazily on first use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.section = kindle_unpack.Sectionizer(path)
+        except struct.error:
+            # too short to be a PDB file
+            self.section = None
+        self._record0 = None
+        self._mh = None
+        self._metadata = None
+
+    @property
+    def is_mobi(self):
+        return self.section is not None and self.section.ident == b'BOOKMOBI'
+
+    @property
+    def pdb_name(self):
+        return re.sub('[^-A-Za-z0-9 ]+', '_',
+                      self.section.palmname.replace('\x00', ''))
+
+    @property
+    def record0(self):
+        if self._record0 is None:
+            self._record0 = self.section.load_section(0)
+        return self._record0
+
+    @property
+    def text_length(self):
+        return struct.unpack('>I', self.record0[4:8])[0]
+
+    @property
+    def mh(self):
+        if self._mh is None:
+            self._mh = kindle_unpack.MobiHeader(self.section, 0)
+        return self._mh
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = self.mh.getmetadata()
+        return self._metadata
+
+    def exth(self, search_id):
+        return find_exth(search_id, self.record0)
+
+    def close(self):
+        if self.section is not None:
+            self.section.close()
@@ -13,21 +13,30 @@
 from __future__ import print_function
 import sys
 import os
-import csv
 import shutil
+import time
+import struct
 import tempfile
 
-from imghdr import what
+from array import array
+
 from io import BytesIO
-from datetime import datetime
+from itertools import izip
 
-import kindle_unpack
-from lib.apnx import APNXBuilder
-from lib.pages import find_exth
+from lib.apnx import APNXBuilder, PAGE_TYPECODE, page_signature
 from lib.pages import get_pages
+from lib.pages import PagesDatabase
 from lib.get_real_pages import get_real_pages
 from lib.kfxmeta import get_kindle_kfx_metadata
 from lib.dualmetafix import DualMobiMetaFix
+from lib.book_cache import BookCache, cache_dir
+from lib.http_cache import HttpCache
+from lib.book_handle import BookHandle
+from lib.metrics import METRICS
+from lib.parallel import map_books, pipeline
+from lib.progress import PROGRESS, DEBUG, INFO, printed_progress
+from lib.scanner import MOBI_EXTENSIONS
+from lib.scanner import scan_library
 
 SFENC = sys.getfilesystemencoding()
 try:
@@ -51,109 +60,153 @@ def clean_temp(sourcedir):
                             raise
 
 
-def asin_list_from_csv(mf):
-    if os.path.isfile(mf):
-        with open(mf) as f:
-            csvread = csv.reader(f, delimiter=';', quotechar='"',
-                                 quoting=csv.QUOTE_ALL)
-            asinlist = []
-            filelist = []
-            for row in csvread:
-                try:
-                    if row[0] != '* NONE *':
-                        asinlist.append(row[0])
-                except IndexError:
-                    continue
-                filelist.append(row[6])
-            return asinlist, filelist
+def mobi_cache_entry(handle):
+    mh = handle.mh
+    metadata = handle.metadata
+
+    def first(key):
+        try:
+            return metadata[key][0]
+        except KeyError:
+            return None
+    cover_offset = first('CoverOffset')
+    if cover_offset is not None:
+        cover_record = cover_record_number(mh, cover_offset)
     else:
-        with open(mf, 'wb') as o:
-            csvwrite = csv.writer(o, delimiter=';', quotechar='"',
-                                  quoting=csv.QUOTE_ALL)
-            csvwrite.writerow(
-                ['asin', 'lang', 'author', 'title', 'pages', 'is_real',
-                 'file_path']
-            )
-            return [], []
+        cover_record = None
+    return {
+        'asin': first('ASIN'),
+        'doctype': first('Document Type'),
+        'cover_offset': cover_offset,
+        'cover_record': cover_record,
+        'text_length': struct.unpack('>I', mh.header[4:8])[0],
+        'version': mh.version,
+        'pdb_name': handle.pdb_name
+    }
+
+
+# other KFX metadata is not decoded
+KFX_METADATA_KEYS = ("ASIN", "cde_content_type", "cover_image_data")
+
 
+def kfx_cache_entry(kfx_metadata):
+    return {
+        'asin': kfx_metadata.get("ASIN"),
+        'doctype': kfx_metadata.get("cde_content_type"),
+        'has_cover': "cover_image_data" in kfx_metadata
+    }
 
-def dump_pages(asinlist, filelist, mf, dirpath, fil, is_verbose):
-    row = get_pages(dirpath, fil, is_verbose)
-    if row is None:
-        return
-    if row[0] in asinlist:
-        return
-    if row[6] in filelist:
-        return
-    with open(mf, 'ab') as o:
-        print('* Updating book pages CSV file...')
-        csvwrite = csv.writer(o, delimiter=';', quotechar='"',
-                              quoting=csv.QUOTE_ALL)
-        csvwrite.writerow(row)
 
+NON_IMAGE_RESOURCES = ("FLIS", "FCIS", "FDST", "DATP", "SRCS", "CMET",
+                       "FONT", "RESC")
+EOF_RECORD = chr(0xe9) + chr(0x8e) + "\r\n"
 
-# get_cover_image based on Pawel Jastrzebski <pawelj@vulturis.eu> work:
+
+def classify_resource(data):
+    """Return kind of resource record looking only at its first bytes."""
+    head = data[:8]
+    if head[:4] in NON_IMAGE_RESOURCES:
+        return head[:4]
+    if head == EOF_RECORD:
+        return 'EOF'
+    if head[:2] == b'\xFF\xD8':
+        return 'jpeg'
+    if head == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:2] == b'BM':
+        return 'bmp'
+    return None
+
+
+def cover_record_number(mh, cover_offset):
+    # CoverOffset counts all resource records from the first one, so the
+    # cover record is found directly. Combo KF8 files share resources
+    # between both halves, so record 0 header gives the shortest path.
+    if mh.firstresource == 0xffffffff:
+        return None
+    return mh.firstresource + int(cover_offset)
+
+
+# get_cover_data based on Pawel Jastrzebski <pawelj@vulturis.eu> work:
 # https://github.com/AcidWeb/KindleButler/blob/master/KindleButler/File.py
-def get_cover_image(section, mh, metadata, doctype, file, fide, is_verbose,
-                    fix_thumb):
+def get_cover_data(section, mh, metadata, fide):
+    """
+    Return cover image record of MOBI book or None if there is none.
+
+    IOError is raised if the record is not an image of known format.
+    """
     try:
         cover_offset = metadata['CoverOffset'][0]
     except KeyError:
-        print('ERROR! No cover found in "%s"' % fide)
-        return False
-    beg = mh.firstresource
-    end = section.num_sections
-    imgnames = []
-    for i in range(beg, end):
-        data = section.load_section(i)
-        tmptype = data[0:4]
-        if tmptype in ["FLIS", "FCIS", "FDST", "DATP", "SRCS", "CMET",
-                       "FONT", "RESC"]:
-            imgnames.append(None)
-            continue
-        if data == chr(0xe9) + chr(0x8e) + "\r\n":
-            imgnames.append(None)
-            continue
-        imgtype = what(None, data)
-        if imgtype is None and data[0:2] == b'\xFF\xD8':
-            last = len(data)
-            while data[last - 1:last] == b'\x00':
-                last -= 1
-            if data[last - 2:last] == b'\xFF\xD9':
-                imgtype = "jpeg"
-        if imgtype is None:
-            imgnames.append(None)
-        else:
-            imgnames.append(i)
-        if len(imgnames) - 1 == int(cover_offset):
-            return process_image(data, fix_thumb, doctype, is_verbose)
-    return False
+        PROGRESS.error('ERROR! No cover found in "%s"', fide,
+                       error='no cover')
+        return None
+    cover_record = cover_record_number(mh, cover_offset)
+    if cover_record is None or cover_record >= section.num_sections:
+        PROGRESS.error('ERROR! No cover found in "%s"', fide,
+                       error='no cover')
+        return None
+    # the record is copied out of the file mapping only if it is an image
+    data = section.section_view(cover_record)
+    kind = classify_resource(data)
+    if kind in NON_IMAGE_RESOURCES or kind == 'EOF':
+        PROGRESS.error('ERROR! No cover found in "%s"', fide,
+                       error='no cover')
+        return None
+    if kind is None:
+        # MOBI images are JPEG, PNG, GIF or BMP, don't let PIL guess
+        raise IOError('unrecognized cover image format')
+    return str(data)
 
 
-def process_image(data, fix_thumb, doctype, is_verbose):
-    cover = Image.open(BytesIO(data))
+THUMB_QUALITIES = ('best', 'normal', 'fast')
+APNX_ALGORITHMS = ('fast', 'accurate')
+# books waiting between two stages of the covers pipeline
+PIPELINE_QUEUE_SIZE = 8
+
+
+def process_image(data, fix_thumb, doctype, thumb_quality='normal'):
     if fix_thumb:
-        cover.thumbnail((283, 415), Image.ANTIALIAS)
+        size = (283, 415)
     else:
-        cover.thumbnail((305, 470), Image.ANTIALIAS)
-    cover = cover.convert('L')
-    if doctype == 'PDOC' and fix_thumb:
-        pdoc_cover = Image.new(
-            "L",
-            (cover.size[0], cover.size[1] + 55),
-            "white"
-        )
-        pdoc_cover.paste(cover, (0, 0))
-        if is_verbose:
-            print('DONE!')
-        return pdoc_cover
-    else:
-        if is_verbose:
-            print('DONE!')
-        return cover
+        size = (305, 470)
+    with METRICS.timer('image_decode') as stage:
+        stage['seen'] += 1
+        cover = Image.open(BytesIO(data))
+        # with best quality the image is decoded by thumbnail(), which lets
+        # the decoder scale it down, so decoding is timed as resizing
+        if thumb_quality != 'best':
+            # let JPEG decoder scale down with DCT and decode only
+            # luminance, then resample single channel image to the final
+            # size
+            cover.draft('L', size)
+            cover = cover.convert('L')
+        stage['processed'] += 1
+    with METRICS.timer('image_resize') as stage:
+        stage['seen'] += 1
+        if thumb_quality == 'best':
+            cover.thumbnail(size, Image.ANTIALIAS)
+            cover = cover.convert('L')
+        elif thumb_quality == 'fast':
+            cover.thumbnail(size, Image.BILINEAR)
+        else:
+            cover.thumbnail(size, Image.ANTIALIAS)
+        if doctype == 'PDOC' and fix_thumb:
+            pdoc_cover = Image.new(
+                "L",
+                (cover.size[0], cover.size[1] + 55),
+                "white"
+            )
+            pdoc_cover.paste(cover, (0, 0))
+            cover = pdoc_cover
+        stage['processed'] += 1
+    PROGRESS.debug('DONE!')
+    return cover
 
 
-def fix_generated_thumbs(file, is_verbose, fix_thumb):
+def fix_generated_thumbs(file, fix_thumb):
     try:
         cover = Image.open(file)
     except IOError:
@@ -163,284 +216,626 @@ def fix_generated_thumbs(file, is_verbose, fix_thumb):
     except KeyError:
         dpi = (96, 96)
     if dpi == (96, 96) and fix_thumb:
-        if is_verbose:
-            print('* Fixing generated thumbnail "%s"...' % (file))
+        PROGRESS.debug('* Fixing generated thumbnail "%s"...', file)
         pdoc_cover = Image.new("L", (cover.size[0], cover.size[1] + 45),
                                "white")
         pdoc_cover.paste(cover, (0, 0))
         pdoc_cover.save(file, dpi=[72, 72])
     elif dpi == (72, 72) and not fix_thumb:
-        if is_verbose:
-            print('* Reverse fix for generated thumbnail "%s"...' % (file))
+        PROGRESS.debug('* Reverse fix for generated thumbnail "%s"...', file)
         pdoc_cover = Image.new("L", (cover.size[0], cover.size[1] - 45),
                                "white")
         pdoc_cover.paste(cover, (0, 0))
         pdoc_cover.save(file, dpi=[96, 96])
     else:
-        if is_verbose:
-            print('* Generated thumbnail "%s" is OK. DPI: %s. Skipping...'
-                  % (os.path.basename(file), dpi))
+        PROGRESS.debug('* Generated thumbnail "%s" is OK. DPI: %s. '
+                       'Skipping...', os.path.basename(file), dpi)
     return False
 
 
-def generate_apnx_files(docs, is_verbose, is_overwrite_apnx, days,
-                        tempdir):
+def apnx_jobs(tasks, accurate=False):
+    """
+    Yield APNX builder jobs of (book, apnx_path, pages, entry) tasks.
+
+    Metadata of MOBI books parsed into their cache entries is passed on,
+    so a book is not opened again unless its text is mapped.
+    """
+    for book, apnx_path, pages, entry in tasks:
+        PROGRESS.debug('* Generating APNX file for "%s"', book.fide)
+        if pages is not None:
+            PROGRESS.debug('  * Using %s pages defined in CSV '
+                           'file in Kindle/documents', pages)
+            page_count = int(pages)
+        else:
+            if accurate:
+                PROGRESS.debug('  ! No real pages in '
+                               'extract_cover_thumbs_book_pages2.csv.'
+                               ' Accurate algorithm used...')
+            else:
+                PROGRESS.debug('  ! Book not found in '
+                               'extract_cover_thumbs_book_pages2.csv.'
+                               ' Fast algorithm used...')
+            page_count = 0
+        yield book.path, apnx_path, page_count, entry
+
+
+def generate_apnx_batch(tasks, accurate=False):
+    written = APNXBuilder().write_apnx_batch(
+        apnx_jobs(tasks, accurate), accurate)
+    METRICS.stage('apnx_write')['processed'] += written
+    return written
+
+
+def accurate_pages_signature(book, entry):
+    """
+    Return page_signature of accurate page mapping of the book and the
+    mapped pages if the text was mapped now (None otherwise).
+
+    The signature is kept in the cache entry, so text of the book is mapped
+    again only when the book changes.
+    """
+    pages = None
+    if 'accurate_pages' not in entry:
+        handle = BookHandle(book.path)
+        try:
+            pages = array(PAGE_TYPECODE,
+                          APNXBuilder().get_book_pages(handle, accurate=True))
+        finally:
+            handle.close()
+        entry['accurate_pages'] = page_signature(pages)
+    page_count, first_pages = entry['accurate_pages']
+    return (page_count, tuple(first_pages)), pages
+
+
+def batches(tasks, jobs):
+    """Split tasks into batches, a few per job so workers stay busy."""
+    if jobs <= 1:
+        return [tasks] if tasks else []
+    size = max(1, min(32, -(-len(tasks) // (jobs * 4))))
+    return [tasks[i:i + size] for i in range(0, len(tasks), size)]
+
+
+def generate_apnx_files(books, is_overwrite_apnx, pages_db, book_cache,
+                        jobs=1, algorithm='fast'):
+    """
+    Generate APNX files of MOBI books.
+
+    Existing APNX files are rewritten only if they are stale: their ASIN,
+    cdeType, format or page mapping differ from the ones which would be
+    generated now, e.g. after pages of the book were found.
+    """
+    tasks, created, refreshed, skipped = stale_apnx_tasks(
+        books, is_overwrite_apnx, pages_db, book_cache, algorithm)
+    for _ in map_books(generate_apnx_batch,
+                       [(batch, algorithm == 'accurate')
+                        for batch in batches(tasks, jobs)],
+                       jobs):
+        pass
+    PROGRESS.info('* APNX files: %d created, %d refreshed, %d skipped',
+                  created, refreshed, skipped)
+
+
+def stale_apnx_tasks(books, is_overwrite_apnx, pages_db, book_cache,
+                     algorithm='fast'):
+    """
+    Return tasks of books whose APNX files have to be written.
+
+    Numbers of files to be created, refreshed and skipped are returned too.
+    """
+    accurate = algorithm == 'accurate'
+    tasks = []
+    states = {'created': 0, 'refreshed': 0, 'skipped': 0}
+    for book in books:
+        if book.ext not in MOBI_EXTENSIONS:
+            continue
+        sdr_dir = os.path.join(book.root, book.stem + '.sdr')
+        if not os.path.isdir(sdr_dir):
+            os.makedirs(sdr_dir)
+        apnx_path = os.path.join(sdr_dir, book.stem + '.apnx')
+        if '!DeviceUpgradeLetter!' in book.name:
+            continue
+        with METRICS.book(book.path), METRICS.timer('apnx_write') as stage:
+            stage['seen'] += 1
+            state, pages, entry = apnx_state(book, apnx_path,
+                                             is_overwrite_apnx, pages_db,
+                                             book_cache, accurate)
+        states[state] += 1
+        if state != 'skipped':
+            tasks.append((book, apnx_path, pages, entry))
+    return (tasks, states['created'], states['refreshed'],
+            states['skipped'])
+
+
+def apnx_state(book, apnx_path, is_overwrite_apnx, pages_db, book_cache,
+               accurate=False):
+    """
+    Return state of APNX file of the book, pages found in CSV file and
+    metadata of the book (its cache entry).
+
+    The state is 'created', 'refreshed' or 'skipped'. If the text was
+    mapped with the accurate algorithm to check the file, the metadata is
+    a copy of the entry holding the mapped pages as page_map, so the text
+    is not decompressed again to write the file.
+    """
     apnx_builder = APNXBuilder()
-    if days is not None:
-        dtt = datetime.today()
-        days_int = int(days)
+    entry = book_cache.get(book)
+    if entry is None:
+        handle = BookHandle(book.path)
+        entry = {'is_mobi': handle.is_mobi}
+        if handle.is_mobi:
+            entry.update(mobi_cache_entry(handle))
+        handle.close()
+    asin = (entry['asin'] or '') if entry['is_mobi'] else ''
+    row = pages_db.find(asin, book.name)
+    pages = row[4] if row else None
+    if accurate and row and row[5] != 'True':
+        # estimated pages are replaced with mapping of the text
+        pages = None
+    if not entry['is_mobi']:
+        PROGRESS.debug('* Invalid file format of "%s". Skipping APNX '
+                       'file...', book.fide)
+        return 'skipped', pages, entry
+    if not os.path.isfile(apnx_path):
+        return 'created', pages, entry
+    if is_overwrite_apnx:
+        return 'refreshed', pages, entry
+    apnx_meta = apnx_builder.make_apnx_meta(
+        entry['asin'], entry['doctype'], entry['version'])
+    known = ()
+    page_map = None
+    if accurate or 'accurate_pages' in entry:
+        accurate_signature, page_map = accurate_pages_signature(book, entry)
+        known = (accurate_signature,)
+    if accurate and not pages:
+        signature = known[0]
     else:
-        days_int = 0
-        diff = 0
-    for root, dirs, files in os.walk(docs):
-        for name in files:
-            if 'documents' + os.path.sep + 'dictionaries' in root:
-                if is_verbose:
-                    print('! Excluded dictionary:', name)
-                continue
-            mobi_path = os.path.join(root, name)
-            if "attachables" in mobi_path:
-                continue
-            if days is not None:
+        signature = page_signature(apnx_builder.get_pages(
+            entry['text_length'], int(pages) if pages else 0))
+        page_map = None
+    if apnx_builder.check_apnx(apnx_path, apnx_meta, signature,
+                               known) != 'stale':
+        return 'skipped', pages, entry
+    PROGRESS.debug('* APNX file of "%s" is stale', book.fide)
+    if page_map is not None:
+        return 'refreshed', pages, dict(entry, page_map=page_map)
+    return 'refreshed', pages, entry
+
+
+def thumbnail_path(kindlepath, asin, doctype):
+    return os.path.join(
+        kindlepath, 'system', 'thumbnails',
+        'thumbnail_%s_%s_portrait.jpg' % (asin, doctype)
+    )
+
+
+def needs_thumbnail(thumbpath, doctype, is_overwrite_pdoc_thumbs,
+                    is_overwrite_amzn_thumbs):
+    return (not os.path.isfile(thumbpath) or
+            os.path.getsize(thumbpath) < 1024 or  # "image not availabe" stub
+            (is_overwrite_pdoc_thumbs and doctype == 'PDOC') or
+            (is_overwrite_amzn_thumbs and (
+                doctype == 'EBOK' or doctype == 'EBSP'
+            )))
+
+
+def prefetch_book(book, entry, kindlepath, is_overwrite_pdoc_thumbs,
+                  is_overwrite_amzn_thumbs):
+    """
+    Open MOBI book and page in records its cover is extracted from.
+
+    Return BookHandle of the book or None if it is not going to be read.
+    Only record 0 and the cover record known from the cache entry are
+    paged in, KFX books are read by their parser.
+    """
+    if book.is_kfx or '!DeviceUpgradeLetter!' in book.fide:
+        return None
+    if entry is not None:
+        if not entry['is_mobi'] or entry['asin'] is None:
+            return None
+        thumbpath = thumbnail_path(kindlepath, entry['asin'],
+                                   entry['doctype'])
+        if not needs_thumbnail(thumbpath, entry['doctype'],
+                               is_overwrite_pdoc_thumbs,
+                               is_overwrite_amzn_thumbs):
+            return None
+    with METRICS.timer('prefetch') as stage:
+        stage['seen'] += 1
+        handle = BookHandle(book.path)
+        if handle.is_mobi:
+            section = handle.section
+            section.prefetch_section(0)
+            cover_record = entry and entry.get('cover_record')
+            if (cover_record is not None and
+                    cover_record < section.num_sections):
+                section.prefetch_section(cover_record)
+            stage['processed'] += 1
+    return handle
+
+
+def read_book_cover(book, entry, kindlepath, is_overwrite_pdoc_thumbs,
+                    is_overwrite_amzn_thumbs, patch_azw3, need_pages=True,
+                    handle=None):
+    """
+    Read metadata and cover image of a single book.
+
+    Return cache entry of the book (None if it was skipped) and tuple of
+    thumbnail path, cover image data and document type (None if no
+    thumbnail has to be written). An already opened BookHandle of MOBI
+    book can be passed in handle.
+    """
+    name = book.name
+    is_kfx = book.is_kfx
+    fide = book.fide
+    PROGRESS.debug('* %s:', fide, end=' ')
+    mobi_path = book.path
+    kfx_metadata = None
+    if is_kfx:
+        if '_sample' in fide:
+            PROGRESS.debug('KFX Sample. Skipping...')
+            return entry, None
+        if entry is None:
+            with METRICS.timer('metadata') as stage:
+                stage['seen'] += 1
                 try:
-                    dt = os.path.getctime(mobi_path)
-                except OSError:
-                    continue
-                dt = datetime.fromtimestamp(dt).strftime('%Y-%m-%d')
-                dt = datetime.strptime(dt, '%Y-%m-%d')
-                diff = (dtt - dt).days
-            if name.lower().endswith(('.azw3', '.mobi', '.azw')) and diff <= days_int:
-                sdr_dir = os.path.join(root, os.path.splitext(
-                                       name)[0] + '.sdr')
-                if not os.path.isdir(sdr_dir):
-                    os.makedirs(sdr_dir)
-                apnx_path = os.path.join(sdr_dir, os.path.splitext(
-                                         name)[0] + '.apnx')
-                if not os.path.isfile(apnx_path) or is_overwrite_apnx:
-                    if '!DeviceUpgradeLetter!' in name:
-                        continue
-                    if is_verbose:
-                        print('* Generating APNX file for "%s"'
-                            % name.decode(sys.getfilesystemencoding()))
-                    if os.path.isfile(os.path.join(
-                            tempdir, 'extract_cover_thumbs_book_pages2.csv')):
-                        with open(os.path.join(
-                                tempdir, 'extract_cover_thumbs_book_pages2.csv'
-                        ), 'rb') as f1:
-                            csvread = csv.reader(
-                                f1, delimiter=';', quotechar='"',
-                                quoting=csv.QUOTE_ALL
-                            )
-                            with open(mobi_path, 'rb') as f2:
-                                mobi_content = f2.read()
-                            if mobi_content[60:68] != 'BOOKMOBI':
-                                if is_verbose:
-                                    print('* Invalid file format. Skipping...')
-                                asin = ''
-                            else:
-                                asin = find_exth(113, mobi_content)
-                            found = False
-                            for i in csvread:
-                                try:
-                                    if (
-                                        i[0] == asin and i[0] != '* NONE *'
-                                    ) or (
-                                        i[0] == '* NONE *' and i[6] == name
-                                    ):
-                                        if is_verbose:
-                                            print(
-                                                '  * Using %s pages defined '
-                                                'in CSV '
-                                                'file in Kindle/documents' % (
-                                                    i[4]))
-                                        apnx_builder.write_apnx(
-                                            mobi_path, apnx_path, int(i[4])
-                                        )
-                                        found = True
-                                        continue
-                                except IndexError:
-                                    continue
-                            if not found:
-                                if is_verbose:
-                                    print(
-                                        '  ! Book not found in '
-                                        'extract_cover_thumbs_book_pages2.csv.'
-                                        ' Fast algorithm used...')
-                                apnx_builder.write_apnx(mobi_path, apnx_path)
-                    else:
-                        apnx_builder.write_apnx(mobi_path, apnx_path)
+                    kfx_metadata = get_kindle_kfx_metadata(
+                        mobi_path, KFX_METADATA_KEYS, raw_media=True)
+                except Exception as e:
+                    PROGRESS.error('ERROR! Extracting metadata from %s: %s',
+                                   fide, unicode(e), error=type(e).__name__)
+                    METRICS.book_error(type(e).__name__)
+                    return entry, None
+                entry = kfx_cache_entry(kfx_metadata)
+                stage['processed'] += 1
+        doctype = entry['doctype']
+        if not doctype:
+            PROGRESS.error('ERROR! No document type found in "%s"', fide,
+                           error='no document type')
+            return entry, None
+        asin = entry['asin']
+    else:
+        if '!DeviceUpgradeLetter!' in fide:
+            PROGRESS.debug('Upgrade Letter. Skipping...')
+            return entry, None
+        if entry is None:
+            with METRICS.timer('metadata') as stage:
+                stage['seen'] += 1
+                if handle is None:
+                    handle = BookHandle(mobi_path)
+                entry = {'is_mobi': handle.is_mobi}
+                if need_pages:
+                    entry['pages_row'] = get_pages(handle, name)
+                if entry['is_mobi']:
+                    entry.update(mobi_cache_entry(handle))
+                    stage['processed'] += 1
+        if not entry['is_mobi']:
+            PROGRESS.error('* Not a valid MOBI file "%s".', fide,
+                           error='invalid MOBI')
+            return entry, None
+        asin = entry['asin']
+        doctype = entry['doctype']
+    if (patch_azw3 is True and
+            doctype == 'PDOC' and
+            asin is not None and
+            name.lower().endswith('.azw3')):
+        PROGRESS.info('PATCHING AZW3', end=' ')
+        if handle is not None:
+            handle.close()
+            handle = None
+        dmf = DualMobiMetaFix(mobi_path)
+        open(mobi_path, 'wb').write(dmf.getresult())
+        doctype = 'EBOK'
+    if asin is None:
+        PROGRESS.error('ERROR! No ASIN found in "%s"', fide, error='no ASIN')
+        return entry, None
+    thumbpath = thumbnail_path(kindlepath, asin, doctype)
+    if not needs_thumbnail(thumbpath, doctype, is_overwrite_pdoc_thumbs,
+                           is_overwrite_amzn_thumbs):
+        PROGRESS.debug('skipped (cover present or overwriting not forced).')
+        return entry, None
+    if is_kfx:
+        with METRICS.timer('cover') as stage:
+            stage['seen'] += 1
+            if kfx_metadata is None:
+                try:
+                    kfx_metadata = get_kindle_kfx_metadata(
+                        mobi_path, KFX_METADATA_KEYS, raw_media=True)
+                except Exception as e:
+                    PROGRESS.error(
+                        'ERROR! Extracting metadata from %s: %s', fide,
+                        unicode(e), error=type(e).__name__)
+                    METRICS.book_error(type(e).__name__)
+                    return entry, None
+            image_data = kfx_metadata.get("cover_image_data")
+            if not image_data:
+                PROGRESS.error('ERROR! No cover image found in "%s"',
+                               fide, error='no cover')
+                return entry, None
+            stage['processed'] += 1
+    PROGRESS.debug('PROCESSING COVER:', end=' ')
+    if not is_kfx:
+        with METRICS.timer('cover') as stage:
+            stage['seen'] += 1
+            try:
+                if handle is None:
+                    handle = BookHandle(mobi_path)
+                image_data = get_cover_data(handle.section, handle.mh,
+                                            handle.metadata, fide)
+            except IOError:
+                PROGRESS.error('FAILED! Image format unrecognized...',
+                               error='IOError')
+                METRICS.book_error('IOError')
+                return entry, None
+            if image_data is None:
+                return entry, None
+            stage['processed'] += 1
+    return entry, (thumbpath, image_data, doctype)
+
+
+def encode_cover(cover, fix_thumb, thumb_quality='normal'):
+    """
+    Make thumbnail of cover read by read_book_cover().
+
+    Return tuple of thumbnail path and JPEG data or None if the image
+    can't be decoded.
+    """
+    thumbpath, image_data, doctype = cover
+    try:
+        thumbnail = process_image(image_data, fix_thumb, doctype,
+                                  thumb_quality)
+    except IOError:
+        PROGRESS.error('FAILED! Image format unrecognized...',
+                       error='IOError')
+        METRICS.book_error('IOError')
+        return None
+    with METRICS.timer('image_encode') as stage:
+        stage['seen'] += 1
+        thumb = BytesIO()
+        thumbnail.save(thumb, 'JPEG')
+        stage['processed'] += 1
+    return thumbpath, thumb.getvalue()
+
+
+def extract_book_cover(book, entry, kindlepath, is_overwrite_pdoc_thumbs,
+                       is_overwrite_amzn_thumbs, fix_thumb, patch_azw3,
+                       thumb_quality='normal', need_pages=True):
+    """
+    Extract cover thumbnail of a single book.
+
+    Return cache entry of the book (None if it was skipped) and tuple of
+    thumbnail path and JPEG data (None if no thumbnail has to be written).
+    Nothing is written to system/thumbnails here, so it is safe to run
+    it in worker processes.
+    """
+    entry, cover = read_book_cover(book, entry, kindlepath,
+                                   is_overwrite_pdoc_thumbs,
+                                   is_overwrite_amzn_thumbs, patch_azw3,
+                                   need_pages)
+    if cover is None:
+        return entry, None
+    return entry, encode_cover(cover, fix_thumb, thumb_quality)
+
+
+class CoverJob(object):
+    """Book passed through stages of the covers pipeline."""
+
+    def __init__(self, task):
+        (self.book, self.entry, self.kindlepath,
+         self.is_overwrite_pdoc_thumbs, self.is_overwrite_amzn_thumbs,
+         self.fix_thumb, self.patch_azw3, self.thumb_quality,
+         self.need_pages) = task
+        self.handle = self.cover = self.thumb = None
+        self.events = []
+        self.start = None
+
+
+def book_stage(func):
+    """Wrap func(job) to collect progress events and trace of the book."""
+    def stage(job):
+        with PROGRESS.collecting(job.events, job.book.path), \
+                METRICS.book(job.book.path):
+            func(job)
+        return job
+    return stage
+
+
+def prefetch_stage(job):
+    job.start = time.time()
+    PROGRESS.book_started(job.book.path)
+    job.handle = prefetch_book(job.book, job.entry, job.kindlepath,
+                               job.is_overwrite_pdoc_thumbs,
+                               job.is_overwrite_amzn_thumbs)
+
+
+def read_stage(job):
+    try:
+        job.entry, job.cover = read_book_cover(
+            job.book, job.entry, job.kindlepath,
+            job.is_overwrite_pdoc_thumbs, job.is_overwrite_amzn_thumbs,
+            job.patch_azw3, job.need_pages, job.handle)
+    finally:
+        if job.handle is not None:
+            job.handle.close()
+            job.handle = None
+
+
+def encode_stage(job):
+    if job.cover is not None:
+        job.thumb = encode_cover(job.cover, job.fix_thumb, job.thumb_quality)
+        job.cover = None
+
+
+def covers_pipeline(tasks, size=PIPELINE_QUEUE_SIZE):
+    """
+    Yield results of extract_book_cover() for tasks in order.
+
+    Books are prefetched, their metadata and covers read and thumbnails
+    encoded by stages running in separate threads, so reading of next
+    books overlaps with image work on the current one. At most size books
+    wait between stages. Progress events of every book are emitted in
+    order, when its result is yielded.
+    """
+    for job in pipeline((CoverJob(task) for task in tasks),
+                        [book_stage(prefetch_stage), book_stage(read_stage),
+                         book_stage(encode_stage)], size):
+        error = None
+        for event in job.events:
+            PROGRESS.emit(event)
+            if event.kind == 'error':
+                error = event.error
+        yield job.entry, job.thumb
+        # after the result was written
+        PROGRESS.book_finished(job.book.path, time.time() - job.start,
+                               error)
+
+
+def traced_book_cover(book, *args):
+    """
+    Call extract_book_cover() adding its time to trace of the book.
+
+    Book started and finished progress events are emitted around it.
+    """
+    with PROGRESS.processing(book.path), METRICS.book(book.path):
+        return extract_book_cover(book, *args)
 
 
 def extract_cover_thumbs(is_silent, is_overwrite_pdoc_thumbs,
                          is_overwrite_amzn_thumbs, is_overwrite_apnx,
                          skip_apnx, kindlepath, is_azw, days, fix_thumb,
-                         lubimy_czytac, mark_real_pages, patch_azw3):
-    docs = os.path.join(kindlepath, 'documents')
-    is_verbose = not is_silent
-    if days is not None:
-        dtt = datetime.today()
-        days_int = int(days)
-        print('Notice! Processing files not older than ' + days + ' days.')
-    else:
-        days_int = 0
-        diff = 0
-
-    # move CSV file to computer temp dir to speed up updating process
-    tempdir = tempfile.mkdtemp(suffix='', prefix='extract_cover_thumbs-tmp-')
-    csv_pages_name = 'extract_cover_thumbs_book_pages2.csv'
-    csv_pages = os.path.join(tempdir, csv_pages_name)
-    if os.path.isfile(os.path.join(docs, csv_pages_name)):
-        shutil.copy2(os.path.join(docs, csv_pages_name),
-                     os.path.join(tempdir, csv_pages_name))
-
-    # load ASIN list from CSV
-    asinlist, filelist = asin_list_from_csv(csv_pages)
-
-    if not os.path.isdir(os.path.join(kindlepath, 'system', 'thumbnails')):
-        print('* ERROR! No Kindle device found in the specified path: "' +
-              os.path.join(kindlepath) + '"')
-        return 1
-    print("START of extracting cover thumbnails...")
-    if is_azw:
-        extensions = ('.azw', '.azw3', '.mobi', '.kfx', '.azw8')
-    else:
-        extensions = ('.azw3', '.mobi', '.kfx', '.azw8')
-    for root, dirs, files in os.walk(docs):
-        for name in files:
-            if 'documents' + os.path.sep + 'dictionaries' in root:
-                if is_verbose:
-                    print('! Excluded dictionary:', name)
+                         lubimy_czytac, mark_real_pages, patch_azw3,
+                         use_cache=True, purge_cache=False, jobs=1,
+                         thumb_quality='normal', lubimy_czytac_rate=1.0,
+                         apnx_algorithm='fast', stats_path=None,
+                         prometheus_path=None, trace=None,
+                         lubimy_czytac_workers=4):
+    """
+    Extract cover thumbnails, pages and APNX files of books on Kindle.
+
+    Progress is reported through PROGRESS; if nobody listens to it, it is
+    printed to stdout, with details unless is_silent. Books metadata cached
+    by another version of the tool is not used.
+    """
+    with printed_progress(INFO if is_silent else DEBUG):
+        start = time.time()
+        METRICS.reset(trace is not None)
+        docs = os.path.join(kindlepath, 'documents')
+        if days is not None:
+            PROGRESS.info('Notice! Processing files not older than %s days.',
+                          days)
+
+        # move CSV file to computer temp dir to speed up updating process
+        tempdir = tempfile.mkdtemp(suffix='',
+                                   prefix='extract_cover_thumbs-tmp-')
+        csv_pages_name = 'extract_cover_thumbs_book_pages2.csv'
+        csv_pages = os.path.join(tempdir, csv_pages_name)
+        if os.path.isfile(os.path.join(docs, csv_pages_name)):
+            shutil.copy2(os.path.join(docs, csv_pages_name),
+                         os.path.join(tempdir, csv_pages_name))
+
+        # load book pages database from CSV
+        with METRICS.timer('pages_csv'):
+            pages_db = PagesDatabase(csv_pages)
+
+        if not os.path.isdir(os.path.join(kindlepath, 'system', 'thumbnails')):
+            PROGRESS.error('* ERROR! No Kindle device found in the specified '
+                           'path: "%s"', kindlepath)
+            return 1
+        PROGRESS.info('START of extracting cover thumbnails...')
+        if is_azw:
+            extensions = ('.azw', '.azw3', '.mobi', '.kfx', '.azw8')
+        else:
+            extensions = ('.azw3', '.mobi', '.kfx', '.azw8')
+        book_cache = BookCache(kindlepath, use_cache)
+        if purge_cache:
+            book_cache.purge()
+        with METRICS.timer('scan') as stage:
+            books = scan_library(docs, days)
+            stage['seen'] += len(books)
+        tasks = []
+        for book in books:
+            if book.ext not in extensions:
                 continue
-            if days is not None:
-                try:
-                    dt = os.path.getctime(os.path.join(root, name))
-                except OSError:
-                    continue
-                dt = datetime.fromtimestamp(dt).strftime('%Y-%m-%d')
-                dt = datetime.strptime(dt, '%Y-%m-%d')
-                diff = (dtt - dt).days
-            if name.lower().endswith(extensions) and diff <= days_int:
-                if name.lower().endswith('.kfx') or name.lower().endswith('.azw8'):
-                    is_kfx = True
-                else:
-                    is_kfx = False
-                fide = name.decode(sys.getfilesystemencoding())
-                if is_verbose:
-                    try:
-                        print('* %s:' % fide, end=' ')
-                    except:
-                        print('* %r:' % fide, end=' ')
-                mobi_path = os.path.join(root, name)
-                if "attachables" in mobi_path:
-                    continue
-                if is_kfx:
-                    if '_sample' in fide:
-                        if is_verbose:
-                            print('KFX Sample. Skipping...')
-                        continue
-                    try:
-                        kfx_metadata = get_kindle_kfx_metadata(mobi_path)
-                    except Exception as e:
-                        print('ERROR! Extracting metadata from %s: %s' % (
-                            fide, unicode(e)
-                        ))
-                        continue
-                    doctype = kfx_metadata.get("cde_content_type")
-                    if not doctype:
-                        print('ERROR! No document type found in "%s"' % fide)
-                        continue
-                    asin = kfx_metadata.get("ASIN")
-                else:
-                    if '!DeviceUpgradeLetter!' in fide:
-                        if is_verbose:
-                            print('Upgrade Letter. Skipping...')
-                        continue
-                    dump_pages(asinlist, filelist, csv_pages, root, name, is_verbose)
-                    with open(mobi_path, 'rb') as mf:
-                        mobi_content = mf.read()
-                        if mobi_content[60:68] != 'BOOKMOBI':
-                            print('* Not a valid MOBI file "%s".'
-                                  % fide)
-                            continue
-                    section = kindle_unpack.Sectionizer(mobi_path)
-                    mhlst = [kindle_unpack.MobiHeader(section, 0)]
-                    mh = mhlst[0]
-                    metadata = mh.getmetadata()
-                    try:
-                        asin = metadata['ASIN'][0]
-                    except KeyError:
-                        asin = None
-                    try:
-                        doctype = metadata['Document Type'][0]
-                    except KeyError:
-                        doctype = None
-                if (patch_azw3 is True and
-                        doctype == 'PDOC' and
-                        asin is not None and
-                        name.lower().endswith('.azw3')):
-                    print("PATCHING AZW3", end=' ')
-                    dmf = DualMobiMetaFix(mobi_path)
-                    open(mobi_path, 'wb').write(dmf.getresult())
-                    doctype = 'EBOK'
-                if asin is None:
-                    print('ERROR! No ASIN found in "%s"' % fide)
-                    continue
-                thumbpath = os.path.join(
-                    kindlepath, 'system', 'thumbnails',
-                    'thumbnail_%s_%s_portrait.jpg' % (asin, doctype)
-                )
-                if (not os.path.isfile(thumbpath) or
-                        (os.path.isfile(thumbpath) and os.path.getsize(thumbpath) < 1024) or  # "image not availabe" stub
-                        (is_overwrite_pdoc_thumbs and doctype == 'PDOC') or
-                        (is_overwrite_amzn_thumbs and (
-                            doctype == 'EBOK' or doctype == 'EBSP'
-                        ))):
-                    if is_kfx:
-                        image_data = kfx_metadata.get("cover_image_data")
-                        if not image_data:
-                            print('ERROR! No cover image found in "%s"' % fide)
-                            continue
-                    if is_verbose:
-                        print('PROCESSING COVER:', end=' ')
-                    try:
-                        if is_kfx:
-                            cover = process_image(image_data.decode('base64'),
-                                                  fix_thumb, doctype,
-                                                  is_verbose)
-                        else:
-                            cover = get_cover_image(section, mh, metadata,
-                                                    doctype, name,
-                                                    fide, is_verbose, fix_thumb)
-                    except IOError:
-                        print('FAILED! Image format unrecognized...')
-                        continue
-                    if not cover:
+            # books already present in pages CSV are not parsed for pages again
+            need_pages = not book.is_kfx and not pages_db.has_file(book.name)
+            entry = book_cache.get(book)
+            if entry is not None and need_pages and 'pages_row' not in entry:
+                entry = None
+            tasks.append((book, entry, kindlepath, is_overwrite_pdoc_thumbs,
+                          is_overwrite_amzn_thumbs, fix_thumb, patch_azw3,
+                          thumb_quality, need_pages))
+        METRICS.stage('scan')['processed'] += len(tasks)
+        if jobs > 1:
+            results = map_books(traced_book_cover, tasks, jobs)
+        else:
+            results = covers_pipeline(tasks)
+        for task, (entry, thumb) in izip(tasks, results):
+            book = task[0]
+            if entry is None:
+                continue
+            book_cache.put(book, entry)
+            with METRICS.book(book.path):
+                if 'pages_row' in entry:
+                    with METRICS.timer('pages_csv') as stage:
+                        stage['seen'] += 1
+                        if pages_db.add(entry['pages_row']):
+                            stage['processed'] += 1
+                if thumb is not None:
+                    thumbpath, data = thumb
+                    with METRICS.timer('thumbnail_write') as stage:
+                        stage['seen'] += 1
+                        with open(thumbpath, 'wb') as f:
+                            f.write(data)
+                        METRICS.written(len(data))
+                        stage['processed'] += 1
+        if lubimy_czytac and days:
+            PROGRESS.info('START of downloading real book page numbers...')
+            http_cache = None
+            if use_cache:
+                http_cache = HttpCache(os.path.join(cache_dir(), 'http'))
+                if purge_cache:
+                    http_cache.purge()
+            with METRICS.timer('real_pages'):
+                get_real_pages(os.path.join(
+                    tempdir, 'extract_cover_thumbs_book_pages2.csv'),
+                    mark_real_pages, workers=lubimy_czytac_workers,
+                    rate=lubimy_czytac_rate, cache=http_cache)
+            if http_cache is not None:
+                PROGRESS.debug('* Downloaded pages cache: %d hits, %d misses',
+                               http_cache.hits, http_cache.misses)
+            with METRICS.timer('pages_csv'):
+                pages_db = PagesDatabase(csv_pages)
+            PROGRESS.info('FINISH of downloading real book page numbers...')
+        if not skip_apnx:
+            PROGRESS.info('START of generating book page numbers '
+                          '(APNX files)...')
+            generate_apnx_files(books, is_overwrite_apnx, pages_db, book_cache,
+                                jobs, apnx_algorithm)
+            PROGRESS.info('FINISH of generating book page numbers '
+                          '(APNX files)...')
+
+        if is_overwrite_pdoc_thumbs:
+            thumb_dir = os.path.join(kindlepath, 'system', 'thumbnails')
+            thumb_list = os.listdir(thumb_dir)
+            for c in thumb_list:
+                if c.startswith('thumbnail') and c.endswith('.jpg'):
+                    if c.endswith('portrait.jpg'):
                         continue
-                    cover.save(thumbpath)
-                elif is_verbose:
-                    print('skipped (cover present or overwriting not forced).')
-    if lubimy_czytac and days:
-        print("START of downloading real book page numbers...")
-        get_real_pages(os.path.join(
-            tempdir, 'extract_cover_thumbs_book_pages2.csv'), mark_real_pages)
-        print("FINISH of downloading real book page numbers...")
-    if not skip_apnx:
-        print("START of generating book page numbers (APNX files)...")
-        generate_apnx_files(docs, is_verbose, is_overwrite_apnx,
-                            days, tempdir)
-        print("FINISH of generating book page numbers (APNX files)...")
-
-    if is_overwrite_pdoc_thumbs:
-        thumb_dir = os.path.join(kindlepath, 'system', 'thumbnails')
-        thumb_list = os.listdir(thumb_dir)
-        for c in thumb_list:
-            if c.startswith('thumbnail') and c.endswith('.jpg'):
-                if c.endswith('portrait.jpg'):
-                    continue
-                fix_generated_thumbs(os.path.join(thumb_dir, c),
-                                     is_verbose, fix_thumb)
-    print("FINISH of extracting cover thumbnails...")
-    shutil.copy2(os.path.join(tempdir, csv_pages_name),
-                 os.path.join(docs, csv_pages_name))
-    clean_temp(tempdir)
-    return 0
+                    fix_generated_thumbs(os.path.join(thumb_dir, c), fix_thumb)
+        PROGRESS.info('FINISH of extracting cover thumbnails...')
+        with METRICS.timer('pages_csv'):
+            shutil.copy2(os.path.join(tempdir, csv_pages_name),
+                         os.path.join(docs, csv_pages_name))
+            METRICS.written(os.path.getsize(os.path.join(docs,
+                                                         csv_pages_name)))
+        clean_temp(tempdir)
+        if days is None:
+            book_cache.prune(books)
+        book_cache.save()
+        if trace is not None:
+            for line in METRICS.trace_lines(trace):
+                PROGRESS.info(line)
+        if stats_path:
+            METRICS.write_json(stats_path, time.time() - start, jobs, trace)
+            PROGRESS.info('* Statistics saved to "%s"', stats_path)
+        if prometheus_path:
+            METRICS.write_prometheus(prometheus_path, time.time() - start)
+        return 0
@@ -10,48 +10,137 @@
 # to your Kindle Paperwhite.
 #
 from __future__ import print_function
+import os
+import csv
+import sys
+import time
+import socket
+import httplib
+import urllib
+import urllib2
+import urlparse
+import threading
+import unicodedata
 
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 
-def get_real_pages(csvfile, mark_real_pages):
+from lib.metrics import METRICS
+from lib.progress import PROGRESS
 
-    import os
-    import csv
-    import urllib
-    import urllib2
-    import unicodedata
-    import sys
+SFENC = sys.getfilesystemencoding()
+try:
+    from lxml.etree import LxmlError
+    from lxml.html import fromstring
+except ImportError as e:
+    fromstring = None
+    LxmlError = ValueError
+    lxml_error = str(e).decode(SFENC)
+
+LUBIMYCZYTAC_URL = 'http://lubimyczytac.pl'
+SEARCH_RESULTS = '*//div[contains(@class,"book-data")]'
+BOOK_PAGES = ('//div[@class="profil-desc-inline"]'
+              '//dt[contains(text(),"liczba stron")]'
+              '/following-sibling::dd/text()')
+# failed requests, they are retried
+HTTP_ERRORS = (urllib2.URLError, socket.error, httplib.HTTPException)
+
+
+class RateLimiter(object):
+    """Allow at most rate requests per second to every host."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlparse.urlparse(url).netloc
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot.get(host, 0))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def strip_accents(text):
+    return ''.join(c for c in unicodedata.normalize(
+        'NFKD', text
+    ) if unicodedata.category(c) != 'Mn')
+
+
+def fetch_page(url, limiter, retries=3, backoff=1.0):
+    for attempt in range(retries + 1):
+        limiter.wait(url)
+        try:
+            req = urllib2.Request(url)
+            body = urllib2.urlopen(req, timeout=30).read()
+            METRICS.read(len(body))
+            return body
+        except urllib2.HTTPError as e:
+            if e.code < 500 or attempt == retries:
+                raise
+        except HTTP_ERRORS:
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
 
-    SFENC = sys.getfilesystemencoding()
-    try:
-        from lxml.html import fromstring
-    except ImportError as e:
-        sys.exit('CRITICAL! ' + str(e).decode(SFENC))
 
-    def strip_accents(text):
-        return ''.join(c for c in unicodedata.normalize(
-            'NFKD', text
-        ) if unicodedata.category(c) != 'Mn')
+def get_html_page(url, limiter, retries=3, backoff=1.0):
+    return fromstring(fetch_page(url, limiter, retries, backoff))
 
-    def get_html_page(url):
-        req = urllib2.Request(url)
-        return fromstring(urllib2.urlopen(req).read())
 
-    def search_book(category):
-        url = 'http://lubimyczytac.pl/szukaj/ksiazki'
+def no_search_results(tree):
+    return not tree.xpath(SEARCH_RESULTS)
+
+
+def no_book_pages(tree):
+    return not tree.xpath(BOOK_PAGES)
+
+
+class BookLookup(object):
+    """Find real number of pages of a book on lubimyczytac.pl."""
+
+    def __init__(self, limiter, base_url=LUBIMYCZYTAC_URL, retries=3,
+                 backoff=1.0, cache=None):
+        self.limiter = limiter
+        self.base_url = base_url
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+
+    def get_html_page(self, url, is_negative=None):
+        """
+        Return parsed page, from cache if possible.
+
+        Downloaded pages for which is_negative(tree) is true are cached as
+        negative entries, which expire sooner.
+        """
+        if self.cache is not None:
+            body = self.cache.get(url)
+            if body is not None:
+                return fromstring(body)
+        body = fetch_page(url, self.limiter, self.retries, self.backoff)
+        tree = fromstring(body)
+        if self.cache is not None:
+            self.cache.put(url, body, bool(is_negative and is_negative(tree)))
+        return tree
+
+    def search_book(self, category):
+        url = self.base_url + '/szukaj/ksiazki'
         data = urllib.urlencode({
             'phrase': category,
             'main_search': '1',
         })
         url = url + '?' + data
-        return get_html_page(url)
-
-    def get_pages_book_type(url):
-        tree = get_html_page(url)
-        pages = tree.xpath(
-            '//div[@class="profil-desc-inline"]'
-            '//dt[contains(text(),"liczba stron")]'
-            '/following-sibling::dd/text()'
-        )
+        return self.get_html_page(url, no_search_results)
+
+    def get_pages_book_type(self, url):
+        tree = self.get_html_page(url, no_book_pages)
+        pages = tree.xpath(BOOK_PAGES)
         book_types = tree.xpath('//div[contains(@class, "cover-book-type")]')
         if book_types:
             book_type = book_types[0].text
@@ -62,18 +151,18 @@ def get_real_pages(csvfile, mark_real_pages):
         else:
             return None, book_type
 
-    def get_search_results(tree, author, title):
+    def get_search_results(self, tree, author, title, log):
         title = title.decode('UTF-8').lower().encode('UTF-8')
         author = author.decode('UTF-8').lower().encode('UTF-8')
-        results = tree.xpath('*//div[contains(@class,"book-data")]')
+        results = tree.xpath(SEARCH_RESULTS)
         if len(results) == 1:
             book_url = results[0].xpath(
                 './div[contains(@class,"book-general-data")]'
                 '/a[@class="bookTitle"]/@href'
             )[0]
-            return book_url
+            return urlparse.urljoin(self.base_url, book_url)
         elif len(results) == 0:
-            print('  No results...')
+            log.append('  No results...')
         else:
             for result in results:
                 try:
@@ -92,10 +181,10 @@ def get_real_pages(csvfile, mark_real_pages):
                     author_f = author_f + ', ' + a
                 author_f = author_f.lstrip(', ')
                 author = author.replace('; ', ', ').replace(' i ', ', ')
-                book_url = result.xpath(
+                book_url = urlparse.urljoin(self.base_url, result.xpath(
                     './div[contains(@class,"book-general-data")]'
                     '/a[@class="bookTitle"]/@href'
-                )[0]
+                )[0])
                 if len(title) > len(title_f):
                     sub_title = len(title_f)
                 else:
@@ -114,62 +203,122 @@ def get_real_pages(csvfile, mark_real_pages):
                         set(a_s))).strip().replace(',', '')
                     if author == author_f:
                         return book_url
-                        break
                     elif a_s == a_fs:
                         return book_url
-                        break
                     elif a_srt == a_fsrt:
                         return book_url
-                        break
-            print('  No matches in results...')
-
-    if os.path.isfile(os.path.join(csvfile)):
-        with open(os.path.join(csvfile), 'rb') as f:
-            csvread = csv.reader(
-                f, delimiter=';', quotechar='"',
-                quoting=csv.QUOTE_ALL
-            )
-            dumped_list = list(csvread)
-            for row in dumped_list:
-                try:
-                    if row[0] == 'asin' or row[5] == 'True' or not(
-                        row[1].lower() == 'pl' or row[1].lower() == 'pl-pl'
-                    ):
-                        continue
-                    print('* Searching for: ' + row[2].decode(
-                          'UTF-8') + ' - ' + row[3].decode('UTF-8'))
-                except IndexError:
-                    continue
-                try:
-                    root = search_book(row[3])
-                    if len(root.xpath(
-                        '*//div[contains(@class,"book-data")]'
-                    )) == 0:
-                        root = search_book(row[3].split('.')[0])
-                    book_url = get_search_results(root, row[2], row[3])
-                except urllib2.HTTPError:
-                    print('  ! HTTP error. Unable to find the book details...')
-                    book_url = None
-                if book_url:
-                    pages, book_type = get_pages_book_type(book_url)
-                    if pages is not None:
-                        row[4] = pages
-                        row[5] = True
-                        print('  Book pages:', pages)
-                    elif book_type == 'E-book':
-                        print('  ! E-book format only! '
-                              'Using computed pages as real pages...')
-                        row[5] = True
-                    else:
-                        print('  ! There are no page number set '
-                              'on the site: ' + book_url)
-                elif mark_real_pages:
-                    print('  ! Marking computed pages as real pages...')
-                    row[5] = True
-
-                with open(os.path.join(csvfile), 'wb') as f:
-                    csvwrite = csv.writer(
-                        f, delimiter=';', quotechar='"',
-                        quoting=csv.QUOTE_ALL
-                    )
-                    csvwrite.writerows(dumped_list)
+            log.append('  No matches in results...')
+
+    def lookup(self, row, mark_real_pages):
+        """
+        Look up single CSV row.
+
+        Return updated pages and is_real values (None if the row has to
+        stay unchanged) together with log messages of the lookup.
+        """
+        log = ['* Searching for: ' + row[2].decode(
+               'UTF-8') + ' - ' + row[3].decode('UTF-8')]
+        pages = is_real = None
+        try:
+            root = self.search_book(row[3])
+            if no_search_results(root):
+                root = self.search_book(row[3].split('.')[0])
+            book_url = self.get_search_results(root, row[2], row[3], log)
+        except HTTP_ERRORS:
+            log.append('  ! HTTP error. Unable to find the book details...')
+            book_url = None
+        except LxmlError:
+            log.append('  ! Parse error. Unable to find the book details...')
+            book_url = None
+        if book_url:
+            try:
+                book_pages, book_type = self.get_pages_book_type(book_url)
+            except HTTP_ERRORS:
+                log.append('  ! HTTP error. Unable to get the book '
+                           'details: ' + book_url)
+                return pages, is_real, log
+            except LxmlError:
+                log.append('  ! Parse error. Unable to get the book '
+                           'details: ' + book_url)
+                return pages, is_real, log
+            if book_pages is not None:
+                pages = book_pages
+                is_real = True
+                log.append('  Book pages: ' + book_pages)
+            elif book_type == 'E-book':
+                log.append('  ! E-book format only! '
+                           'Using computed pages as real pages...')
+                is_real = True
+            else:
+                log.append('  ! There are no page number set '
+                           'on the site: ' + book_url)
+        elif mark_real_pages:
+            log.append('  ! Marking computed pages as real pages...')
+            is_real = True
+        return pages, is_real, log
+
+
+def is_lookup_row(row):
+    try:
+        return not (row[0] == 'asin' or row[5] == 'True' or not(
+            row[1].lower() == 'pl' or row[1].lower() == 'pl-pl'
+        ))
+    except IndexError:
+        return False
+
+
+def write_rows(csvfile, rows):
+    with open(csvfile, 'wb') as f:
+        csvwrite = csv.writer(
+            f, delimiter=';', quotechar='"',
+            quoting=csv.QUOTE_ALL
+        )
+        csvwrite.writerows(rows)
+        METRICS.written(f.tell())
+
+
+def get_real_pages(csvfile, mark_real_pages, workers=4, rate=1.0,
+                   retries=3, base_url=LUBIMYCZYTAC_URL, cache=None):
+    """
+    Download real page numbers of Polish books listed in CSV file.
+
+    Books are looked up by a pool of workers, requests to every host are
+    limited to rate per second and failed requests are retried with
+    exponential backoff. Downloaded pages are stored in optional HttpCache.
+    Results are merged back in CSV order.
+    """
+    if fromstring is None:
+        sys.exit('CRITICAL! ' + lxml_error)
+
+    if not os.path.isfile(csvfile):
+        return
+    with open(csvfile, 'rb') as f:
+        csvread = csv.reader(
+            f, delimiter=';', quotechar='"',
+            quoting=csv.QUOTE_ALL
+        )
+        dumped_list = list(csvread)
+    rows = [row for row in dumped_list if is_lookup_row(row)]
+    if not rows:
+        return
+    METRICS.add('seen', len(rows))
+    lookup = BookLookup(RateLimiter(rate), base_url, retries, cache=cache)
+    running = METRICS.running
+    # bytes downloaded by workers are counted in the stage running here
+    pool = ThreadPool(max(1, min(workers, len(rows))), METRICS.count_in,
+                      (running[-1] if running else None,))
+    try:
+        results = pool.imap(lambda row: lookup.lookup(row, mark_real_pages),
+                            rows)
+        for row, (pages, is_real, log) in izip(rows, results):
+            for line in log:
+                PROGRESS.info(line)
+            if pages is not None:
+                row[4] = pages
+                METRICS.add('processed', 1)
+            if is_real is not None:
+                row[5] = is_real
+            write_rows(csvfile, dumped_list)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import os
+import time
+import hashlib
+import threading
+
+DAY = 24 * 60 * 60
+
+
+class HttpCache(object):
+    """
+    On-disk cache of downloaded pages keyed by URL.
+
+    Pages expire after ttl seconds. Negative entries (e.g. searches without
+    results) expire sooner, after negative_ttl seconds, so books added to
+    the site later are found. When the cache grows over max_size bytes the
+    oldest entries are evicted.
+    """
+
+    def __init__(self, path, ttl=30 * DAY, negative_ttl=7 * DAY,
+                 max_size=50 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.size = sum(os.path.getsize(os.path.join(path, f))
+                        for f in os.listdir(path))
+
+    def _file(self, url, negative):
+        return os.path.join(self.path, hashlib.sha1(url).hexdigest() +
+                            ('.neg' if negative else '.html'))
+
+    def get(self, url):
+        now = time.time()
+        for negative, ttl in ((False, self.ttl), (True, self.negative_ttl)):
+            fpath = self._file(url, negative)
+            try:
+                if now - os.path.getmtime(fpath) > ttl:
+                    continue
+                with open(fpath, 'rb') as f:
+                    body = f.read()
+            except (IOError, OSError):
+                continue
+            with self.lock:
+                self.hits += 1
+            return body
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, url, body, negative=False):
+        with self.lock:
+            self._remove(self._file(url, not negative))
+            fpath = self._file(url, negative)
+            self._remove(fpath)
+            # readers do not take the lock, never expose half written file
+            with open(fpath + '.tmp', 'wb') as f:
+                f.write(body)
+            os.rename(fpath + '.tmp', fpath)
+            self.size += len(body)
+            if self.size > self.max_size:
+                self.evict()
+
+    def _remove(self, fpath):
+        try:
+            size = os.path.getsize(fpath)
+            os.remove(fpath)
+        except OSError:
+            return
+        self.size -= size
+
+    def evict(self):
+        """Remove oldest entries until cache fits in 3/4 of max_size."""
+        entries = []
+        for f in os.listdir(self.path):
+            fpath = os.path.join(self.path, f)
+            entries.append((os.path.getmtime(fpath), fpath))
+        for _, fpath in sorted(entries):
+            if self.size <= self.max_size * 3 / 4:
+                break
+            self._remove(fpath)
+
+    def purge(self):
+        with self.lock:
+            for f in os.listdir(self.path):
+                self._remove(os.path.join(self.path, f))
@@ -6,11 +6,14 @@ from __future__ import (unicode_literals, division, absolute_import, print_funct
 import collections
 import datetime
 import decimal
+import hashlib
 import json
+import mmap
 import os
-import StringIO
 import struct
 
+from lib.metrics import METRICS
+
 
 '''
 Sample program to demonstrate the decoding of data and extraction of metadata from KFX book files.
@@ -53,6 +56,12 @@ Raw ION files can also be dumped by this program.
 
 
 Release history:
+3.7     Cache symbol tables shared by containers, look up symbols by index
+3.6     Read KDF fragments through a cursor, only metadata ones when getting metadata
+3.5     Optionally return cover image data as raw bytes instead of base64
+3.4     Decode only metadata keys requested by get_kindle_kfx_metadata()
+3.3     Faster ION decoding over offsets of a single buffer
+3.2     Read KFX containers lazily through memory mapping
 3.1     Improve performance when getting only metadata
 3.0     Kindle KFX metadata API, e-ink Kindle cover metadata, new command line arguments
 2.0     Additional ion data types and support for KDF.
@@ -64,12 +73,13 @@ Release history:
 __license__   = 'GPL v3'
 __copyright__ = '2016, John Howell <jhowell@acm.org>'
 
-VERSION = '3.1'
+VERSION = '3.7'
 
 
 # magic numbers for data structures
 CONTAINER_MAGIC = b'CONT'
 ENTITY_MAGIC = b'ENTY'
+ENTITY_HEADER_LENGTH = 10    # magic, version and header length
 ION_MAGIC = b'\xe0\x01\x00\xea'
 DRMION_MAGIC = b'\xeaDRMION\xee'
 
@@ -92,6 +102,11 @@ DT_STRUCT = 13              # OrderedDict of symbol/value pairs (order is someti
 DT_TYPED_DATA = 14          # dict with 'type', 'id', 'value'
 
 
+# precompiled structures used by the ION decoder
+FLOAT64 = struct.Struct(b'>d')
+UINT_STRUCTS = {1: struct.Struct(b'>B'), 2: struct.Struct(b'>H'), 4: struct.Struct(b'>L'), 8: struct.Struct(b'>Q')}
+
+
 # some metadata-related symbols
 YJ_SYMBOLS = {
     7: "symbols",
@@ -120,7 +135,28 @@ YJ_SYMBOLS = {
     }
     
     
+def symbol_names(symbols):
+    # list of symbol names indexed by symbol number, unknown symbols are named "S<number>"
+    return [symbols[i] if i in symbols else "S%d" % i for i in range(max(symbols) + 1)]
+    
+    
+YJ_SYMBOL_NAMES = symbol_names(YJ_SYMBOLS)
+
+# symbol tables of recently decoded containers by hash of their document symbols
+SYMBOL_TABLE_CACHE_SIZE = 16
+symbol_table_cache = collections.OrderedDict()
+    
+    
 METADATA_ENTITY_TYPES = {164, 258, 417, 490}
+EXTERNAL_RESOURCE_ENTITY_TYPE = 164
+METADATA_ENTITY_TYPE = 258
+RAW_MEDIA_ENTITY_TYPE = 417
+BOOK_METADATA_ENTITY_TYPE = 490
+
+
+# struct fields decoded when only some metadata keys are needed (None stands for the whole value)
+BOOK_METADATA_FIELDS = {"categorised_metadata": {"metadata": {"key": None, "value": None}}}
+EXTERNAL_RESOURCE_FIELDS = {"location": None}
 
 
 def main():
@@ -164,19 +200,26 @@ def main():
         print('Decoding: %s' % args.pathname)
         
         if args.pathname.endswith('.kdf'):
-            data = KDFDatabase(args.pathname).decode()
+            kdf = KDFDatabase(args.pathname)
+            try:
+                data = kdf.decode(metadata_only=args.metadata)
+            finally:
+                kdf.close()
         else:
-            packed_data = read_file(args.pathname)
-            
-            if packed_data[0:4] == CONTAINER_MAGIC:
-                data = KFXContainer(packed_data).decode(metadata_only=args.metadata)
-            elif packed_data[0:4] == ION_MAGIC:
-                data = PackedIon(packed_data).decode_list()
-            elif packed_data[0:8] == DRMION_MAGIC:
-                data = PackedIon(packed_data[8:-8]).decode_list()
-            else:
-                print('%s does not appear to be KFX, KDF or ION' % args.pathname)
-                return
+            packed_data = map_file(args.pathname)
+            
+            try:
+                if packed_data[0:4] == CONTAINER_MAGIC:
+                    data = KFXContainer(packed_data).decode(metadata_only=args.metadata)
+                elif packed_data[0:4] == ION_MAGIC:
+                    data = PackedIon(packed_data).decode_list()
+                elif packed_data[0:8] == DRMION_MAGIC:
+                    data = PackedIon(packed_data[8:-8]).decode_list()
+                else:
+                    print('%s does not appear to be KFX, KDF or ION' % args.pathname)
+                    return
+            finally:
+                close_file(packed_data)
             
         if args.metadata:
             data = extract_metadata(data)
@@ -189,18 +232,36 @@ def main():
         print('No processing option specified. See --help')
 
     
-def get_kindle_kfx_metadata(filepath):
-    packed_data = read_file(filepath)
-
-    if packed_data[0:8] == DRMION_MAGIC:
-        # encrypted main file - metadata is in an alternate location
-        altpath = os.path.join(os.path.splitext(filepath)[0] + ".sdr", "assets", "metadata.kfx")
-        packed_data = read_file(altpath)
+def get_kindle_kfx_metadata(filepath, keys=None, raw_media=False):
+    # only the magic is checked here, the container is memory mapped and only the parts needed are read
+    # keys limits the result to given metadata keys (such as "ASIN" or "cover_image_data"), values
+    # not needed for them are skipped without being decoded
+    # raw_media returns cover_image_data as image bytes instead of base64 text needed for JSON
+    if filepath.endswith('.kdf'):
+        kdf = KDFDatabase(filepath)
+        try:
+            metadata = extract_metadata(kdf.decode(metadata_only=True, keys=keys))
+        finally:
+            kdf.close()
+    else:
+        datapath = filepath
+        if read_file(filepath, len(DRMION_MAGIC)) == DRMION_MAGIC:
+            # encrypted main file - metadata is in an alternate location
+            datapath = os.path.join(os.path.splitext(filepath)[0] + ".sdr", "assets", "metadata.kfx")
             
-    if packed_data[0:4] != CONTAINER_MAGIC:
-        raise Exception("%s is not a KFX container" % filepath)
+        packed_data = map_file(datapath)
+        try:
+            if packed_data[0:4] != CONTAINER_MAGIC:
+                raise Exception("%s is not a KFX container" % filepath)
+                
+            metadata = extract_metadata(KFXContainer(packed_data).decode(metadata_only=True, keys=keys, raw_media=raw_media))
+        finally:
+            close_file(packed_data)
         
-    return extract_metadata(KFXContainer(packed_data).decode(metadata_only=True))
+    if keys is not None:
+        metadata = dict((key, value) for key, value in metadata.items() if key in keys)
+        
+    return metadata
 
     
     
@@ -229,24 +290,25 @@ def extract_metadata(container_data):
             for key,value in entity.value.items():
                 add_metadata(key, value)
            
-    cover_image = metadata.get("cover_image")
-    if cover_image:
+    location = get_cover_location(container_data, metadata.get("cover_image"))
+    if location:
         for entity in container_data:
-            if entity.type == "external_resource" and entity.id == cover_image:
-                location = entity.value["location"]
+            if entity.type == "bcRawMedia" and entity.id == location:
+                metadata["cover_image_data"] = entity.value
                 break
-        else:
-            location = None
-            
-        if location:
-            for entity in container_data:
-                if entity.type == "bcRawMedia" and entity.id == location:
-                    metadata["cover_image_data"] = entity.value
-                    break
         
     return metadata
     
     
+def get_cover_location(container_data, cover_image):
+    if cover_image:
+        for entity in container_data:
+            if entity.type == "external_resource" and entity.id == cover_image:
+                return entity.value["location"]
+                
+    return None
+    
+    
   
     
 class PackedData:
@@ -305,6 +367,9 @@ class PackedBlock(PackedData):
 class KFXContainer(PackedBlock):
     '''
     Container file containing data entities
+    
+    Data may be a memory mapped file. Only the header, symbol table and index table are read here,
+    entities are sliced out of the data when they are decoded.
     '''
     
     def __init__(self, data):
@@ -324,7 +389,7 @@ class KFXContainer(PackedBlock):
             self.symbol_data = None
             
             
-        self.entities = []
+        self.entity_index = []
         index_table_length = container_info.get("bcIndexTabLength")
         
         if index_table_length:
@@ -333,22 +398,70 @@ class KFXContainer(PackedBlock):
         
             while entity_table.remaining():
                 entity_id, entity_type, entity_offset, entity_len = entity_table.unpack_multi('<LLQQ')
-                entity_start = self.header_len + entity_offset
-                self.entities.append(Entity(self.data[entity_start:entity_start + entity_len], entity_type, entity_id))
+                self.entity_index.append((entity_id, entity_type, self.header_len + entity_offset, entity_len))
+                
+        METRICS.read(self.offset + container_info_length + (doc_symbol_length or 0) + (index_table_length or 0))
             
-        
-    def decode(self, metadata_only=False):
-        symtab = dict(YJ_SYMBOLS)
-    
-        if self.symbol_data:
-            ion_symbol_table = PackedIon(self.symbol_data).decode().value
-            syms = ion_symbol_table["symbols"]
-            min_id = ion_symbol_table["max_id"] - len(syms) + 1
             
-            for i,sym in enumerate(syms):
-                symtab[i + min_id] = sym
+    @property
+    def entities(self):
+        return list(self.get_entities())
+        
+        
+    def get_entities(self, entity_types=None):
+        for entity_id, entity_type, entity_start, entity_len in self.entity_index:
+            if entity_types is None or entity_type in entity_types:
+                yield self.get_entity(entity_id, entity_type, entity_start, entity_len)
+                
+                
+    def get_entity(self, entity_id, entity_type, entity_start, entity_len):
+        # only the entity header is parsed here, so that its data is copied out of the container just once
+        header = PackedBlock(self.data[entity_start:entity_start + ENTITY_HEADER_LENGTH], ENTITY_MAGIC)
+        METRICS.read(entity_len)
+        return Entity(None, entity_type, entity_id, self.data[entity_start + header.header_len:entity_start + entity_len])
+                
+                
+    def find_entity(self, entity_type, name, symtab):
+        for entity_id, type_, entity_start, entity_len in self.entity_index:
+            if type_ == entity_type and symbol_name(symtab, entity_id) == name:
+                return self.get_entity(entity_id, entity_type, entity_start, entity_len)
+                
+        return None
+                
+        
+    def decode(self, metadata_only=False, keys=None, raw_media=False):
+        # keys (metadata keys needed) limit decoding of metadata entities to struct fields holding them
+        # raw_media leaves binary entities as bytes instead of encoding them as base64
+        symtab = get_symbol_table(self.symbol_data)
+                
+        if not metadata_only:
+            return [entity.decode(symtab, raw_media=raw_media) for entity in self.get_entities()]
             
-        return [entity.decode(symtab) for entity in self.entities if (not metadata_only) or (entity.entity_type in METADATA_ENTITY_TYPES)]
+        if keys is None:
+            container_data = [entity.decode(symtab) for entity in self.get_entities(METADATA_ENTITY_TYPES - {RAW_MEDIA_ENTITY_TYPE})]
+        else:
+            metadata_fields = dict.fromkeys(set(keys) | {"cover_image"})
+            container_data = [entity.decode(symtab, BOOK_METADATA_FIELDS if entity.entity_type == BOOK_METADATA_ENTITY_TYPE else metadata_fields)
+                    for entity in self.get_entities({METADATA_ENTITY_TYPE, BOOK_METADATA_ENTITY_TYPE})]
+                    
+        cover_image = extract_metadata(container_data).get("cover_image")
+        if keys is not None:
+            if "cover_image_data" not in keys or not cover_image:
+                return container_data
+                
+            # of all external resources only the cover is needed
+            entity = self.find_entity(EXTERNAL_RESOURCE_ENTITY_TYPE, cover_image, symtab)
+            if entity is not None:
+                container_data.append(entity.decode(symtab, EXTERNAL_RESOURCE_FIELDS))
+        
+        # of all raw media only the cover image is needed
+        location = get_cover_location(container_data, cover_image)
+        if location:
+            entity = self.find_entity(RAW_MEDIA_ENTITY_TYPE, location, symtab)
+            if entity is not None:
+                container_data.append(entity.decode(symtab, raw_media=raw_media))
+                    
+        return container_data
         
 
 class TypedData(object):
@@ -374,34 +487,101 @@ class Entity(PackedBlock):
             self.entity_data = data[self.header_len:]
         
         
-    def decode(self, symtab):
-        return TypedData(PackedIon(symtab=symtab).symbol_name(self.entity_type),
-                    PackedIon(symtab=symtab).symbol_name(self.entity_id),
-                    PackedIon(self.entity_data, symtab).decode() if PackedData(self.entity_data).unpack_one('4s') == ION_MAGIC
-                            else self.entity_data.encode('base64'))
+    def decode(self, symtab, fields=None, raw_media=False):
+        if self.entity_data[0:4] == ION_MAGIC:
+            value = PackedIon(self.entity_data, symtab).decode(fields)
+        elif raw_media:
+            value = self.entity_data
+        else:
+            value = self.entity_data.encode('base64')
+            
+        return TypedData(symbol_name(symtab, self.entity_type), symbol_name(symtab, self.entity_id), value)
     
 
 class KDFDatabase(object):
     '''
     SLQite database containing book fragments
+    
+    Fragments are read through a cursor and decoded one at a time, so only the fragments needed are
+    held in memory. Fragments of given types are selected by SQL when the database has element types
+    in its fragment_properties table, otherwise by the type found at the start of their data.
     '''
     
     def __init__(self, filename):
         import sqlite3      # version 3.8.2 or later required
         
-        conn = sqlite3.connect(filename, 30)
-        self.fragments = conn.execute('SELECT * FROM fragments;').fetchall()
-        conn.close()
+        self.conn = sqlite3.connect(filename, 30)
+        self.has_element_types = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+                "name = 'fragment_properties';").fetchone() is not None
         
         
-    def decode(self):
-        fragments_data = []
+    def close(self):
+        self.conn.close()
+        
+        
+    def get_fragments(self, fragment_types=None):
+        # yields id and ION data of fragments
+        if fragment_types is not None and self.has_element_types:
+            fragment_types = sorted(fragment_types)
+            cursor = self.conn.execute("SELECT f.id, f.payload_value FROM fragments f JOIN fragment_properties p ON p.id = f.id "
+                    "WHERE f.payload_type = 'blob' AND p.key = 'element_type' AND p.value IN (%s);" %
+                    ", ".join("?" * len(fragment_types)), fragment_types)
+        else:
+            cursor = self.conn.execute("SELECT id, payload_value FROM fragments WHERE payload_type = 'blob';")
+            
+        for id, payload_value in cursor:
+            if id != "max_id":
+                METRICS.read(len(payload_value))
+                yield id, bytes(payload_value)
+                
+                
+    def get_fragment(self, id):
+        row = self.conn.execute("SELECT payload_value FROM fragments WHERE id = ? AND payload_type = 'blob';", (id,)).fetchone()
+        if row is None:
+            return None
+            
+        METRICS.read(len(row[0]))
+        return bytes(row[0])
+        
+        
+    def decode_fragment(self, id, payload, fields=None):
+        fragment = PackedIon(payload).decode(fields)
+        return TypedData(fragment.id, id.encode('utf8'), fragment.value)
+        
         
-        for id, payload_type, payload_value in self.fragments:
-            if payload_type == "blob" and id != "max_id":
-                fragment = PackedIon(StringIO.StringIO(payload_value).read()).decode()
-                fragments_data.append(TypedData(fragment.id, id.encode('utf8'), fragment.value))
-      
+    def decode(self, metadata_only=False, keys=None):
+        # same as KFXContainer.decode(), cover images are kept in separate files, not in the database
+        if not metadata_only:
+            return [self.decode_fragment(id, payload) for id, payload in self.get_fragments()]
+            
+        if keys is None:
+            fragment_types = {YJ_SYMBOLS[entity_type] for entity_type in METADATA_ENTITY_TYPES - {RAW_MEDIA_ENTITY_TYPE}}
+        else:
+            fragment_types = {YJ_SYMBOLS[METADATA_ENTITY_TYPE], YJ_SYMBOLS[BOOK_METADATA_ENTITY_TYPE]}
+            metadata_fields = dict.fromkeys(set(keys) | {"cover_image"})
+            
+        fragments_data = []
+        for id, payload in self.get_fragments(fragment_types):
+            fragment_type = PackedIon(payload).typed_data_id()
+            if fragment_type not in fragment_types:
+                continue
+                
+            if keys is None:
+                fields = None
+            elif fragment_type == YJ_SYMBOLS[BOOK_METADATA_ENTITY_TYPE]:
+                fields = BOOK_METADATA_FIELDS
+            else:
+                fields = metadata_fields
+                
+            fragments_data.append(self.decode_fragment(id, payload, fields))
+            
+        if keys is not None and "cover_image_data" in keys:
+            # of all external resources only the cover is needed
+            cover_image = extract_metadata(fragments_data).get("cover_image")
+            payload = self.get_fragment(cover_image) if cover_image else None
+            if payload is not None and PackedIon(payload).typed_data_id() == YJ_SYMBOLS[EXTERNAL_RESOURCE_ENTITY_TYPE]:
+                fragments_data.append(self.decode_fragment(cover_image, payload, EXTERNAL_RESOURCE_FIELDS))
+                
         return fragments_data
         
         
@@ -409,21 +589,38 @@ class KDFDatabase(object):
 class PackedIon(PackedData):
     '''
     Packed structured binary data format
+    
+    Values are decoded by walking offsets over the single data buffer, so nested values are never
+    copied into buffers of their own. Every data type is decoded by a reader selected from a table.
+    
+    Decoding can be limited to fields, a projection of struct fields given as a dict of symbol names
+    mapped to projections of their values (None for the whole value). A projection of a list or typed
+    value applies to its elements. Values of other struct fields are skipped without being decoded.
     '''
     
-    def __init__(self, data=b'', symtab=YJ_SYMBOLS):
+    def __init__(self, data=b'', symtab=YJ_SYMBOL_NAMES):
         PackedData.__init__(self, data)
         self.symtab = symtab
+        
+        # indexed by data type
+        self.readers = (
+            self.read_null, self.read_boolean, self.read_positive_integer, self.read_negative_integer,
+            self.read_float, self.read_decimal, self.read_timestamp, self.read_symbol,
+            self.read_string, self.read_string, self.read_blob, self.read_list,
+            self.read_s_expression, self.read_struct, self.read_typed_data, self.read_unknown)
 
         
-    def decode(self):
+    def decode(self, fields=None):
         self.check_magic()
-        return self.unpack_typed_value()
+        value, self.offset = self.read_typed_value(self.offset, fields)
+        return value
 
 
     def decode_list(self):
         self.check_magic()
-        return self.unpack_list(self.remaining())
+        result = self.read_list(self.offset, self.remaining())
+        self.offset = len(self.buffer)
+        return result
         
         
     def check_magic(self):
@@ -433,140 +630,248 @@ class PackedIon(PackedData):
         
 
     def unpack_typed_value(self):
-        cmd = self.unpack_one('B')
+        value, self.offset = self.read_typed_value(self.offset)
+        return value
+        
+        
+    def typed_data_id(self):
+        # symbol name of the id of typed data value (type of KDF fragment) found without decoding
+        # the value, None for other data
+        if self.buffer[0:4] != ION_MAGIC or len(self.buffer) < 5:
+            return None
+            
+        cmd = ord(self.buffer[4])
+        if (cmd >> 4) != DT_TYPED_DATA:
+            return None
+            
+        offset = 5
+        if (cmd & 0x0f) == 14: offset = self.read_unsigned_number(offset)[1]
+        offset = self.read_unsigned_number(offset)[1]      # type
+        return self.symbol_name(self.read_unsigned_number(offset)[0])
+        
+        
+    def read_typed_value(self, offset, fields=None):
+        # returns the value and offset following it
+        cmd = ord(self.buffer[offset])
+        offset += 1
 
         data_type = cmd >> 4
         data_len = cmd & 0x0f
-        if data_len == 14: data_len = self.unpack_unsigned_number()
+        if data_len == 14: data_len, offset = self.read_unsigned_number(offset)
         
-        #print('cmd=%02x, len=%s: %s' % (cmd, data_len, hexs(self.buffer[self.offset:][:data_len])))
+        if data_type <= DT_BOOLEAN:
+            # no data follows, length is actually value
+            return self.readers[data_type](offset, data_len, fields), offset
             
-        if data_type == DT_NULL:
-            return None
+        if data_type > DT_TYPED_DATA:
+            return self.read_unknown(offset, data_len, fields, data_type), offset + data_len
+            
+        return self.readers[data_type](offset, data_len, fields), offset + data_len
         
-        if data_type == DT_BOOLEAN:
-            return data_len != 0  # length is actually value
-        
-        if data_type == DT_POSITIVE_INTEGER:
-            return self.unpack_unsigned_int(data_len)
-
-        if data_type == DT_NEGATIVE_INTEGER:
-            return -self.unpack_unsigned_int(data_len)
-
-        if data_type == DT_FLOAT:
-            if data_len == 0: return float(0.0)
-            return struct.unpack_from(b'>d', self.extract(data_len))[0]     # length must be 8
-
-        if data_type == DT_DECIMAL:
-            if data_len == 0: return decimal.Decimal(0)
-            ion = PackedIon(self.extract(data_len), self.symtab)
-            scale = ion.unpack_signed_number()
-            magnitude = ion.unpack_signed_int(ion.remaining())
-            return decimal.Decimal(magnitude) * (decimal.Decimal(10) ** scale)
-        
-        if data_type == DT_TIMESTAMP:
-            ion = PackedIon(self.extract(data_len), self.symtab)
-            ion.unpack_unsigned_number()        # unknown
-            year = ion.unpack_unsigned_number()
-            month = ion.unpack_unsigned_number()
-            day = ion.unpack_unsigned_number()
-            hour = ion.unpack_unsigned_number()
-            minute = ion.unpack_unsigned_number()
-            second = ion.unpack_unsigned_number()
-            ion.unpack_unsigned_number()        # unknown
-            return datetime.datetime(year, month, day, hour, minute, second)
-        
-        if data_type == DT_SYMBOL:
-            return self.symbol_name(self.unpack_unsigned_int(data_len))
-   
-        if data_type == DT_STRING:
-            return self.extract(data_len).decode('utf8')
-            
-        if data_type == DT_CLOB:
-            return self.extract(data_len).decode('utf8')
-        
-        if data_type == DT_BLOB:
-            return self.extract(data_len).encode('base64')
-        
-        if data_type == DT_LIST:
-            return self.unpack_list(data_len)
-            
-        if data_type == DT_S_EXPRESSION:
-            return tuple(self.unpack_list(data_len))
-            
-        if data_type == DT_STRUCT:
-            ion = PackedIon(self.extract(data_len), self.symtab)
-            result = collections.OrderedDict()
-            
-            while (ion.remaining()):
-                symbol = self.symbol_name(ion.unpack_unsigned_number())
-                result[symbol] = ion.unpack_typed_value()
-                
-            return result
+        
+    def skip_typed_value(self, offset):
+        # returns offset following the value
+        cmd = ord(self.buffer[offset])
+        offset += 1
+        
+        data_len = cmd & 0x0f
+        if data_len == 14: data_len, offset = self.read_unsigned_number(offset)
+        
+        if (cmd >> 4) <= DT_BOOLEAN:
+            return offset
             
-        if data_type == DT_TYPED_DATA:
-            ion = PackedIon(self.extract(data_len), self.symtab)
-            type_ = self.symbol_name(ion.unpack_unsigned_number())
-            id = self.symbol_name(ion.unpack_unsigned_number())
-            value = ion.unpack_typed_value()
-            return TypedData(type_, id, value)
-       
+        return offset + data_len
         
-        print("encountered unknown data type %d" % data_type)
-        self.advance(data_len)    
+        
+    def read_null(self, offset, length, fields=None):
         return None
         
-     
-    def unpack_list(self, length):
-        ion = PackedIon(self.extract(length), self.symtab)
+        
+    def read_boolean(self, offset, length, fields=None):
+        return length != 0
+        
+        
+    def read_positive_integer(self, offset, length, fields=None):
+        return self.read_unsigned_int(offset, length)
+        
+        
+    def read_negative_integer(self, offset, length, fields=None):
+        return -self.read_unsigned_int(offset, length)
+        
+        
+    def read_float(self, offset, length, fields=None):
+        if length == 0: return float(0.0)
+        return FLOAT64.unpack_from(self.buffer, offset)[0]     # length must be 8
+        
+        
+    def read_decimal(self, offset, length, fields=None):
+        if length == 0: return decimal.Decimal(0)
+        scale = self.read_signed_number(offset)
+        magnitude = self.read_signed_int(offset + 1, length - 1)
+        return decimal.Decimal(magnitude) * (decimal.Decimal(10) ** scale)
+        
+        
+    def read_timestamp(self, offset, length, fields=None):
+        values = []
+        while len(values) < 8:
+            value, offset = self.read_unsigned_number(offset)
+            values.append(value)
+            
+        unknown, year, month, day, hour, minute, second, unknown = values
+        return datetime.datetime(year, month, day, hour, minute, second)
+        
+        
+    def read_symbol(self, offset, length, fields=None):
+        return self.symbol_name(self.read_unsigned_int(offset, length))
+        
+        
+    def read_string(self, offset, length, fields=None):
+        return self.buffer[offset:offset + length].decode('utf8')
+        
+        
+    def read_blob(self, offset, length, fields=None):
+        return self.buffer[offset:offset + length].encode('base64')
+        
+        
+    def read_list(self, offset, length, fields=None):
+        end = offset + length
         result = []
         
-        while (ion.remaining()):
-            result.append(ion.unpack_typed_value())
+        while offset < end:
+            value, offset = self.read_typed_value(offset, fields)
+            result.append(value)
     
         return result
+        
+        
+    def read_s_expression(self, offset, length, fields=None):
+        return tuple(self.read_list(offset, length, fields))
+        
+        
+    def read_struct(self, offset, length, fields=None):
+        end = offset + length
+        result = collections.OrderedDict()
+        
+        if fields is None:
+            while offset < end:
+                symbol, offset = self.read_unsigned_number(offset)
+                value, offset = self.read_typed_value(offset)
+                result[self.symbol_name(symbol)] = value
+                
+            return result
+            
+        while offset < end:
+            symbol, offset = self.read_unsigned_number(offset)
+            name = self.symbol_name(symbol)
+            if name in fields:
+                result[name], offset = self.read_typed_value(offset, fields[name])
+            else:
+                offset = self.skip_typed_value(offset)
+                
+        return result
+        
+        
+    def read_typed_data(self, offset, length, fields=None):
+        type_, offset = self.read_unsigned_number(offset)
+        id, offset = self.read_unsigned_number(offset)
+        value = self.read_typed_value(offset, fields)[0]
+        return TypedData(self.symbol_name(type_), self.symbol_name(id), value)
+        
+        
+    def read_unknown(self, offset, length, fields=None, data_type=None):
+        print("encountered unknown data type %s" % data_type)
+        return None
     
     
-    def unpack_unsigned_number(self):
+    def read_unsigned_number(self, offset):
         # variable length numbers, MSB first, 7 bits per byte, last byte is flagged by MSb set
+        # returns the number and offset following it
+        byte = ord(self.buffer[offset])
+        if byte >= 0x80:
+            return byte & 0x7f, offset + 1
+
         number = 0
         while (True):
-            byte = self.unpack_one('B')
+            byte = ord(self.buffer[offset])
+            offset += 1
             number = (number << 7) | (byte & 0x7f)
             if byte >= 0x80:
-                return number
+                return number, offset
                 
                 
-    def unpack_signed_number(self):
+    def read_signed_number(self, offset):
         # single byte only, variable length not supported
-        value = self.unpack_one('B')
+        value = ord(self.buffer[offset])
         if (value & 0x80) == 0: raise Exception('encountered multi-byte signed number')
         if (value & 0x40): return -(value & 0x3f)
         return (value & 0x7f)
         
     
-    def unpack_unsigned_int(self, length):
+    def read_unsigned_int(self, offset, length):
         # unsigned big-endian (MSB first)
-        return struct.unpack_from(b'>Q', chr(0)*(8-length) + self.extract(length))[0]
+        unpacker = UINT_STRUCTS.get(length)
+        if unpacker is not None:
+            return unpacker.unpack_from(self.buffer, offset)[0]
+            
+        number = 0
+        for byte in self.buffer[offset:offset + length]:
+            number = (number << 8) | ord(byte)
+            
+        return number
         
         
-    def unpack_signed_int(self, length):
+    def read_signed_int(self, offset, length):
         # signed big-endian (MSB first)
         if length == 0: return 0
             
-        first_byte = self.unpack_one('B', advance=False)
+        first_byte = ord(self.buffer[offset])
         if (first_byte & 0x80) != 0:
-            self.advance(1)
-            return -struct.unpack_from(b'>Q', chr(0)*(7-length) + chr(first_byte & 0x7f) + self.extract(length-1))[0]
+            return -(((first_byte & 0x7f) << (8 * (length - 1))) | self.read_unsigned_int(offset + 1, length - 1))
             
-        return self.unpack_unsigned_int(length)
+        return self.read_unsigned_int(offset, length)
  
 
     def symbol_name(self, symbol_number):
-        return self.symtab.get(symbol_number, "S%d" % symbol_number)
+        return symbol_name(self.symtab, symbol_number)
+        
+        
+        
+def get_symbol_table(symbol_data):
+    '''
+    Return symbol names (see symbol_names()) of YJ_SYMBOLS extended by document symbols of a container
+    
+    Many books import the same local symbols, so tables are cached by content hash of the document symbols.
+    '''
+    if not symbol_data:
+        return YJ_SYMBOL_NAMES
+        
+    key = hashlib.sha1(symbol_data).digest()
+    symtab = symbol_table_cache.pop(key, None)
+    
+    if symtab is None:
+        symbols = dict(YJ_SYMBOLS)
+        ion_symbol_table = PackedIon(symbol_data).decode().value
+        syms = ion_symbol_table["symbols"]
+        min_id = ion_symbol_table["max_id"] - len(syms) + 1
+        
+        for i,sym in enumerate(syms):
+            symbols[i + min_id] = sym
+            
+        symtab = symbol_names(symbols)
+        if len(symbol_table_cache) >= SYMBOL_TABLE_CACHE_SIZE:
+            symbol_table_cache.popitem(last=False)
+            
+    symbol_table_cache[key] = symtab
+    return symtab
+    
+    
+def symbol_name(symtab, symbol_number):
+    try:
+        return symtab[symbol_number]
+    except IndexError:
+        return "S%d" % symbol_number
         
     
-
 def hexs(string, sep=' '):
     return sep.join('%02x' % ord(b) for b in string)
     
@@ -589,9 +894,26 @@ def json_dump(data, sort_keys=False):
     return json.dumps(data, indent=2, separators=(',', ': '), cls=IonEncoder, sort_keys=sort_keys)
 
     
-def read_file(filename):
+def read_file(filename, size=-1):
     with open(filename, 'rb') as of:
-        return of.read()
+        data = of.read(size)
+        
+    METRICS.read(len(data))
+    return data
+        
+        
+def map_file(filename):
+    # read-only memory map, so that only the pages actually used are read from disk
+    with open(filename, 'rb') as of:
+        if os.fstat(of.fileno()).st_size == 0:
+            return b''
+            
+        return mmap.mmap(of.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        
+def close_file(data):
+    if isinstance(data, mmap.mmap):
+        data.close()
         
         
 def write_file(filename, data):
@@ -19,12 +19,22 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import mmap
 import struct
 
+from lib.metrics import METRICS
+
 
 class Sectionizer:
     def __init__(self, filename):
-        self.data = open(filename, 'rb').read()
+        # map the file instead of reading it, so only the records which are
+        # really loaded (header, record 0, cover) are paged in from the disk
+        with open(filename, 'rb') as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                # empty files can't be mapped
+                self.data = f.read()
         self.palmheader = self.data[:78]
         self.palmname = self.data[:32]
         self.ident = self.palmheader[0x3C:0x3C + 8]
@@ -33,6 +43,7 @@ class Sectionizer:
         sectionsdata = struct.unpack_from('>%dL' % (self.num_sections * 2), self.data, 78) + (self.filelength, 0)  # noqa
         self.sectionoffsets = sectionsdata[::2]
         self.sectionattributes = sectionsdata[1::2]
+        METRICS.read(78 + 8 * self.num_sections)
         # noinspection PyUnusedLocal
         self.sectiondescriptions = ["" for x in range(self.num_sections + 1)]
         self.sectiondescriptions[-1] = "File Length Only"
@@ -48,7 +59,33 @@ class Sectionizer:
 
     def load_section(self, section):
         before, after = self.sectionoffsets[section:section + 2]
-        return self.data[before:after]
+        data = self.data[before:after]
+        METRICS.read(len(data))
+        return data
+
+    def section_view(self, section):
+        """
+        Return the record as a buffer of the mapping, without copying it.
+
+        The buffer must not be used after close(), so values kept longer
+        have to be copied out of it.
+        """
+        before, after = self.sectionoffsets[section:section + 2]
+        after = min(after, self.filelength)
+        METRICS.read(max(0, after - before))
+        return buffer(self.data, before, max(0, after - before))
+
+    def prefetch_section(self, section):
+        """Page the record in from the disk without copying it."""
+        before, after = self.sectionoffsets[section:section + 2]
+        for offset in range(before, min(after, self.filelength),
+                            mmap.PAGESIZE):
+            self.data[offset]
+
+    def close(self):
+        """Release the file mapping (required on Windows before writing)."""
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
 
 
 class MobiHeader:
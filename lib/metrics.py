@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from lib.progress import PROGRESS
+
+SFENC = sys.getfilesystemencoding()
+
+# stages in the order they are run for a book
+STAGES = ('scan', 'prefetch', 'metadata', 'cover', 'image_decode',
+          'image_resize', 'image_encode', 'thumbnail_write', 'pages_csv',
+          'real_pages', 'apnx_write')
+COUNTERS = ('seen', 'processed', 'bytes_read', 'bytes_written', 'seconds')
+PROMETHEUS_PREFIX = 'extract_cover_thumbs_stage_'
+PROMETHEUS_HELP = {
+    'seen': 'Files which entered the stage.',
+    'processed': 'Files for which the stage completed.',
+    'bytes_read': 'Bytes read by the stage.',
+    'bytes_written': 'Bytes written by the stage.',
+    'seconds': 'Time spent in the stage, summed over worker processes.',
+}
+# upper bounds of book latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+def display_path(path):
+    if isinstance(path, unicode):
+        return path
+    return path.decode(SFENC, 'replace')
+
+
+class Metrics(object):
+    """
+    Counters and timers of processing stages.
+
+    Bytes read and written are added to the innermost running stage, so
+    low level readers need not know the stage they are called from.
+    There is one instance per process (METRICS), worker processes send
+    snapshots of theirs to the main process to be merged. Running stages
+    and the book being traced are tracked per thread.
+
+    With tracing on, time spent on every book and in stages run for it
+    is recorded too. With profiling on (profiles is a list), statistics
+    of threads profiled by profile() are collected in profiles.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.profiles = None
+        self.reset()
+
+    def reset(self, tracing=False):
+        self.stages = OrderedDict(
+            (stage, dict.fromkeys(COUNTERS, 0)) for stage in STAGES)
+        self.books = {} if tracing else None
+
+    @property
+    def running(self):
+        try:
+            return self.local.running
+        except AttributeError:
+            self.local.running = []
+            return self.local.running
+
+    @property
+    def current(self):
+        return getattr(self.local, 'current', None)
+
+    @current.setter
+    def current(self, trace):
+        self.local.current = trace
+
+    @property
+    def tracing(self):
+        return self.books is not None
+
+    @property
+    def profiling(self):
+        return self.profiles is not None
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = dict.fromkeys(COUNTERS, 0)
+        return self.stages[name]
+
+    @contextmanager
+    def timer(self, name):
+        """Time the block and make it the stage bytes are counted in."""
+        counters = self.stage(name)
+        self.running.append(counters)
+        start = time.time()
+        try:
+            yield counters
+        finally:
+            elapsed = time.time() - start
+            self.running.pop()
+            with self.lock:
+                counters['seconds'] += elapsed
+            if self.current is not None:
+                stages = self.current['stages']
+                stages[name] = stages.get(name, 0) + elapsed
+            PROGRESS.stage(name, elapsed)
+
+    @contextmanager
+    def book(self, path):
+        """Add time of the block and of stages run in it to book trace."""
+        if self.books is None:
+            yield
+            return
+        previous = self.current
+        self.current = self.book_trace(path)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.current['seconds'] += time.time() - start
+            self.current = previous
+
+    def book_trace(self, path):
+        with self.lock:
+            if path not in self.books:
+                self.books[path] = {'seconds': 0, 'stages': {}}
+            return self.books[path]
+
+    @contextmanager
+    def profile(self):
+        """Profile the calling thread within the block if profiling is on."""
+        if self.profiles is None:
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.create_stats()
+            with self.lock:
+                self.profiles.append(profiler.stats)
+
+    def book_error(self, error):
+        """Note error of the book being traced."""
+        if self.current is not None:
+            self.current['error'] = error
+
+    def count_in(self, counters):
+        """
+        Count bytes of the calling thread in counters of a running stage.
+
+        Meant as initializer of pool threads working for a stage timed by
+        another thread. Nothing is done if counters is None.
+        """
+        if counters is not None:
+            self.running.append(counters)
+
+    def add(self, counter, value):
+        if not self.running:
+            return
+        with self.lock:
+            self.running[-1][counter] += value
+
+    def read(self, size):
+        self.add('bytes_read', size)
+
+    def written(self, size):
+        self.add('bytes_written', size)
+
+    def snapshot(self):
+        return ([(name, dict(counters))
+                 for name, counters in self.stages.items()
+                 if any(counters.values())], self.books, self.profiles)
+
+    def merge(self, snapshot):
+        stages, books, profiles = snapshot
+        with self.lock:
+            for name, counters in stages:
+                stage = self.stage(name)
+                for counter, value in counters.items():
+                    stage[counter] += value
+            if self.profiles is not None and profiles:
+                self.profiles.extend(profiles)
+            if self.books is None or not books:
+                return
+            for path, trace in books.items():
+                merged = self.book_trace(path)
+                merged['seconds'] += trace['seconds']
+                for name, seconds in trace['stages'].items():
+                    merged['stages'][name] = (merged['stages'].get(name, 0) +
+                                              seconds)
+                if 'error' in trace:
+                    merged['error'] = trace['error']
+
+    def slowest_books(self, count):
+        """Return (path, trace) of count books which took most time."""
+        return sorted(self.books.items(),
+                      key=lambda item: item[1]['seconds'],
+                      reverse=True)[:count]
+
+    def latency_histogram(self):
+        """Return cumulative counts of books not slower than the buckets."""
+        counts = [0] * len(LATENCY_BUCKETS)
+        for trace in self.books.values():
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if trace['seconds'] <= bound:
+                    counts[i] += 1
+        return zip(LATENCY_BUCKETS, counts)
+
+    def report(self, wall_seconds, jobs=1, slowest=10):
+        report = OrderedDict((
+            ('wall_seconds', round(wall_seconds, 6)),
+            ('jobs', jobs),
+            ('stages', OrderedDict(
+                (name, OrderedDict(
+                    (counter, round(counters[counter], 6)
+                     if counter == 'seconds' else counters[counter])
+                    for counter in COUNTERS))
+                for name, counters in self.stages.items())),
+        ))
+        if self.books is None:
+            return report
+        report['books'] = OrderedDict((
+            ('traced', len(self.books)),
+            ('slowest', [OrderedDict((
+                ('path', display_path(path)),
+                ('seconds', round(trace['seconds'], 6)),
+                ('stages', OrderedDict(
+                    (name, round(trace['stages'][name], 6))
+                    for name in self.stages if name in trace['stages'])),
+                ('error', trace.get('error')),
+            )) for path, trace in self.slowest_books(slowest)]),
+            ('latency_histogram', [
+                OrderedDict((('le', bound), ('count', count)))
+                for bound, count in self.latency_histogram()]),
+        ))
+        return report
+
+    def trace_lines(self, slowest=10):
+        """Return lines of slowest books and latency histogram report."""
+        lines = ['* Slowest books:']
+        for path, trace in self.slowest_books(slowest):
+            lines.append('  %8.3f s  %s%s' % (
+                trace['seconds'], display_path(path),
+                ' (%s)' % trace['error'] if 'error' in trace else ''))
+            lines.append('             ' + ', '.join(
+                '%s %.3f' % (name, trace['stages'][name])
+                for name in self.stages if name in trace['stages']))
+        lines.append('* Books processed in:')
+        previous = 0
+        for bound, count in self.latency_histogram():
+            if previous == len(self.books):
+                # no slower books
+                break
+            lines.append('  <= %6g s: %d' % (bound, count - previous))
+            previous = count
+        else:
+            lines.append('   > %6g s: %d' % (LATENCY_BUCKETS[-1],
+                                            len(self.books) - previous))
+        return lines
+
+    def write_json(self, path, wall_seconds, jobs=1, slowest=10):
+        with open(path, 'wb') as f:
+            json.dump(self.report(wall_seconds, jobs, slowest), f, indent=2,
+                      separators=(',', ': '))
+            f.write(b'\n')
+
+    def write_prometheus(self, path, wall_seconds):
+        """Write report in text format of Prometheus node exporter."""
+        lines = []
+        for counter in COUNTERS:
+            metric = PROMETHEUS_PREFIX + counter
+            lines.append('# HELP %s %s' % (metric, PROMETHEUS_HELP[counter]))
+            lines.append('# TYPE %s gauge' % metric)
+            for name, counters in self.stages.items():
+                lines.append('%s{stage="%s"} %s' % (
+                    metric, name, repr(counters[counter])))
+        lines.append('# HELP extract_cover_thumbs_run_seconds '
+                     'Wall time of the run.')
+        lines.append('# TYPE extract_cover_thumbs_run_seconds gauge')
+        lines.append('extract_cover_thumbs_run_seconds %r' % wall_seconds)
+        if self.books is not None:
+            metric = 'extract_cover_thumbs_book_seconds'
+            lines.append('# HELP %s Time spent on books.' % metric)
+            lines.append('# TYPE %s histogram' % metric)
+            for bound, count in self.latency_histogram():
+                lines.append('%s_bucket{le="%g"} %d' % (metric, bound, count))
+            lines.append('%s_bucket{le="+Inf"} %d' % (metric,
+                                                      len(self.books)))
+            lines.append('%s_sum %r' % (metric, sum(
+                trace['seconds'] for trace in self.books.values())))
+            lines.append('%s_count %d' % (metric, len(self.books)))
+        # node exporter may read the file at any time
+        with open(path + '.tmp', 'wb') as f:
+            f.write('\n'.join(lines) + '\n')
+        if os.path.exists(path) and os.name == 'nt':
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+
+class ProfileStats(object):
+    """Statistics of a profile made elsewhere, loadable by pstats."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def profiled(path, func, *args, **kwargs):
+    """
+    Call func under cProfile and save profile statistics in path.
+
+    Profiles of other threads run meanwhile with METRICS.profile() are
+    merged into the saved statistics.
+    """
+    METRICS.profiles = []
+    try:
+        with METRICS.profile():
+            return func(*args, **kwargs)
+    finally:
+        profiles, METRICS.profiles = METRICS.profiles, None
+        stats = pstats.Stats(*[ProfileStats(profile) for profile in profiles])
+        stats.dump_stats(path)
+
+
+METRICS = Metrics()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import re
+import struct
+
+NO_COMPRESSION = 1
+PALMDOC_COMPRESSION = 2
+HUFFCDIC_COMPRESSION = 17480
+
+QUAD = struct.Struct('>Q')
+
+# runs of bytes copied as they are by PalmDOC decompression
+PALMDOC_LITERALS_RE = re.compile(b'[\x00\x09-\x7f]+')
+
+
+def palmdoc_decompress(data):
+    """
+    Decompress PalmDOC (LZ77) compressed text record.
+
+    Tokens are dispatched on their first byte and runs of literal bytes
+    are matched with a regular expression and copied at once.
+    """
+    out = bytearray()
+    tokens = bytearray(data)
+    match_literals = PALMDOC_LITERALS_RE.match
+    pos = 0
+    end = len(tokens)
+    while pos < end:
+        c = tokens[pos]
+        if c >= 0xc0:
+            # space and character
+            out += b' '
+            out.append(c ^ 0x80)
+            pos += 1
+        elif c >= 0x80:
+            # distance and length of earlier text
+            if pos + 1 < end:
+                c = (c << 8) | tokens[pos + 1]
+            else:
+                c <<= 8
+            pos += 2
+            distance = (c >> 3) & 0x7ff
+            length = (c & 7) + 3
+            start = len(out) - distance
+            if distance <= 0 or start < 0:
+                continue
+            if distance >= length:
+                out += out[start:start + length]
+            else:
+                # copied text overlaps the text being written
+                for i in range(start, start + length):
+                    out.append(out[i])
+        elif 0 < c < 9:
+            # next c bytes are copied as they are
+            pos += 1
+            out += tokens[pos:pos + c]
+            pos += c
+        else:
+            literals = match_literals(data, pos)
+            out += literals.group()
+            pos = literals.end()
+    return bytes(out)
+
+
+class HuffcdicReader(object):
+    """
+    Table driven decoder of HUFF/CDIC compressed text records.
+
+    Codes up to 16 bits long, nearly all codes of real books, are decoded
+    with one lookup in a table indexed by the next 16 bits of the record.
+    Compressed phrases of the dictionary are decoded once, on first use.
+    """
+
+    def __init__(self, huff, cdics):
+        self.phrases = []
+        self.compressed = {}
+        self.load_huff(huff)
+        for cdic in cdics:
+            self.load_cdic(cdic)
+
+    def load_huff(self, huff):
+        if huff[0:8] != b'HUFF\x00\x00\x00\x18':
+            raise ValueError('invalid HUFF header')
+        off1, off2 = struct.unpack_from('>LL', huff, 8)
+        dict2 = struct.unpack_from('>64L', huff, off2)
+        self.mincode = [0] + [code << (32 - codelen) for codelen, code
+                              in enumerate(dict2[0::2], 1)]
+        self.maxcode = [0] + [((code + 1) << (32 - codelen)) - 1
+                              for codelen, code in enumerate(dict2[1::2], 1)]
+        self.dict1 = []
+        for value in struct.unpack_from('>256L', huff, off1):
+            codelen, term, maxcode = value & 0x1f, value & 0x80, value >> 8
+            if codelen == 0 or codelen <= 8 and not term:
+                raise ValueError('invalid HUFF code table')
+            self.dict1.append((codelen, term,
+                               ((maxcode + 1) << (32 - codelen)) - 1))
+        table = []
+        for prefix, (codelen, term, maxcode) in enumerate(self.dict1):
+            if not term:
+                table.extend(self.long_codes(prefix, codelen))
+            elif codelen <= 16:
+                # all codes starting with the byte have the same length,
+                # but the phrase depends on their bits after the byte
+                shift = 32 - codelen
+                start = prefix << 8
+                table.extend([(codelen, (maxcode - (code << 16)) >> shift)
+                              for code in range(start, start + 256)])
+            else:
+                table.extend([None] * 256)
+        self.table = table
+
+    def long_codes(self, prefix, codelen):
+        """
+        Return table entries of 16-bit codes starting with the byte.
+
+        Codes are searched from the shortest like in long_code(), but
+        for ranges of codes at once. Entries of codes longer than 16 bits
+        are None.
+        """
+        entries = [None] * 256
+        start = prefix << 8
+        end = start + 256
+        while codelen <= 16 and end > start:
+            low = max(start, -(-self.mincode[codelen] >> 16))
+            if low < end:
+                shift = 32 - codelen
+                maxcode = self.maxcode[codelen]
+                entries[low - start:end - start] = [
+                    (codelen, (maxcode - (code << 16)) >> shift)
+                    for code in range(low, end)]
+                end = low
+            codelen += 1
+        return entries
+
+    def load_cdic(self, cdic):
+        if cdic[0:8] != b'CDIC\x00\x00\x00\x10':
+            raise ValueError('invalid CDIC header')
+        phrases, bits = struct.unpack_from('>LL', cdic, 8)
+        count = min(1 << bits, phrases - len(self.phrases))
+        for offset in struct.unpack_from('>%dH' % count, cdic, 16):
+            length, = struct.unpack_from('>H', cdic, 16 + offset)
+            phrase = cdic[18 + offset:18 + offset + (length & 0x7fff)]
+            if not length & 0x8000:
+                self.compressed[len(self.phrases)] = phrase
+                phrase = None
+            self.phrases.append(phrase)
+
+    def long_code(self, code):
+        """Return length and phrase index of code given as next 32 bits."""
+        codelen, term, maxcode = self.dict1[code >> 24]
+        if not term:
+            while code < self.mincode[codelen]:
+                codelen += 1
+                if codelen > 32:
+                    raise ValueError('invalid HUFF code')
+            maxcode = self.maxcode[codelen]
+        return codelen, (maxcode - code) >> (32 - codelen)
+
+    def expand(self, index):
+        try:
+            data = self.compressed.pop(index)
+        except KeyError:
+            raise ValueError('recursive CDIC phrase')
+        phrase = self.unpack(data)
+        self.phrases[index] = phrase
+        return phrase
+
+    def unpack(self, data):
+        out = []
+        append = out.append
+        phrases = self.phrases
+        table = self.table
+        unpack_quad = QUAD.unpack_from
+        bitsleft = len(data) * 8
+        data += b'\x00' * 8
+        pos = 0
+        x, = unpack_quad(data, 0)
+        n = 32
+        while True:
+            if n <= 0:
+                pos += 4
+                x, = unpack_quad(data, pos)
+                n += 32
+            code = (x >> n) & 0xffffffff
+            entry = table[code >> 16]
+            if entry is None:
+                entry = self.long_code(code)
+            codelen, index = entry
+            n -= codelen
+            bitsleft -= codelen
+            if bitsleft < 0:
+                break
+            try:
+                phrase = phrases[index]
+            except IndexError:
+                raise ValueError('invalid CDIC phrase')
+            if phrase is None:
+                phrase = self.expand(index)
+            append(phrase)
+        return b''.join(out)
+
+
+def trailing_entries_size(data, flags):
+    """Return size of trailing entries appended to a text record."""
+    def entry_size(size):
+        result = bitpos = 0
+        while size > 0:
+            value = ord(data[size - 1])
+            result |= (value & 0x7f) << bitpos
+            bitpos += 7
+            size -= 1
+            if value & 0x80 or bitpos >= 28:
+                break
+        return result
+
+    num = 0
+    testflags = flags >> 1
+    while testflags:
+        if testflags & 1:
+            num += entry_size(len(data) - num)
+        testflags >>= 1
+    # multibyte characters overflowing into the next record
+    if flags & 1 and len(data) > num:
+        num += (ord(data[len(data) - num - 1]) & 0x3) + 1
+    return num
+
+
+def extra_flags(mh):
+    if mh.palm or mh.length < 0xe4 or mh.version < 5:
+        return 0
+    flags, = struct.unpack_from('>H', mh.header, 0xf2)
+    return flags
+
+
+def text_decompressor(mh):
+    """
+    Return function decompressing text records of the book.
+
+    None is returned for encrypted books and unsupported compression.
+    Broken HUFF/CDIC records raise ValueError.
+    """
+    if mh.crypto_type != 0:
+        return None
+    compression, = struct.unpack_from('>H', mh.header, 0)
+    if compression == NO_COMPRESSION:
+        return bytes
+    if compression == PALMDOC_COMPRESSION:
+        return palmdoc_decompress
+    if compression == HUFFCDIC_COMPRESSION:
+        huffoff, huffnum = struct.unpack_from('>LL', mh.header, 0x70)
+        huffoff += mh.start
+        # phrases are copied out of the records by the reader
+        return HuffcdicReader(
+            mh.sect.section_view(huffoff),
+            [mh.sect.section_view(i)
+             for i in range(huffoff + 1, huffoff + huffnum)]).unpack
+    return None
+
+
+def iter_text_records(section, mh, decompress):
+    """
+    Yield decompressed text records one by one.
+
+    Compressed records are passed to decompress as buffers of the file
+    mapping, so they are not copied before they are decompressed.
+    """
+    flags = extra_flags(mh)
+    for i in range(mh.start + 1, mh.start + mh.records + 1):
+        data = section.section_view(i)
+        if flags:
+            size = trailing_entries_size(data, flags)
+            if size:
+                data = buffer(data, 0, len(data) - size)
+        yield decompress(data)
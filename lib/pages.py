@@ -9,43 +9,15 @@
 
 from __future__ import print_function
 import os
+import csv
 import sys
 import struct
 import unicodedata
 
-SFENC = sys.getfilesystemencoding()
-
-
-class PalmDB:
-    unique_id_seed = 68
-    number_of_pdb_records = 76
-    first_pdb_record = 78
-
-    def __init__(self, palmdata):
-        self.data = palmdata
-        self.nsec, = struct.unpack_from('>H', self.data,
-                                        PalmDB.number_of_pdb_records)
-
-    def getsecaddr(self, secno):
-        secstart, = struct.unpack_from('>L', self.data,
-                                       PalmDB.first_pdb_record + secno * 8)
-        if secno == self.nsec - 1:
-            secend = len(self.data)
-        else:
-            secend, = struct.unpack_from(
-                '>L', self.data,
-                PalmDB.first_pdb_record + (secno + 1) * 8
-            )
-        return secstart, secend
-
-    def readsection(self, secno):
-        if secno < self.nsec:
-            secstart, secend = self.getsecaddr(secno)
-            return self.data[secstart:secend]
-        return ''
+from lib.metrics import METRICS
+from lib.progress import PROGRESS
 
-    def getnumsections(self):
-        return self.nsec
+SFENC = sys.getfilesystemencoding()
 
 
 def find_exth(search_id, content):
@@ -68,9 +40,14 @@ def strip_accents(text):
     ) if unicodedata.category(c) != 'Mn')
 
 
-def mobi_header_fields(mobi_content):
-    pp = PalmDB(mobi_content)
-    header = pp.readsection(0)
+def utf8_text(text, codepage):
+    """Return EXTH or title text of the book encoded in UTF-8."""
+    if codepage == 65001:
+        return text
+    return text.decode('cp1252', 'replace').encode('UTF-8')
+
+
+def mobi_header_fields(header):
     id = struct.unpack_from('4s', header, 0x10)[0]
     version = struct.unpack_from('>L', header, 0x24)[0]
     # dictionary input and output languages
@@ -87,31 +64,111 @@ def mobi_header_fields(mobi_content):
     return id, version, title, locations, dict_input, dict_output
 
 
-def get_pages(dirpath, mfile, is_verbose):
+def get_pages(book, mfile):
     file_dec = mfile.decode(sys.getfilesystemencoding())
-    with open(os.path.join(dirpath, mfile), 'rb') as f:
-        mobi_content = f.read()
-    if mobi_content[60:68] != 'BOOKMOBI':
-        print(file_dec + ': invalid file format. Skipping...')
+    if not book.is_mobi:
+        PROGRESS.warning('%s: invalid file format. Skipping...', file_dec)
         return None
-    id, ver, title, locations, di, do = mobi_header_fields(mobi_content)
+    header = book.record0
+    id, ver, title, locations, di, do = mobi_header_fields(header)
     if (di != 0 or do != 0):
-        print(file_dec + ': dictionary file. Skipping...')
+        PROGRESS.warning('%s: dictionary file. Skipping...', file_dec)
         return None
-    author = find_exth(100, mobi_content)
-    asin = find_exth(113, mobi_content)
-    dc_lang = find_exth(524, mobi_content)
+    author = find_exth(100, header)
+    asin = find_exth(113, header)
+    dc_lang = find_exth(524, header)
     if '!DeviceUpgradeLetter!' in asin:
-        if is_verbose:
-            print(file_dec + ': Upgrade Letter. Skipping...')
+        PROGRESS.debug('%s: Upgrade Letter. Skipping...', file_dec)
         return None
+    # text of the CSV file is UTF-8, like the one of most books
+    codepage, = struct.unpack_from('>L', header, 0x1c)
     row = [
         asin,
         dc_lang,
-        author,
-        title,
+        utf8_text(author, codepage),
+        utf8_text(title, codepage),
         locations / 15 + 1,
         False,
         os.path.join(mfile)
     ]
     return row
+
+
+class PagesDatabase(object):
+    """Book pages CSV file loaded once and indexed by ASIN and file name."""
+
+    header = ['asin', 'lang', 'author', 'title', 'pages', 'is_real',
+              'file_path']
+
+    def __init__(self, csvfile):
+        self.csvfile = csvfile
+        self.asins = set()
+        self.files = set()
+        self.by_asin = {}
+        self.by_file = {}
+        self.count = 0
+        if not os.path.isfile(csvfile):
+            with open(csvfile, 'wb') as o:
+                csvwrite = csv.writer(o, delimiter=';', quotechar='"',
+                                      quoting=csv.QUOTE_ALL)
+                csvwrite.writerow(self.header)
+            return
+        with open(csvfile, 'rb') as f:
+            csvread = csv.reader(f, delimiter=';', quotechar='"',
+                                 quoting=csv.QUOTE_ALL)
+            for row in csvread:
+                self.index(row)
+            METRICS.read(f.tell())
+
+    def index(self, row):
+        if not row:
+            return
+        self.count += 1
+        if row[0] != '* NONE *':
+            self.asins.add(row[0])
+            if len(row) > 4:
+                self.by_asin[row[0]] = (self.count, row)
+        elif len(row) > 6:
+            self.by_file[row[6]] = (self.count, row)
+        if len(row) > 6:
+            self.files.add(row[6])
+
+    def has_file(self, mfile):
+        return mfile in self.files
+
+    def add(self, row):
+        """
+        Append row of a new book to CSV file.
+
+        Return True if the row was added.
+        """
+        if row is None:
+            return False
+        if row[0] in self.asins:
+            return False
+        if row[6] in self.files:
+            return False
+        with open(self.csvfile, 'ab') as o:
+            PROGRESS.info('* Updating book pages CSV file...')
+            o.seek(0, os.SEEK_END)
+            start = o.tell()
+            csvwrite = csv.writer(o, delimiter=';', quotechar='"',
+                                  quoting=csv.QUOTE_ALL)
+            csvwrite.writerow(row)
+            METRICS.written(o.tell() - start)
+        self.index(row)
+        return True
+
+    def find(self, asin, mfile):
+        """
+        Return the last row matching ASIN.
+
+        Books without ASIN are matched by the file name.
+        """
+        found = [self.by_file.get(mfile)]
+        if asin != '* NONE *':
+            found.append(self.by_asin.get(asin))
+        found = [f for f in found if f is not None]
+        if not found:
+            return None
+        return max(found)[1]
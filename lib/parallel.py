@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import sys
+import Queue
+import threading
+import multiprocessing
+
+from lib.metrics import METRICS
+from lib.progress import PROGRESS, StreamRedirector
+
+# end of items passed between pipeline stages
+DONE = object()
+
+
+class StageError(object):
+    """Exception raised by a pipeline stage, passed on to the consumer."""
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def run_captured(task):
+    func, args, tracing, profiling, level = task
+    events = PROGRESS.capture(level)
+    stdout = sys.stdout
+    # anything printed directly is kept in order with the events
+    sys.stdout = StreamRedirector()
+    METRICS.reset(tracing)
+    METRICS.profiles = [] if profiling else None
+    try:
+        with METRICS.profile():
+            result = func(*args)
+    finally:
+        sys.stdout = stdout
+    return events, result, METRICS.snapshot()
+
+
+def map_books(func, tasks, jobs=1):
+    """
+    Call func for every tuple of arguments in tasks and yield results in order.
+
+    With more than one job the calls are spread across a process pool.
+    Progress events of each call are collected in the worker and emitted
+    at once, so log messages of books are never interleaved. Metrics and
+    profiles of each call are merged into METRICS of the main process.
+    """
+    if jobs <= 1 or len(tasks) <= 1:
+        for args in tasks:
+            yield func(*args)
+        return
+    pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+        for events, result, metrics in pool.imap(
+                run_captured, [(func, args, METRICS.tracing,
+                                METRICS.profiling, PROGRESS.level)
+                               for args in tasks]):
+            for event in events:
+                PROGRESS.emit(event)
+            METRICS.merge(metrics)
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def feed_stage(items, output, stop):
+    end = DONE
+    with METRICS.profile():
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                output.put(item)
+        except Exception:
+            end = StageError(sys.exc_info())
+    output.put(end)
+
+
+def run_stage(func, source, output, stop):
+    with METRICS.profile():
+        while True:
+            item = source.get()
+            if item is DONE or isinstance(item, StageError):
+                break
+            if stop.is_set():
+                item = DONE
+                break
+            try:
+                item = func(item)
+            except Exception:
+                item = StageError(sys.exc_info())
+                break
+            output.put(item)
+    output.put(item)
+
+
+def drain(queue):
+    try:
+        while True:
+            queue.get_nowait()
+    except Queue.Empty:
+        pass
+
+
+def pipeline(items, stages, size=8):
+    """
+    Pass items through stage functions and yield results in order.
+
+    Every stage runs in its own thread and takes items from the previous
+    one through a queue holding at most size items, so reading of next
+    items overlaps with processing of the current one, while the number
+    of items held in memory stays bounded. Exceptions raised by stages
+    are raised again here.
+    """
+    stop = threading.Event()
+    queues = [Queue.Queue(size) for _ in range(len(stages) + 1)]
+    threads = [threading.Thread(target=feed_stage,
+                                args=(items, queues[0], stop))]
+    for func, source, output in zip(stages, queues, queues[1:]):
+        threads.append(threading.Thread(target=run_stage,
+                                        args=(func, source, output, stop)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is DONE:
+                return
+            if isinstance(item, StageError):
+                raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            while thread.is_alive():
+                # unblock stages waiting for full or empty queues
+                for queue in queues:
+                    drain(queue)
+                    try:
+                        queue.put_nowait(DONE)
+                    except Queue.Full:
+                        pass
+                thread.join(0.01)
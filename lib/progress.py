@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import sys
+import time
+import locale
+import threading
+
+from contextlib import contextmanager
+
+SFENC = sys.getfilesystemencoding()
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+# level of a dispatcher nobody listens to
+SILENT = 100
+
+
+class Event(object):
+    """
+    Progress event passed to listeners.
+
+    Kind is 'message', 'error', 'book_started', 'book_finished' or
+    'stage'. Messages are formatted only when their text is needed.
+    """
+
+    def __init__(self, kind, level, msg='', args=(), end='\n', book=None,
+                 stage=None, seconds=None, error=None):
+        self.kind = kind
+        self.level = level
+        self.msg = msg
+        self.args = args
+        self.end = end
+        self.book = book
+        self.stage = stage
+        self.seconds = seconds
+        self.error = error
+
+    @property
+    def text(self):
+        if self.kind not in ('message', 'error'):
+            return None
+        if self.args:
+            return self.msg % self.args + self.end
+        return self.msg + self.end
+
+
+class Progress(object):
+    """
+    Dispatcher of progress events to subscribed listeners.
+
+    Every listener is called with events not below the level it was
+    subscribed with. Events below the level of all listeners are dropped
+    before anything is created or formatted, so with no verbose listener
+    debug messages cost one comparison. There is one instance per process
+    (PROGRESS), events of worker processes are collected and emitted
+    again in the main process. The book being processed is tracked per
+    thread.
+    """
+
+    def __init__(self):
+        self.listeners = []
+        self.level = SILENT
+        self.local = threading.local()
+
+    @property
+    def book(self):
+        return getattr(self.local, 'book', None)
+
+    @property
+    def book_error(self):
+        return getattr(self.local, 'book_error', None)
+
+    def subscribe(self, listener, level=INFO):
+        self.listeners.append((level, listener))
+        self.level = min(self.level, level)
+
+    def unsubscribe(self, listener):
+        self.listeners = [(level, subscribed)
+                          for level, subscribed in self.listeners
+                          if subscribed is not listener]
+        self.level = min([level for level, _ in self.listeners] + [SILENT])
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def emit(self, event):
+        events = getattr(self.local, 'events', None)
+        if events is not None:
+            events.append(event)
+            return
+        for level, listener in self.listeners:
+            if event.level >= level:
+                listener(event)
+
+    def log(self, level, msg, *args, **kwargs):
+        """Emit message; it is formatted with args like msg % args."""
+        if level < self.level:
+            return
+        self.emit(Event('message', level, msg, args, kwargs.get('end', '\n'),
+                        self.book))
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(WARNING, msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        """
+        Emit error message of the book being processed.
+
+        The error keyword argument names the error, it is reported when
+        the book is finished too.
+        """
+        error = kwargs.get('error', 'error')
+        if self.book is not None:
+            self.local.book_error = error
+        if ERROR < self.level:
+            return
+        self.emit(Event('error', ERROR, msg, args, kwargs.get('end', '\n'),
+                        self.book, error=error))
+
+    def stage(self, name, seconds):
+        """Emit time spent in processing stage."""
+        if DEBUG < self.level:
+            return
+        self.emit(Event('stage', DEBUG, book=self.book, stage=name,
+                        seconds=seconds))
+
+    def book_started(self, path):
+        if DEBUG < self.level:
+            return
+        self.emit(Event('book_started', DEBUG, book=path))
+
+    def book_finished(self, path, seconds, error=None):
+        if DEBUG < self.level:
+            return
+        self.emit(Event('book_finished', DEBUG, book=path, seconds=seconds,
+                        error=error))
+
+    @contextmanager
+    def processing(self, path):
+        """Emit book started and finished events around the block."""
+        with self.collecting(getattr(self.local, 'events', None), path):
+            self.book_started(path)
+            start = time.time()
+            try:
+                yield
+            finally:
+                self.book_finished(path, time.time() - start,
+                                   self.book_error)
+
+    @contextmanager
+    def collecting(self, events, path):
+        """
+        Track book at path as processed by the thread within the block.
+
+        Events emitted by the thread meanwhile are appended to events
+        (unless it is None) instead of being passed to listeners.
+        """
+        local = self.local
+        previous = (getattr(local, 'events', None), self.book,
+                    self.book_error)
+        local.events, local.book, local.book_error = events, path, None
+        try:
+            yield
+        finally:
+            local.events, local.book, local.book_error = previous
+
+    def capture(self, level):
+        """Replace listeners with a list collecting events and return it."""
+        events = []
+        self.listeners = []
+        self.level = SILENT
+        self.subscribe(events.append, level)
+        return events
+
+
+def decode_text(text):
+    if isinstance(text, unicode):
+        return text
+    return text.decode(SFENC, 'replace')
+
+
+def stream_writer(stream):
+    """Return function writing unicode text to the stream."""
+    if not isinstance(stream, file):
+        # Tk widgets and unicode aware consoles take unicode
+        return stream.write
+    encoding = (getattr(stream, 'encoding', None) or
+                locale.getpreferredencoding() or 'utf-8')
+
+    def write(text):
+        stream.write(text.encode(encoding, 'replace'))
+        stream.flush()
+    return write
+
+
+class LogSink(object):
+    """
+    Listener writing text of messages in chunks.
+
+    Messages are buffered and written by one call of write when the
+    buffer grows over size or at most interval seconds after they were
+    emitted, so the console or the widget is not updated for every line.
+    """
+
+    def __init__(self, write, level=INFO, interval=0.25, size=65536):
+        self.write = write
+        self.level = level
+        self.interval = interval
+        self.size = size
+        self.chunks = []
+        self.buffered = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.flusher = threading.Thread(target=self.run)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def __call__(self, event):
+        text = event.text
+        if not text:
+            return
+        with self.lock:
+            self.chunks.append(decode_text(text))
+            self.buffered += len(text)
+            if self.buffered >= self.size:
+                self.flush_locked()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if not self.chunks:
+            return
+        text = u''.join(self.chunks)
+        self.chunks = []
+        self.buffered = 0
+        self.write(text)
+
+    def close(self):
+        self.done.set()
+        self.flusher.join()
+        self.flush()
+
+
+class StreamRedirector(object):
+    """File-like object emitting text written to it as messages."""
+
+    def __init__(self, level=INFO):
+        self.level = level
+
+    def write(self, text):
+        PROGRESS.log(self.level, text, end='')
+
+    def flush(self):
+        pass
+
+
+PROGRESS = Progress()
+
+
+@contextmanager
+def printed_progress(level, stream=None):
+    """
+    Write messages not below level to stream (stdout) within the block.
+
+    Text printed directly is passed through PROGRESS meanwhile, so it is
+    kept in order with buffered messages. Nothing is done if somebody
+    listens to PROGRESS already.
+    """
+    if PROGRESS.listeners:
+        yield
+        return
+    stdout = sys.stdout
+    sink = LogSink(stream_writer(stream or stdout), level)
+    PROGRESS.subscribe(sink, level)
+    sys.stdout = StreamRedirector()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+        PROGRESS.unsubscribe(sink)
+        sink.close()
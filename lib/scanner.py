@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+from __future__ import print_function
+import os
+import sys
+
+from datetime import datetime
+
+from lib.progress import PROGRESS
+
+MOBI_EXTENSIONS = ('.azw', '.azw3', '.mobi')
+KFX_EXTENSIONS = ('.kfx', '.azw8')
+BOOK_EXTENSIONS = MOBI_EXTENSIONS + KFX_EXTENSIONS
+
+
+class Book(object):
+    """Single eBook file found in Kindle documents directory."""
+
+    def __init__(self, root, name, stat):
+        self.root = root
+        self.name = name
+        self.path = os.path.join(root, name)
+        self.stem, self.ext = os.path.splitext(name)
+        self.ext = self.ext.lower()
+        self.stat = stat
+        if self.ext in KFX_EXTENSIONS:
+            self.format = 'kfx'
+        else:
+            self.format = 'mobi'
+
+    @property
+    def fide(self):
+        return self.name.decode(sys.getfilesystemencoding())
+
+    @property
+    def is_kfx(self):
+        return self.format == 'kfx'
+
+
+def scan_library(docs, days):
+    """
+    Walk Kindle documents directory once and return list of books.
+
+    Dictionaries and attachables subtrees are pruned. If days is given
+    only books not older than days are returned.
+    """
+    if days is not None:
+        dtt = datetime.today()
+        days_int = int(days)
+    books = []
+    for root, dirs, files in os.walk(docs):
+        for d in list(dirs):
+            if (os.path.join(root, d) == os.path.join(docs, 'dictionaries') or
+                    'attachables' in d):
+                if d == 'dictionaries':
+                    PROGRESS.debug('! Excluded dictionaries: %s',
+                                   os.path.join(root, d))
+                dirs.remove(d)
+        for name in files:
+            if not name.lower().endswith(BOOK_EXTENSIONS):
+                continue
+            if 'attachables' in name:
+                continue
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            if days is not None:
+                dt = datetime.fromtimestamp(stat.st_ctime).strftime('%Y-%m-%d')
+                dt = datetime.strptime(dt, '%Y-%m-%d')
+                if (dtt - dt).days > days_int:
+                    continue
+            books.append(Book(root, name, stat))
+    return books
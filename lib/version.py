@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+# shared by the command line and the GUI front-ends
+numeric_version = (1, 0, 1)
+__version__ = u'.'.join(map(unicode, numeric_version))
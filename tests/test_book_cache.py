@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+"""Tests of lib/book_cache.py."""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from lib import book_cache
+from lib.book_cache import BookCache
+from lib.progress import PROGRESS, WARNING
+from lib.scanner import Book
+
+
+class BookCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.home = os.environ.get('HOME')
+        os.environ['HOME'] = os.path.join(self.tmp, 'home')
+        self.kindle = os.path.join(self.tmp, 'kindle')
+        self.docs = os.path.join(self.kindle, 'documents')
+        os.makedirs(os.path.join(self.kindle, 'system'))
+        os.makedirs(self.docs)
+        self.warnings = []
+        PROGRESS.subscribe(self.warnings.append, WARNING)
+
+    def tearDown(self):
+        PROGRESS.unsubscribe(self.warnings.append)
+        if self.home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = self.home
+        shutil.rmtree(self.tmp)
+
+    def book(self, name, content='book'):
+        path = os.path.join(self.docs, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return Book(self.docs, name, os.stat(path))
+
+    def cache_files(self):
+        return sorted(os.listdir(book_cache.cache_dir()))
+
+    def test_round_trip(self):
+        book = self.book('a.mobi')
+        data = {'asin': 'B000000001', 'title': 'Zażółć',
+                'pages_row': ['B000000001', 'pl', 'Autor', 'Tytuł']}
+        cache = BookCache(self.kindle)
+        self.assertIsNone(cache.get(book))
+        cache.put(book, data)
+        cache.save()
+        self.assertEqual(self.warnings, [])
+        loaded = BookCache(self.kindle)
+        self.assertEqual(loaded.get(book), data)
+        self.assertIsInstance(loaded.get(book)['title'], str)
+        self.assertEqual((loaded.hits, loaded.misses), (2, 0))
+
+    def test_changed_book_misses(self):
+        book = self.book('a.mobi')
+        cache = BookCache(self.kindle)
+        cache.put(book, {'asin': 'B000000001'})
+        cache.save()
+        changed = self.book('a.mobi', 'changed book')
+        loaded = BookCache(self.kindle)
+        self.assertIsNone(loaded.get(changed))
+        self.assertEqual(loaded.misses, 1)
+
+    def test_other_version_is_dropped(self):
+        book = self.book('a.mobi')
+        cache = BookCache(self.kindle)
+        cache.put(book, {'asin': 'B000000001'})
+        cache.save()
+        with open(cache.path, 'rb') as f:
+            data = json.load(f)
+        data['tool_version'] = '0.0'
+        with open(cache.path, 'wb') as f:
+            json.dump(data, f)
+        self.assertEqual(BookCache(self.kindle).entries, {})
+
+    def test_unsaveable_text_is_a_warning(self):
+        book = self.book('a.mobi')
+        cache = BookCache(self.kindle)
+        # cp1252 title which is not valid UTF-8
+        cache.put(book, {'pages_row': ['* NONE *', 'pl', 'Autor',
+                                       'Tytu\xb3']})
+        cache.save()
+        self.assertEqual(len(self.warnings), 1)
+        self.assertIn('Unable to save', self.warnings[0].text)
+        self.assertEqual(self.cache_files(), [])
+
+    def test_disabled_cache_is_not_saved(self):
+        book = self.book('a.mobi')
+        cache = BookCache(self.kindle, enabled=False)
+        cache.put(book, {'asin': 'B000000001'})
+        cache.save()
+        self.assertEqual(cache.get(book), {'asin': 'B000000001'})
+        self.assertFalse(os.path.isdir(book_cache.cache_dir()))
+
+    def test_prune(self):
+        kept, removed = self.book('a.mobi'), self.book('b.mobi')
+        cache = BookCache(self.kindle)
+        cache.put(kept, {'asin': 'B000000001'})
+        cache.put(removed, {'asin': 'B000000002'})
+        cache.prune([kept])
+        self.assertEqual(list(cache.entries), ['a.mobi'])
+
+
+if __name__ == '__main__':
+    unittest.main()
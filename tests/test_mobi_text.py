@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+"""Tests of text decompression of lib/mobi_text.py."""
+
+import random
+import unittest
+
+from benchmarks.synthetic import (cdic_records, huff_record,
+                                  huffcdic_codes, huffcdic_compress)
+from lib.mobi_text import HuffcdicReader, palmdoc_decompress
+
+
+class PalmdocDecompressTest(unittest.TestCase):
+
+    def test_literals(self):
+        self.assertEqual(palmdoc_decompress(b'Hello\x00\x7f'),
+                         b'Hello\x00\x7f')
+        self.assertEqual(palmdoc_decompress(b''), b'')
+
+    def test_escaped_literals(self):
+        # count byte 1-8 is followed by bytes copied as they are
+        self.assertEqual(palmdoc_decompress(b'a\x03\xff\x80\x01b'),
+                         b'a\xff\x80\x01b')
+
+    def test_space_and_character(self):
+        self.assertEqual(palmdoc_decompress(b'a\xe2\xf8'), b'a b x')
+
+    def test_distance_and_length(self):
+        # distance 3, length 3
+        self.assertEqual(palmdoc_decompress(b'abc\x80\x18d'), b'abcabcd')
+        # distance 6, length 10
+        self.assertEqual(palmdoc_decompress(b'abcdef\x80\x37'),
+                         b'abcdefabcdefabcd')
+
+    def test_overlapping_copy(self):
+        # distance 2 shorter than length 6 repeats copied text
+        self.assertEqual(palmdoc_decompress(b'ab\x80\x13'), b'abababab')
+        self.assertEqual(palmdoc_decompress(b'-\x80\x0f'), b'-' * 11)
+
+    def test_invalid_distance_is_skipped(self):
+        self.assertEqual(palmdoc_decompress(b'ab\x80\x00c'), b'abc')
+        self.assertEqual(palmdoc_decompress(b'ab\x80\x28c'), b'abc')
+
+    def test_buffer(self):
+        data = b'xxabc\x80\x18\xf8\x02\xff\x01Y'
+        self.assertEqual(palmdoc_decompress(buffer(data, 2)),
+                         b'abcabc x\xff\x01Y')
+
+
+class HuffcdicReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.codes = huffcdic_codes()[0]
+        self.phrases = [b'p%04d' % index for index in range(len(self.codes))]
+
+    def reader(self, phrases):
+        return HuffcdicReader(huff_record(),
+                              cdic_records(self.codes, phrases))
+
+    def compress(self, indexes):
+        return huffcdic_compress(self.codes, indexes)
+
+    def test_every_code(self):
+        # codes of all lengths, including longer than 16 bits
+        indexes = list(range(len(self.codes)))
+        random.Random(0).shuffle(indexes)
+        self.assertEqual(self.reader(self.phrases).unpack(
+            self.compress(indexes)),
+            b''.join(self.phrases[index] for index in indexes))
+
+    def test_empty_record(self):
+        self.assertEqual(self.reader(self.phrases).unpack(b''), b'')
+
+    def test_buffer(self):
+        data = b'xx' + self.compress([0, 1, 2, len(self.codes) - 1])
+        self.assertEqual(self.reader(self.phrases).unpack(buffer(data, 2)),
+                         b'p0000p0001p0002p%04d' % (len(self.codes) - 1))
+
+    def test_compressed_phrase(self):
+        phrases = list(self.phrases)
+        phrases[5] = [1, 1000, 2]
+        reader = self.reader(phrases)
+        self.assertIsNone(reader.phrases[5])
+        self.assertEqual(reader.unpack(self.compress([5, 0, 5])),
+                         b'p0001p1000p0002p0000p0001p1000p0002')
+        self.assertEqual(reader.phrases[5], b'p0001p1000p0002')
+
+    def test_recursive_phrase(self):
+        phrases = list(self.phrases)
+        phrases[5] = [1, 5]
+        with self.assertRaises(ValueError):
+            self.reader(phrases).unpack(self.compress([5]))
+
+
+if __name__ == '__main__':
+    unittest.main()
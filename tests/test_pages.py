@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+"""Tests of PagesDatabase of lib/pages.py."""
+
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+
+from lib.pages import PagesDatabase
+
+
+def row(asin, pages, mfile):
+    return [asin, 'pl', 'Autor', 'Tytuł', pages, 'False', mfile]
+
+
+class PagesDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.csvfile = os.path.join(self.tmp, 'book_pages.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_rows(self, rows):
+        with open(self.csvfile, 'wb') as o:
+            csvwrite = csv.writer(o, delimiter=';', quotechar='"',
+                                  quoting=csv.QUOTE_ALL)
+            csvwrite.writerow(PagesDatabase.header)
+            for r in rows:
+                csvwrite.writerow(r)
+
+    def test_new_file_has_header(self):
+        db = PagesDatabase(self.csvfile)
+        self.assertEqual(db.count, 0)
+        with open(self.csvfile, 'rb') as f:
+            self.assertEqual(list(csv.reader(f, delimiter=';')),
+                             [PagesDatabase.header])
+
+    def test_find_by_asin(self):
+        self.write_rows([row('B000000001', '100', 'a.mobi'),
+                         row('B000000002', '200', 'b.mobi')])
+        db = PagesDatabase(self.csvfile)
+        self.assertEqual(db.find('B000000002', 'other.mobi')[4], '200')
+        self.assertIsNone(db.find('B000000003', 'a.mobi'))
+
+    def test_find_without_asin_by_file(self):
+        self.write_rows([row('* NONE *', '100', 'a.mobi'),
+                         row('* NONE *', '200', 'b.mobi')])
+        db = PagesDatabase(self.csvfile)
+        self.assertEqual(db.find('* NONE *', 'b.mobi')[4], '200')
+        self.assertEqual(db.find('B000000001', 'a.mobi')[4], '100')
+        self.assertIsNone(db.find('* NONE *', 'c.mobi'))
+
+    def test_last_row_wins(self):
+        self.write_rows([row('B000000001', '100', 'a.mobi'),
+                         row('* NONE *', '150', 'b.mobi'),
+                         row('B000000001', '200', 'c.mobi')])
+        db = PagesDatabase(self.csvfile)
+        self.assertEqual(db.find('B000000001', 'a.mobi')[4], '200')
+        # row without ASIN matched by file comes after the ASIN row
+        self.write_rows([row('B000000001', '100', 'a.mobi'),
+                         row('* NONE *', '150', 'b.mobi')])
+        db = PagesDatabase(self.csvfile)
+        self.assertEqual(db.find('B000000001', 'b.mobi')[4], '150')
+
+    def test_add(self):
+        db = PagesDatabase(self.csvfile)
+        self.assertTrue(db.add(row('B000000001', '100', 'a.mobi')))
+        self.assertTrue(db.add(row('* NONE *', '200', 'b.mobi')))
+        self.assertEqual(db.find('B000000001', 'x.mobi')[4], '100')
+        self.assertEqual(db.find('* NONE *', 'b.mobi')[4], '200')
+        self.assertTrue(db.has_file('b.mobi'))
+        reloaded = PagesDatabase(self.csvfile)
+        self.assertEqual(reloaded.count, 3)
+        self.assertEqual(reloaded.find('* NONE *', 'b.mobi'),
+                         row('* NONE *', '200', 'b.mobi'))
+
+    def test_add_rejects_duplicates(self):
+        db = PagesDatabase(self.csvfile)
+        self.assertTrue(db.add(row('B000000001', '100', 'a.mobi')))
+        self.assertFalse(db.add(row('B000000001', '200', 'b.mobi')))
+        self.assertFalse(db.add(row('* NONE *', '200', 'a.mobi')))
+        self.assertFalse(db.add(None))
+        self.assertEqual(PagesDatabase(self.csvfile).count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of ExtractCoverThumbs, licensed under
+# GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+"""Tests of pipeline of lib/parallel.py."""
+
+import time
+import threading
+import traceback
+import unittest
+
+from lib.parallel import pipeline
+
+
+class StageFailed(Exception):
+    pass
+
+
+def double(item):
+    return item * 2
+
+
+def fail_on_three(item):
+    if item == 3:
+        raise StageFailed(item)
+    return item
+
+
+def feed_failing(count):
+    for item in range(count):
+        yield item
+    raise StageFailed('feed')
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.threads = threading.active_count()
+
+    def tearDown(self):
+        # stage threads are stopped when the pipeline is left
+        self.assertEqual(threading.active_count(), self.threads)
+
+    def test_results_in_order(self):
+        self.assertEqual(list(pipeline(range(100), [double, str], 4)),
+                         [str(item * 2) for item in range(100)])
+
+    def test_without_stages(self):
+        self.assertEqual(list(pipeline(iter('abc'), [])), ['a', 'b', 'c'])
+
+    def test_stage_error_is_raised(self):
+        results = []
+        with self.assertRaises(StageFailed) as raised:
+            for item in pipeline(range(10), [fail_on_three, double]):
+                results.append(item)
+        self.assertEqual(results, [0, 2, 4])
+        self.assertEqual(raised.exception.args, (3,))
+        # traceback of the stage thread is kept
+        self.assertIn('fail_on_three', traceback.format_exc())
+
+    def test_feed_error_is_raised(self):
+        results = []
+        with self.assertRaises(StageFailed) as raised:
+            for item in pipeline(feed_failing(3), [double]):
+                results.append(item)
+        self.assertEqual(results, [0, 2, 4])
+        self.assertEqual(raised.exception.args, ('feed',))
+
+    def test_queues_are_bounded(self):
+        fed = []
+
+        def items():
+            for item in range(100):
+                fed.append(item)
+                yield item
+
+        size = 2
+        stages = [double, double]
+        # items in queues and held by the feeding and stage threads
+        limit = (len(stages) + 1) * size + len(stages) + 1
+        for consumed, _ in enumerate(pipeline(items(), stages, size), 1):
+            time.sleep(0.002)
+            self.assertLessEqual(len(fed) - consumed, limit)
+        self.assertEqual(len(fed), 100)
+
+    def test_leaving_early_stops_stages(self):
+        results = pipeline(iter(range(1000)), [double], 2)
+        self.assertEqual(next(results), 0)
+        results.close()
+
+
+if __name__ == '__main__':
+    unittest.main()